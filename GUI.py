@@ -773,10 +773,11 @@ def in_handler(gui: NoFrame) -> None:
                     reload_chat_previews = True
             
             elif item.type == "create_chat_fail":
-                    if not item.data[0]:
+                    # The server sends the reason the chat was not created (the user or the chat does not exist, or the server is unavailable)
+                    if not item.data:
                         err = "Something went wrong"
                     else:
-                        err = "User does not exist" #TODO per qualche motivo spunta solo U in item.data[0]
+                        err = item.data
                     if gui.is_new_chat_menu_open:
                         print("chat create error", err)
                         gui.newchat_error.config(text = err)
@@ -54,7 +54,8 @@ CREATE TABLE `chat` (
   `Description` char(255) DEFAULT NULL,
   `Creation_date` date NOT NULL,
   `Founder_id` int(11) NOT NULL,
-  `Message_counter` int(11) NOT NULL
+  `Message_counter` int(11) NOT NULL,
+  `Archived_number` int(11) NOT NULL DEFAULT 0
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 --
@@ -83,6 +84,25 @@ CREATE TABLE `message` (
 
 -- --------------------------------------------------------
 
+--
+-- Struttura della tabella `message_archive`
+--
+-- The old messages every partecipant read are moved here (see Server._archive_messages), so that the message table
+-- and its indexes only hold the recent ones. The messages 1 to chat.Archived_number of a chat are archived,
+-- the following ones are in message. The rows are clustered by chat, and compressed.
+--
+
+CREATE TABLE `message_archive` (
+  `ID` int(11) NOT NULL,
+  `Id_chat` int(11) NOT NULL,
+  `Id_sender` int(11) NOT NULL,
+  `Body` blob NOT NULL,
+  `Timestamp` datetime NOT NULL,
+  `Message_number` int(11) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 ROW_FORMAT=COMPRESSED;
+
+-- --------------------------------------------------------
+
 --
 -- Struttura della tabella `participate`
 --
@@ -90,7 +110,23 @@ CREATE TABLE `message` (
 CREATE TABLE `participate` (
   `Id_user` int(11) NOT NULL,
   `Id_chat` int(11) NOT NULL,
-  `Last_message_id` int(11) NOT NULL
+  `Last_message_id` int(11) NOT NULL,
+  `Inbox` tinyint(1) NOT NULL DEFAULT 0
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- --------------------------------------------------------
+
+--
+-- Struttura della tabella `inbox`
+--
+-- The messages not yet delivered to the partecipants whose participate.Inbox is set (the ones of the small chats,
+-- see Server._create_chat): create_message adds a row for each of them, and the server deletes it once delivered
+--
+
+CREATE TABLE `inbox` (
+  `Id_user` int(11) NOT NULL,
+  `Id_chat` int(11) NOT NULL,
+  `Message_number` int(11) NOT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 --
@@ -106,6 +142,9 @@ CREATE TRIGGER `Clean_up_chat` AFTER DELETE ON `participate` FOR EACH ROW BEGIN
 
 DECLARE x int DEFAULT 0;
 
+DELETE FROM inbox
+WHERE inbox.Id_user = old.Id_user AND inbox.Id_chat = old.Id_chat;
+
 SELECT COUNT(*) FROM participate
 WHERE old.Id_chat = participate.Id_chat INTO x;
 
@@ -133,6 +172,10 @@ WHERE participate.Id_user = old.ID;
 UPDATE message
 SET message.Id_sender = 1
 WHERE message.Id_sender = old.ID;
+
+UPDATE message_archive
+SET message_archive.Id_sender = 1
+WHERE message_archive.Id_sender = old.ID;
 END
 $$
 DELIMITER ;
@@ -154,7 +197,14 @@ ALTER TABLE `chat`
 ALTER TABLE `message`
   ADD PRIMARY KEY (`ID`),
   ADD KEY `Foreign_key_sender_id` (`Id_sender`),
-  ADD KEY `Id_chat` (`Id_chat`);
+  ADD UNIQUE KEY `Chat_message_number` (`Id_chat`,`Message_number`);
+
+--
+-- Indici per le tabelle `message_archive`
+--
+ALTER TABLE `message_archive`
+  ADD PRIMARY KEY (`Id_chat`,`Message_number`),
+  ADD KEY `Archive_sender_id` (`Id_sender`);
 
 --
 -- Indici per le tabelle `participate`
@@ -162,11 +212,18 @@ ALTER TABLE `message`
 ALTER TABLE `participate`
   ADD PRIMARY KEY (`Id_user`,`Id_chat`);
 
+--
+-- Indici per le tabelle `inbox`
+--
+ALTER TABLE `inbox`
+  ADD PRIMARY KEY (`Id_user`,`Id_chat`,`Message_number`);
+
 --
 -- Indici per le tabelle `user`
 --
 ALTER TABLE `user`
-  ADD PRIMARY KEY (`ID`);
+  ADD PRIMARY KEY (`ID`),
+  ADD UNIQUE KEY `Nick_IDN` (`Nick`,`IDN`);
 
 --
 -- AUTO_INCREMENT per le tabelle scaricate
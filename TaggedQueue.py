@@ -1,24 +1,46 @@
 import time
+import threading
+from collections import deque, OrderedDict, Counter
 from typing import *
 import datetime
+from metrics import Histogram
 
 QUEUE_RESPONSE_TIMEOUT = 15
 QUEUE_CHECK_DELAY = 0.1
+WAIT_INTERRUPT_CHECK_DELAY = 0.1  # How often a waiter that can be interrupted checks whether it was (in seconds)
+RESPONSE_TTL = 60               # The time an unclaimed response is kept in the queue (in seconds)
+MAX_RESPONSES = 10000           # The maximum number of unclaimed responses kept in the queue
+UNKNOWN_JOB_TYPE = "unknown"    # The job type used in the counters when the type of a response can't be found
+
+# Priority classes of the jobs (lower value = served first)
+PRIORITY_INTERACTIVE = 0    # Jobs a client is waiting for (login, messages, chats...)
+PRIORITY_BACKGROUND = 1     # Bookkeeping jobs nobody waits for (status, last seen...)
+# How many jobs of each lane are served in a round, when every lane has jobs waiting
+LANE_WEIGHTS = {
+    PRIORITY_INTERACTIVE: 4,
+    PRIORITY_BACKGROUND: 1
+}
 
 class Job():
     """
     The Job class is used to store the jobs to be executed by the worker threads
     """
 
-    def __init__(self, type: str, args: TypedDict, job_tag: int = None):
+    def __init__(self, type: str, args: TypedDict, job_tag: int = None, priority: int = PRIORITY_INTERACTIVE, no_reply: bool = False, session: Hashable = None):
         """
         The constructor of the Job class
+        A no_reply job is fire-and-forget: it never produces a response, and the queue keeps no bookkeeping for it
+        A job with a session is cancelled if the session ends before a worker takes it (see TaggedQueue.cancel_session)
         """
         self.type = type
         self.args = args
         self.job_tag = job_tag
-        self.request_time = None
-        self.response_time = None
+        self.priority = priority
+        self.no_reply = no_reply
+        self.session = session
+        self.request_time = None    # When the job was put in the queue
+        self.start_time = None      # When a worker took the job
+        self.response_time = None   # When the worker finished the job
 
 
 class Response():
@@ -44,78 +66,458 @@ class TaggedQueue():
     It also provides methods
     """
 
-    def __init__(self):
+    def __init__(self, lane_weights: Dict[int, int] = None, response_ttl: float = RESPONSE_TTL, max_responses: int = MAX_RESPONSES):
         """
         The constructor of the TaggedQueue class
         """
-        # We store the queue
-        self.request_queue = []
+        # We store one queue per priority class (a deque, so that taking the next job is O(1))
+        self.lane_weights = dict(LANE_WEIGHTS if lane_weights is None else lane_weights)
+        self.lanes = {priority: deque() for priority in sorted(self.lane_weights)}
+        # Jobs each lane can still be served in the current round (weighted round robin)
+        self.lane_credits = dict(self.lane_weights)
+        # Per-lane counters: jobs served, total and maximum time spent waiting in the queue (in seconds)
+        self.lane_served = {priority: 0 for priority in self.lanes}
+        self.lane_wait_time = {priority: 0.0 for priority in self.lanes}
+        self.lane_max_wait_time = {priority: 0.0 for priority in self.lanes}
+        # Notified every time a job is put in the queue, so that idle workers wake up immediately
+        self.requests_available = threading.Condition(threading.Lock())
         self.responses = {}
+        # One event per tag, set by put_response to wake up whoever is waiting on that tag
+        self.waiters = {}
+        # Protects the responses, the waiters and the response bookkeeping
+        self.responses_lock = threading.Lock()
+        # Unclaimed responses expire after response_ttl seconds, and at most max_responses are kept
+        self.response_ttl = response_ttl
+        self.max_responses = max_responses
+        # tag : (expiration time, job type) of the stored responses, oldest first
+        self.response_deadlines = OrderedDict()
+        # tag : (expiration time, job type) of the jobs still waiting for a response
+        self.pending_types = {}
+        # expiration delay : (expiration time, tag) of the pending jobs, oldest first.
+        # The delay depends on the queue timeout of the job type, so there is one queue per delay to keep each one ordered
+        self.pending_deadlines = {}
+        # tag : expiration time of the tags whose waiter gave up, oldest first
+        self.abandoned = OrderedDict()
+        # Per job type counters of the responses nobody collected
+        self.orphaned_responses = Counter()    # arrived after their waiter timed out
+        self.expired_responses = Counter()     # never claimed before the TTL
+        self.evicted_responses = Counter()     # dropped because the store was full
         # We store the number of jobs
         self.number_of_jobs = 0
+        # Per job type limits: maximum number of jobs running at once, and maximum time a job may wait in the queue (in seconds)
+        self.concurrency_limits = {}
+        self.queue_timeouts = {}
+        # Per job type counters: jobs currently running, and jobs dropped because they waited longer than their timeout
+        self.running_jobs = Counter()
+        self.timed_out_jobs = Counter()
+        # Per job type counter of the jobs removed from the queue because their session ended
+        self.cancelled_jobs = Counter()
+        # job type : {"queue_wait", "execution", "end_to_end"} latency histograms
+        self.latencies = {}
+        self.latencies_lock = threading.Lock()
 
     def __len__(self):
         """
         The length of the queue
         """
-        return len(self.queue)
+        return sum(len(lane) for lane in self.lanes.values())
+
+    @property
+    def request_queue(self) -> List[Job]:
+        """
+        The jobs waiting in the queue, ordered by priority class
+        """
+        with self.requests_available:
+            return [job for lane in self.lanes.values() for job in lane]
+
+    def set_job_type_limits(self, job_type: str, max_concurrency: int = None, timeout: float = None):
+        """
+        Sets the limits of a job type: at most max_concurrency jobs of the type are handed to the workers at once,
+        and a job that waited more than timeout seconds in the queue is dropped instead of being executed
+        (whoever was waiting for it already gave up). None means no limit
+        """
+        with self.requests_available:
+            self.concurrency_limits[job_type] = max_concurrency
+            self.queue_timeouts[job_type] = timeout
+            # A higher limit may make some waiting jobs runnable
+            self.requests_available.notify_all()
 
     def put_request(self, job: Job):
         """
-        Puts a job in the queue
-        """
-        # We increment the number of jobs
-        self.number_of_jobs += 1
-        # Generate a new job tag
-        job_tag = self.number_of_jobs
-        # assign the job tag to the job
-        job.job_tag = job_tag
-        # store the time of the request
-        job.request_time = datetime.datetime.now()
-        # We insert the job in the queue
-        self.request_queue.append(job)
+        Puts a job in the queue, in the lane of its priority class
+        """
+        if job.priority not in self.lanes:
+            raise ValueError("Unknown job priority: {}".format(job.priority))
+        with self.requests_available:
+            # We increment the number of jobs
+            self.number_of_jobs += 1
+            # Generate a new job tag
+            job_tag = self.number_of_jobs
+            # assign the job tag to the job
+            job.job_tag = job_tag
+            # store the time of the request
+            job.request_time = datetime.datetime.now()
+            if not job.no_reply:
+                with self.responses_lock:
+                    # We remember the type of the job, to account for its response if nobody collects it
+                    # (before a worker can take the job and answer it).
+                    # The job may wait in the queue up to its timeout before it's answered, so we keep it longer than the TTL
+                    delay = self.response_ttl + (self.queue_timeouts.get(job.type) or 0)
+                    deadline = time.monotonic() + delay
+                    self.pending_types[job_tag] = (deadline, job.type)
+                    self.pending_deadlines.setdefault(delay, deque()).append((deadline, job_tag))
+            # We insert the job in its lane
+            self.lanes[job.priority].append(job)
+            # We wake up one of the waiting workers
+            self.requests_available.notify()
         # We return the job tag
         return job_tag
 
+    def cancel_session(self, session: Hashable) -> int:
+        """
+        Removes from the queue the jobs of a session that no worker took yet, and returns how many were cancelled.
+        Used when a client disconnects, so that the workers don't spend time on requests nobody will read
+        """
+        cancelled = []
+        with self.requests_available:
+            for priority, lane in self.lanes.items():
+                if not any(job.session == session for job in lane):
+                    continue
+                # We rebuild the lane without the jobs of the session
+                kept = deque()
+                for job in lane:
+                    if job.session == session:
+                        cancelled.append(job)
+                        self.cancelled_jobs[job.type] += 1
+                    else:
+                        kept.append(job)
+                self.lanes[priority] = kept
+        with self.responses_lock:
+            # No response will ever come for the cancelled jobs
+            for job in cancelled:
+                self.pending_types.pop(job.job_tag, None)
+        return len(cancelled)
+
     def put_response(self, job_tag: int, response: Response):
         """
-        Puts a response in the queue
-        """
-        # We store the response
-        self.responses[job_tag] = response
-
-    def wait_for_result(self, tag, timeout: int = QUEUE_RESPONSE_TIMEOUT, pop_response : bool = True) -> Response:
-        """
-        Waits for a result with the given tag
-        """
-        # We get the current time
-        start_time = time.time()
-        # We loop until we find the result
-        while True:
-            # We check if the timeout has been reached
-            if time.time() - start_time > timeout:
-                return None
-            # We check if the result is in the queue
-            if tag in self.responses:
-                # We get the response
-                response = self.responses[tag]
-                # We check if we have to pop the response
-                if pop_response:
-                    # We pop the response
-                    del self.responses[tag]
-                # We return the response
-                return response
-            # We wait a bit
-            time.sleep(0)
-
-    def next(self):
-        """
-        Returns the next job in the queue
-        """
-        # We check if the queue is empty
-        if len(self.request_queue) == 0:
-            return None
-        # We get the next job
-        job = self.request_queue.pop(0)
-        # We return the job
-        return job
\ No newline at end of file
+        Puts a response in the queue, and wakes up the threads waiting for it
+        """
+        with self.responses_lock:
+            now = time.monotonic()
+            # We drop the expired responses first
+            self._evict_expired(now)
+            job_type = self._job_type(job_tag)
+            # If the waiter already gave up, nobody will ever collect the response
+            if self.abandoned.pop(job_tag, None) is not None:
+                self.orphaned_responses[job_type] += 1
+                self.waiters.pop(job_tag, None)
+                return
+            # We store the response
+            self.responses[job_tag] = response
+            self.response_deadlines.pop(job_tag, None)
+            self.response_deadlines[job_tag] = (now + self.response_ttl, job_type)
+            # We signal the waiters (if nobody is waiting yet, the event is already set when they arrive)
+            event = self.waiters.get(job_tag)
+            if event is None:
+                event = self.waiters[job_tag] = threading.Event()
+            event.set()
+            # If the store is full, we drop the oldest responses
+            while len(self.response_deadlines) > self.max_responses:
+                tag, (_, oldest_type) = self.response_deadlines.popitem(last=False)
+                self._forget_response(tag)
+                self.evicted_responses[oldest_type] += 1
+
+    def wait_for_result(self, tag, timeout: int = QUEUE_RESPONSE_TIMEOUT, pop_response : bool = True, interrupted: Callable[[], bool] = None) -> Response:
+        """
+        Waits for a result with the given tag.
+        The calling thread is blocked (without using the CPU) until the response is put in the queue or the timeout expires.
+        If interrupted is given, it is called every WAIT_INTERRUPT_CHECK_DELAY seconds, and the wait ends as soon as it returns True
+        (for example when the client waiting for the result disconnects).
+        Returns None if the timeout expires or the wait is interrupted.
+        """
+        # We get (or create) the event associated with the tag
+        with self.responses_lock:
+            event = self.waiters.get(tag)
+            if event is None:
+                event = self.waiters[tag] = threading.Event()
+        # We wait until the response is put in the queue
+        deadline = time.monotonic() + timeout
+        while not event.wait(timeout if interrupted is None else max(0, min(WAIT_INTERRUPT_CHECK_DELAY, deadline - time.monotonic()))):
+            if interrupted is not None and time.monotonic() < deadline and not interrupted():
+                continue
+            with self.responses_lock:
+                # Nobody answered in time: we forget the event, unless the response arrived in the meantime
+                if tag not in self.responses:
+                    if self.waiters.get(tag) is event:
+                        del self.waiters[tag]
+                    # If the response arrives later, it will be discarded and accounted as orphaned
+                    self.abandoned.pop(tag, None)
+                    self.abandoned[tag] = time.monotonic() + self.response_ttl
+                    return None
+            break
+        with self.responses_lock:
+            # We get the response
+            response = self.responses.get(tag)
+            # We check if we have to pop the response
+            if pop_response and tag in self.responses:
+                # We pop the response
+                self._forget_response(tag)
+                self.response_deadlines.pop(tag, None)
+        # We return the response
+        return response
+
+    def evict_expired_responses(self):
+        """
+        Drops the responses (and the bookkeeping) older than the TTL.
+        It is also done on every put_response, but it should be called periodically so that memory is freed when the queue is idle
+        """
+        with self.responses_lock:
+            self._evict_expired(time.monotonic())
+
+    def response_stats(self) -> dict:
+        """
+        Returns the number of stored responses and, per job type, the counters of the responses nobody collected
+        """
+        with self.responses_lock:
+            return {
+                "stored": len(self.responses),
+                "pending": len(self.pending_types),
+                "orphaned": dict(self.orphaned_responses),
+                "expired": dict(self.expired_responses),
+                "evicted": dict(self.evicted_responses)
+            }
+
+    def _job_type(self, tag) -> str:
+        """
+        Returns the type of the job that generated the tag, and forgets it. Must be called holding the responses lock.
+        Sub-job tags ("<job_tag>-<n>") are accounted to the type of their parent job
+        """
+        entry = self.pending_types.pop(tag, None)
+        if entry is None and isinstance(tag, str):
+            try:
+                entry = self.pending_types.get(int(tag.split("-")[0]))
+            except ValueError:
+                entry = None
+        return UNKNOWN_JOB_TYPE if entry is None else entry[1]
+
+    def _forget_response(self, tag):
+        """
+        Removes the response and the event of a tag. Must be called holding the responses lock
+        """
+        self.responses.pop(tag, None)
+        self.waiters.pop(tag, None)
+
+    def _evict_expired(self, now: float):
+        """
+        Drops everything past its expiration time. Must be called holding the responses lock.
+        Every bookkeeping dict (or queue of deadlines) is ordered by expiration time, so only the expired entries are visited
+        """
+        while self.response_deadlines:
+            tag, (deadline, job_type) = next(iter(self.response_deadlines.items()))
+            if deadline > now:
+                break
+            del self.response_deadlines[tag]
+            self._forget_response(tag)
+            self.expired_responses[job_type] += 1
+        for deadlines in self.pending_deadlines.values():
+            while deadlines and deadlines[0][0] <= now:
+                self.pending_types.pop(deadlines.popleft()[1], None)
+        while self.abandoned and next(iter(self.abandoned.values())) <= now:
+            self.abandoned.popitem(last=False)
+
+    def next(self, timeout: float = 0):
+        """
+        Returns the next job in the queue.
+        The lanes are served with a weighted round robin, so that the background lane cannot starve.
+        Jobs whose type already has max_concurrency jobs running are left in the queue, and jobs that waited longer
+        than the timeout of their type are dropped.
+        If no job can be run, blocks for up to timeout seconds waiting for one (None blocks forever).
+        Returns None if no job is available.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.requests_available:
+            while True:
+                # We get the next job
+                job = self._pop_next_job()
+                if job is not None:
+                    if self._timed_out(job):
+                        # Nobody is waiting for it anymore
+                        self.timed_out_jobs[job.type] += 1
+                        continue
+                    # We update the counters
+                    self._account_served(job)
+                    # We return the job
+                    return job
+                # We wait for a job that can be run, unless we can't wait anymore
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.requests_available.wait_for(self._has_runnable_requests, remaining)
+
+    def next_batch(self, job_type: str, max_n: int, max_wait: float = 0) -> List[Job]:
+        """
+        Returns up to max_n jobs of the given type, taken from every lane in queue order.
+        Waits up to max_wait seconds for the batch to fill; returns what was found (possibly nothing) when the time is up.
+        Used by the workers to coalesce many small jobs of the same type into a single statement.
+        """
+        batch = []
+        deadline = time.monotonic() + max_wait
+        with self.requests_available:
+            while True:
+                # We take the jobs of the type that are already in the queue
+                self._take_jobs_of_type(job_type, max_n - len(batch), batch)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= max_n or remaining <= 0:
+                    break
+                # We wait for more jobs
+                self.requests_available.wait(remaining)
+            # We may have consumed the wake-up meant for a job of another type: we pass it on to another worker
+            if self._has_requests():
+                self.requests_available.notify()
+        return batch
+
+    def job_done(self, job: Job):
+        """
+        Marks a job as finished, and records its queue wait, execution and end-to-end times in the histograms of its type.
+        It is called by the workers once they resolved the job
+        """
+        job.response_time = datetime.datetime.now()
+        with self.requests_available:
+            if job.start_time is not None:
+                self.running_jobs[job.type] -= 1
+                # A job of a limited type can now be run by a waiting worker
+                if self.concurrency_limits.get(job.type) is not None:
+                    self.requests_available.notify()
+        with self.latencies_lock:
+            histograms = self.latencies.get(job.type)
+            if histograms is None:
+                histograms = self.latencies[job.type] = {
+                    "queue_wait": Histogram(),
+                    "execution": Histogram(),
+                    "end_to_end": Histogram()
+                }
+        # A job that didn't go through next (e.g. resolved inline) only has an end-to-end time
+        start_time = job.start_time or job.request_time
+        histograms["queue_wait"].record((start_time - job.request_time).total_seconds())
+        histograms["execution"].record((job.response_time - start_time).total_seconds())
+        histograms["end_to_end"].record((job.response_time - job.request_time).total_seconds())
+
+    def latency_stats(self) -> Dict[str, dict]:
+        """
+        Returns, for each job type, a snapshot of the queue wait, execution and end-to-end histograms
+        """
+        with self.latencies_lock:
+            latencies = dict(self.latencies)
+        return {
+            job_type: {name: histogram.snapshot() for name, histogram in histograms.items()}
+            for job_type, histograms in latencies.items()
+        }
+
+    def lane_stats(self) -> Dict[int, dict]:
+        """
+        Returns, for each lane, the current depth and the wait-time counters
+        """
+        with self.requests_available:
+            return {
+                priority: {
+                    "depth": len(self.lanes[priority]),
+                    "served": self.lane_served[priority],
+                    "total_wait_time": self.lane_wait_time[priority],
+                    "average_wait_time": self.lane_wait_time[priority] / self.lane_served[priority] if self.lane_served[priority] else 0.0,
+                    "max_wait_time": self.lane_max_wait_time[priority]
+                }
+                for priority in self.lanes
+            }
+
+    def _has_requests(self) -> bool:
+        """
+        Returns True if any lane has a job waiting. Must be called holding the requests lock
+        """
+        return any(self.lanes.values())
+
+    def _has_runnable_requests(self) -> bool:
+        """
+        Returns True if any lane has a job whose type is below its concurrency limit. Must be called holding the requests lock
+        """
+        return any(self._first_runnable(lane) is not None for lane in self.lanes.values())
+
+    def _can_run(self, job_type: str) -> bool:
+        """
+        Returns True if a job of the type can be handed to a worker. Must be called holding the requests lock
+        """
+        limit = self.concurrency_limits.get(job_type)
+        return limit is None or self.running_jobs[job_type] < limit
+
+    def _timed_out(self, job: Job) -> bool:
+        """
+        Returns True if the job waited in the queue longer than the timeout of its type
+        """
+        timeout = self.queue_timeouts.get(job.type)
+        return timeout is not None and (datetime.datetime.now() - job.request_time).total_seconds() > timeout
+
+    def _first_runnable(self, lane: deque) -> Optional[int]:
+        """
+        Returns the index of the first job of the lane that can be run, or None. Must be called holding the requests lock
+        """
+        for index, job in enumerate(lane):
+            if self._can_run(job.type):
+                return index
+        return None
+
+    def _account_served(self, job: Job):
+        """
+        Updates the counters of the lane of a job taken from the queue. Must be called holding the requests lock
+        """
+        job.start_time = datetime.datetime.now()
+        self.running_jobs[job.type] += 1
+        waited = (job.start_time - job.request_time).total_seconds()
+        self.lane_served[job.priority] += 1
+        self.lane_wait_time[job.priority] += waited
+        self.lane_max_wait_time[job.priority] = max(self.lane_max_wait_time[job.priority], waited)
+
+    def _take_jobs_of_type(self, job_type: str, max_n: int, batch: List[Job]):
+        """
+        Moves up to max_n jobs of the given type from the lanes to the batch. Must be called holding the requests lock
+        """
+        for priority, lane in self.lanes.items():
+            if max_n <= 0:
+                return
+            if not any(job.type == job_type for job in lane):
+                continue
+            # We rebuild the lane without the jobs we take
+            kept = deque()
+            for job in lane:
+                if max_n > 0 and job.type == job_type and self._can_run(job_type):
+                    if self._timed_out(job):
+                        self.timed_out_jobs[job.type] += 1
+                        continue
+                    self._account_served(job)
+                    batch.append(job)
+                    max_n -= 1
+                else:
+                    kept.append(job)
+            self.lanes[priority] = kept
+
+    def _pop_next_job(self) -> Optional[Job]:
+        """
+        Removes and returns the next job that can be run, or None.
+        The highest priority lane with both a runnable job and credits left is served; when no such lane exists,
+        a new round of the weighted round robin begins. Must be called holding the requests lock
+        """
+        for new_round in (False, True):
+            if new_round:
+                self.lane_credits = dict(self.lane_weights)
+            for priority, lane in self.lanes.items():
+                if self.lane_credits[priority] <= 0:
+                    continue
+                index = self._first_runnable(lane)
+                if index is None:
+                    continue
+                self.lane_credits[priority] -= 1
+                # The first job is almost always runnable, popleft keeps that case O(1)
+                if index == 0:
+                    return lane.popleft()
+                job = lane[index]
+                del lane[index]
+                return job
+        return None
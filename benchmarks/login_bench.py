@@ -0,0 +1,98 @@
+"""
+Login benchmark on a large user table.
+Many clients log in at once with Check_log_in: it measures the logins per second, which depend on the (Nick, IDN) key
+of the user table (see migrations/003), and checks that every login found its user.
+It runs on the in-process SQLite database by default, or on MySQL with --host (after Tables.sql, queries.sql and the migrations).
+On SQLite, --without-index measures the logins again without the key, as they were before.
+Run it from the root of the repository: python benchmarks/login_bench.py
+"""
+import sys
+import os
+import time
+import random
+import threading
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import serverPorts  # server and serverPorts import each other, serverPorts must be imported first
+from server import *
+from sqlite_backend import SQLiteBackend
+
+# The users inserted by a single statement
+INSERT_BATCH = 10000
+# The users sharing the same nick, with different tags
+TAGS_PER_NICK = 4
+
+
+def setup(dbms: DBMS, users: int) -> str:
+    """
+    Creates the users, and returns the prefix of their nicks
+    """
+    prefix = "bench{}_".format(int(time.time()))
+    for start in range(0, users, INSERT_BATCH):
+        with dbms.transaction() as transaction:
+            transaction.executemany(
+                "Insert into user(IDN, Nick, State, Photo, Comunication_key, User_password) values (%s, %s, 0, '', '', 'pw')",
+                [(i % TAGS_PER_NICK + 1, prefix + str(i // TAGS_PER_NICK)) for i in range(start, min(users, start + INSERT_BATCH))]
+            )
+    return prefix
+
+
+def bench(dbms: DBMS, prefix: str, users: int, clients: int, logins: int) -> Tuple[float, int]:
+    """
+    Runs the clients, and returns the logins per second and the number of logins that did not find their user
+    """
+    failed = []
+
+    def client(seed: int):
+        generator = random.Random(seed)
+        for _ in range(logins):
+            i = generator.randrange(users)
+            rows = dbms.execute("Check_log_in", (i % TAGS_PER_NICK + 1, prefix + str(i // TAGS_PER_NICK), "pw"), procedure=True)
+            if len(rows) != 1:
+                failed.append(i)
+
+    threads = [threading.Thread(target=client, args=(seed,), daemon=True) for seed in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return clients * logins / elapsed, len(failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Login benchmark on a large user table")
+    parser.add_argument("--users", type=int, default=1_000_000, help="users in the database")
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--logins", type=int, default=500, help="logins of each client")
+    parser.add_argument("--without-index", action="store_true", help="also measure the logins without the (Nick, IDN) key (SQLite only)")
+    parser.add_argument("--host", help="MySQL host (the in-process SQLite database is used if not given)")
+    parser.add_argument("--user", default="root", help="MySQL user")
+    parser.add_argument("--password", default="", help="MySQL password")
+    parser.add_argument("--database", default="ChitChat", help="MySQL database")
+    args = parser.parse_args()
+    if args.host and args.without_index:
+        parser.error("--without-index would drop a key of the MySQL database, it is only supported on SQLite")
+
+    backend = MySQLBackend() if args.host else SQLiteBackend()
+    dbms = DBMS({
+        "host": args.host,
+        "user": args.user,
+        "password": args.password,
+        "database": args.database,
+        "pool_size": args.clients
+    }, backend)
+    try:
+        prefix = setup(dbms, args.users)
+        runs = [("with the (Nick, IDN) key", bench(dbms, prefix, args.users, args.clients, args.logins))]
+        if args.without_index:
+            dbms.execute("Drop index Nick_IDN")
+            runs.append(("without the key", bench(dbms, prefix, args.users, args.clients, args.logins)))
+    finally:
+        backend.close()
+    print("Backend: {} - Users: {} - Clients: {} - Logins per client: {}".format(
+        "MySQL" if args.host else "SQLite", args.users, args.clients, args.logins
+    ))
+    for name, (throughput, failed) in runs:
+        print("{:<25} {:>10.1f} logins/s{}".format(name, throughput, " - {} logins failed".format(failed) if failed else ""))
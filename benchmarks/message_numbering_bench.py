@@ -0,0 +1,102 @@
+"""
+Concurrency benchmark of create_message on a hot chat.
+Many senders write in the same chat at once: it measures the messages per second, and checks that the messages
+got distinct and contiguous numbers, and that every sender got the id of its own message.
+It runs on the in-process SQLite database by default, or on MySQL with --host (after Tables.sql, queries.sql and the migrations).
+Run it from the root of the repository: python benchmarks/message_numbering_bench.py
+"""
+import sys
+import os
+import time
+import threading
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import serverPorts  # server and serverPorts import each other, serverPorts must be imported first
+from server import *
+from sqlite_backend import SQLiteBackend
+
+
+def setup(dbms: DBMS, senders: int) -> Tuple[int, List[int]]:
+    """
+    Creates the senders and the chat they all write in. Returns the chat id and the ids of the senders
+    """
+    run = int(time.time())
+    user_ids = [
+        dbms.execute("Select create_user(%s, 0, '', 'pw')", ("bench{}_{}".format(run, i),))[0][0]
+        for i in range(senders)
+    ]
+    chat_id = dbms.execute("Select create_chat('hot chat', '', %s, '')", (user_ids[0],))[0][0]
+    with dbms.transaction() as transaction:
+        transaction.executemany(
+            "Insert into participate(Id_user, Id_chat, Last_message_id) values (%s, %s, 0)",
+            [(user_id, chat_id) for user_id in user_ids]
+        )
+    return chat_id, user_ids
+
+
+def bench(dbms: DBMS, senders: int, messages: int) -> Tuple[float, List[str]]:
+    """
+    Runs the senders, and returns the messages per second and the anomalies found
+    """
+    chat_id, user_ids = setup(dbms, senders)
+    sent = []
+    sent_lock = threading.Lock()
+    errors = []
+
+    def sender(user_id: int):
+        for i in range(messages):
+            try:
+                message_id = dbms.execute(
+                    "Select create_message(%(sender_id)s, %(chat_id)s, %(message)s)",
+                    {"sender_id": user_id, "chat_id": chat_id, "message": "message {}".format(i).encode()}
+                )[0][0]
+            except Exception as err:
+                errors.append(str(err))
+                continue
+            with sent_lock:
+                sent.append((message_id, user_id))
+
+    threads = [threading.Thread(target=sender, args=(user_id,), daemon=True) for user_id in user_ids]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Every message must be there once, numbered from 1 without gaps, with the id its sender was given
+    rows = dbms.execute("Select ID, Id_sender, Message_number from message where Id_chat = %s", (chat_id,))
+    anomalies = ["{} sends failed (e.g. {})".format(len(errors), errors[0])] if errors else []
+    numbers = sorted(row[2] for row in rows)
+    if numbers != list(range(1, len(rows) + 1)):
+        anomalies.append("message numbers are duplicated or missing")
+    if sorted(sent) != sorted((row[0], row[1]) for row in rows):
+        anomalies.append("some senders got the id of another message")
+    return len(sent) / elapsed, anomalies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="create_message concurrency benchmark on a hot chat")
+    parser.add_argument("--senders", type=int, default=16, help="number of concurrent senders in the chat")
+    parser.add_argument("--messages", type=int, default=200, help="messages sent by each sender")
+    parser.add_argument("--host", help="MySQL host (the in-process SQLite database is used if not given)")
+    parser.add_argument("--user", default="root", help="MySQL user")
+    parser.add_argument("--password", default="", help="MySQL password")
+    parser.add_argument("--database", default="ChitChat", help="MySQL database")
+    args = parser.parse_args()
+
+    backend = MySQLBackend() if args.host else SQLiteBackend()
+    dbms = DBMS({
+        "host": args.host,
+        "user": args.user,
+        "password": args.password,
+        "database": args.database,
+        "pool_size": args.senders
+    }, backend)
+    try:
+        throughput, anomalies = bench(dbms, args.senders, args.messages)
+    finally:
+        backend.close()
+    print("Backend: {} - Senders: {} - Messages per sender: {}".format("MySQL" if args.host else "SQLite", args.senders, args.messages))
+    print("Throughput: {:>10.1f} messages/s".format(throughput))
+    print("Numbering : {}".format("; ".join(anomalies) if anomalies else "ok (distinct, contiguous, ids returned to their senders)"))
@@ -0,0 +1,85 @@
+"""
+Benchmark of the job dispatch of the TaggedQueue.
+It measures how many jobs per second a pool of workers can drain from the queue,
+comparing the old dispatch (list.pop(0) + sleep after every poll) with the blocking one.
+Run it from the root of the repository: python benchmarks/queue_bench.py
+"""
+import sys
+import os
+import time
+import threading
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from TaggedQueue import *
+
+OLD_WORKER_THREAD_QUEUE_CHECK_DELAY = 0.05  # The delay used by the workers before the blocking dispatch (in seconds)
+
+
+class ListQueue():
+    """
+    The request queue as it was before the blocking dispatch: a list polled by the workers
+    """
+
+    def __init__(self):
+        self.request_queue = []
+
+    def put_request(self, job: Job):
+        self.request_queue.append(job)
+
+    def next(self):
+        if len(self.request_queue) == 0:
+            return None
+        return self.request_queue.pop(0)
+
+
+def _run(queue: Any, jobs: int, workers: int, get_job: Callable, after_poll: Callable) -> float:
+    """
+    Puts the jobs in the queue, drains it with the given number of workers and returns the jobs per second
+    """
+    done = []
+    done_lock = threading.Lock()
+    finished = threading.Event()
+
+    def worker():
+        while not finished.is_set():
+            job = get_job(queue)
+            if job:
+                with done_lock:
+                    done.append(job)
+                    if len(done) == jobs:
+                        finished.set()
+            after_poll()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    for i in range(jobs):
+        queue.put_request(Job("bench", {"i": i}))
+    finished.wait()
+    elapsed = time.perf_counter() - start
+    for thread in threads:
+        thread.join()
+    return jobs / elapsed
+
+
+def bench_old(jobs: int, workers: int) -> float:
+    return _run(ListQueue(), jobs, workers, lambda q: q.next(), lambda: time.sleep(OLD_WORKER_THREAD_QUEUE_CHECK_DELAY))
+
+
+def bench_new(jobs: int, workers: int) -> float:
+    return _run(TaggedQueue(), jobs, workers, lambda q: q.next(0.05), lambda: None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TaggedQueue dispatch benchmark")
+    parser.add_argument("--jobs", type=int, default=2000, help="number of jobs to drain")
+    parser.add_argument("--workers", type=int, default=10, help="number of worker threads")
+    args = parser.parse_args()
+
+    old = bench_old(args.jobs, args.workers)
+    new = bench_new(args.jobs, args.workers)
+    print("Workers: {} - Jobs: {}".format(args.workers, args.jobs))
+    print("list + sleep polling : {:>12.1f} jobs/s".format(old))
+    print("deque + blocking next: {:>12.1f} jobs/s".format(new))
+    print("Speedup              : {:>12.1f}x".format(new / old))
@@ -0,0 +1,114 @@
+"""
+End to end benchmark of the server, on the in-process SQLite database (see sqlite_backend.py).
+The clients are simulated by threads calling the server like the ClientHandlers do: every client sends messages
+to its chats and reads its unread ones, while the worker threads resolve the jobs against the database.
+Run it from the root of the repository: python benchmarks/server_bench.py
+"""
+import sys
+import os
+import time
+import threading
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+import serverPorts  # server and serverPorts import each other, serverPorts must be imported first
+from server import *
+from sqlite_backend import SQLiteBackend
+from conftest import build_server, stop_server  # The servers without sockets of the tests
+
+
+def start_server(backend: DBMSBackend, workers: int, inbox_max_chat_size: int = INBOX_MAX_CHAT_SIZE) -> Server:
+    """
+    Starts the queue, the DBMS and the worker threads of a server, without its sockets
+    """
+    server = build_server(DBMS({"pool_size": workers + 2}, backend), workers, start_workers = True)
+    server.inbox_max_chat_size = inbox_max_chat_size
+    return server
+
+
+def call(server: Server, job_tag: int) -> Any:
+    response = server.queue.wait_for_result(job_tag, timeout=60)
+    return response.result if response else None
+
+
+def setup(server: Server, clients: int, chat_size: int) -> List[Tuple[int, List[int]]]:
+    """
+    Registers the users, and puts them in chats of chat_size users. Returns (user id, chat ids) of every user
+    """
+    users = []
+    for i in range(clients):
+        user_id = call(server, server.register("user{}".format(i), "pw", b"key"))[0][0]
+        users.append((user_id, []))
+    for start in range(0, clients, chat_size):
+        group = users[start:start + chat_size]
+        creator = User(group[0][0], "user{}".format(start), "1", "pw", b"key")
+        partecipants = [("user{}".format(start + i), 1) for i in range(1, len(group))]
+        chat = call(server, server.create_chat(creator, "chat{}".format(start), "", partecipants))
+        for _, chats in group:
+            chats.append(chat["chat_id"])
+    return users
+
+
+def bench(clients: int, workers: int, rounds: int, chat_size: int, inbox_max_chat_size: int = INBOX_MAX_CHAT_SIZE) -> Tuple[float, dict, dict]:
+    """
+    Runs the clients, and returns the requests per second, the latency of every job type and the timings of every statement
+    """
+    backend = SQLiteBackend()
+    server = start_server(backend, workers, inbox_max_chat_size)
+    try:
+        users = setup(server, clients, chat_size)
+        requests = []
+        requests_lock = threading.Lock()
+
+        def client(user_id: int, chats: List[int]):
+            done = 0
+            for i in range(rounds):
+                for chat_id in chats:
+                    call(server, server.send_message(user_id, chat_id, "message {}".format(i).encode()))
+                    done += 1
+                # The ClientHandler reads the unread messages one page at a time
+                after = None
+                while True:
+                    page = call(server, server.get_unread_messages(user_id, after=after))
+                    done += 1
+                    if not page or not page["more"]:
+                        break
+                    after = page["cursor"]
+            with requests_lock:
+                requests.append(done)
+
+        threads = [threading.Thread(target=client, args=user, daemon=True) for user in users]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return sum(requests) / elapsed, server.queue.latency_stats(), server.dbms.statement_stats()
+    finally:
+        stop_server(server)
+        backend.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End to end server benchmark on SQLite")
+    parser.add_argument("--clients", type=int, default=20, help="number of simulated clients")
+    parser.add_argument("--workers", type=int, default=10, help="number of worker threads")
+    parser.add_argument("--rounds", type=int, default=20, help="messages sent by each client to each of its chats")
+    parser.add_argument("--chat-size", type=int, default=5, help="number of users in each chat")
+    parser.add_argument("--inbox-max-chat-size", type=int, default=INBOX_MAX_CHAT_SIZE,
+                        help="chats up to this size deliver through inboxes (fan-out on write), 0 to always read the chats (fan-out on read)")
+    args = parser.parse_args()
+
+    throughput, latencies, statements = bench(args.clients, args.workers, args.rounds, args.chat_size, args.inbox_max_chat_size)
+    print("Clients: {} - Workers: {} - Rounds: {} - Chat size: {} - Fan-out on {}".format(
+        args.clients, args.workers, args.rounds, args.chat_size, "write" if args.chat_size <= args.inbox_max_chat_size else "read"
+    ))
+    print("Throughput: {:>10.1f} requests/s".format(throughput))
+    for job_type in ("send_message", "get_unread_messages"):
+        stats = latencies.get(job_type)
+        if stats:
+            print("{:<20} p50 {:>8.2f} ms - p99 {:>8.2f} ms".format(job_type, stats["end_to_end"]["p50"] * 1000, stats["end_to_end"]["p99"] * 1000))
+    print("Slowest statements (total time):")
+    for name, stats in sorted(statements.items(), key=lambda item: -item[1]["total"]["average"])[:5]:
+        print("  {:>8.2f} ms avg - {:>6} calls - {}".format(stats["total"]["average"] * 1000, stats["total"]["count"], name[:80]))
@@ -0,0 +1,128 @@
+"""
+Benchmark of the unread messages query, before and after the range scans of migrations/002.
+It fills a SQLite database (the schema of sqlite_backend.py) with a long history, then compares the query plans and
+the latency of a poll of the unread messages of a user:
+- before: the messages of every chat of the user are joined, and filtered on their number, with a key on Id_chat only
+- after: the chats with unread messages are found with their counter, then their messages are read from the
+  (Id_chat, Message_number) key, between the last message read and the counter
+Most polls find nothing to read, so both an empty poll and a poll with a few unread messages are measured.
+Run it from the root of the repository: python benchmarks/unread_bench.py (10M messages take a few minutes to generate)
+"""
+import sys
+import os
+import time
+import sqlite3
+import tempfile
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sqlite_backend import SCHEMA
+from typing import *
+
+# The query of Messages_not_received before migrations/002
+BEFORE = (
+    "SELECT p.Id_chat, m.Message_number, u.Nick, u.IDN, m.Timestamp, m.Body "
+    "FROM message m INDEXED BY message_chat, participate p, user u "
+    "WHERE u.ID = m.Id_sender AND p.Id_user = ? AND p.Id_chat = m.Id_chat AND m.Message_number > p.Last_message_id"
+)
+# The query of Messages_not_received after migrations/002
+AFTER = (
+    "SELECT p.Id_chat, m.Message_number, u.Nick, u.IDN, m.Timestamp, m.Body "
+    "FROM participate p "
+    "JOIN chat c ON c.ID = p.Id_chat AND c.Message_counter > p.Last_message_id "
+    "JOIN message m INDEXED BY Chat_message_number ON m.Id_chat = p.Id_chat "
+    "AND m.Message_number BETWEEN p.Last_message_id + 1 AND c.Message_counter "
+    "JOIN user u ON u.ID = m.Id_sender "
+    "WHERE p.Id_user = ? "
+    "ORDER BY p.Id_chat, m.Message_number"
+)
+
+
+def setup(db: sqlite3.Connection, messages: int, chats: int, users: int, chats_per_user: int):
+    """
+    Creates the users (from ID 2, after the deleted user), the chats and the messages. Every user has read every message
+    """
+    db.executescript(SCHEMA)
+    # The key on Id_chat of Tables.sql before migrations/001, for the plan before
+    db.execute("CREATE INDEX message_chat ON message (Id_chat)")
+    db.execute(
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+        "INSERT INTO user (ID, IDN, Nick, State, Photo, Comunication_key, User_password) SELECT i + 1, 1, 'user' || i, 0, '', '', 'pw' FROM n",
+        (users,)
+    )
+    per_chat = messages // chats
+    db.execute(
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+        "INSERT INTO chat (ID, Name, Photo, Description, Creation_date, Founder_id, Message_counter) "
+        "SELECT i, 'chat' || i, '', '', date('now'), 2, ? FROM n",
+        (chats, per_chat)
+    )
+    db.execute(
+        "WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ? - 1) "
+        "INSERT INTO message (Id_chat, Id_sender, Body, Timestamp, Message_number) "
+        "SELECT i / ? + 1, i % ? + 2, 'message', datetime('now'), i % ? + 1 FROM n",
+        (per_chat * chats, per_chat, users, per_chat)
+    )
+    db.execute(
+        "WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ? - 1) "
+        "INSERT OR IGNORE INTO participate (Id_user, Id_chat, Last_message_id) "
+        "SELECT i / ? + 2, (i / ? + i % ? * ?) % ? + 1, ? FROM n",
+        (users * chats_per_user, chats_per_user, chats_per_user, chats_per_user, max(1, chats // chats_per_user), chats, per_chat)
+    )
+    db.commit()
+    db.execute("ANALYZE")
+
+
+def plan(db: sqlite3.Connection, query: str) -> List[str]:
+    return [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + query, (2,))]
+
+
+def poll(db: sqlite3.Connection, query: str, user_id: int, repeat: int) -> Tuple[float, int]:
+    """
+    Runs the query repeat times, and returns its average latency and the number of messages found
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rows = db.execute(query, (user_id,)).fetchall()
+    return (time.perf_counter() - start) / repeat, len(rows)
+
+
+def bench(messages: int, chats: int, users: int, chats_per_user: int, repeat: int) -> Dict[str, dict]:
+    """
+    Fills the database, and returns the plan and the poll latencies of both queries
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        db = sqlite3.connect(os.path.join(directory, "unread.db"))
+        try:
+            setup(db, messages, chats, users, chats_per_user)
+            first_chat = db.execute("SELECT min(Id_chat) FROM participate WHERE Id_user = 2").fetchone()[0]
+            results = {}
+            for name, query in (("before", BEFORE), ("after", AFTER)):
+                # A poll with nothing to read, then one with the last message of the first chat unread
+                db.execute("UPDATE participate SET Last_message_id = ? WHERE Id_user = 2", (messages // chats,))
+                empty = poll(db, query, 2, repeat)
+                db.execute("UPDATE participate SET Last_message_id = Last_message_id - 5 WHERE Id_user = 2 AND Id_chat = ?", (first_chat,))
+                unread = poll(db, query, 2, repeat)
+                results[name] = {"plan": plan(db, query), "empty": empty, "unread": unread}
+            return results
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Unread messages query benchmark on SQLite")
+    parser.add_argument("--messages", type=int, default=10_000_000, help="messages in the database")
+    parser.add_argument("--chats", type=int, default=10_000, help="chats in the database")
+    parser.add_argument("--users", type=int, default=20_000, help="users in the database")
+    parser.add_argument("--chats-per-user", type=int, default=20, help="chats every user is in")
+    parser.add_argument("--repeat", type=int, default=20, help="polls measured for each query")
+    args = parser.parse_args()
+
+    results = bench(args.messages, args.chats, args.users, args.chats_per_user, args.repeat)
+    print("Messages: {} - Chats: {} - Users: {} - Chats per user: {}".format(args.messages, args.chats, args.users, args.chats_per_user))
+    for name, result in results.items():
+        print("{}:".format(name.capitalize()))
+        for line in result["plan"]:
+            print("  plan: {}".format(line))
+        for poll_type in ("empty", "unread"):
+            latency, found = result[poll_type]
+            print("  {:<6} poll {:>10.3f} ms - {} messages".format(poll_type, latency * 1000, found))
@@ -0,0 +1,90 @@
+"""
+The database engines the DBMS class can run on.
+The DBMS class only handles the pool, the prepared statements and the transactions:
+opening the connections is left to a backend, so that the server can run on something else than MySQL
+(see sqlite_backend.py for an in-process stand-in, used by the tests and the benchmarks).
+"""
+import mysql.connector          # For the database connection
+from mysql.connector import errorcode  # For the codes of the errors of the statements
+from abc import ABC, abstractmethod  # For the interface of the backends
+from typing import *            # For the type hints
+
+
+class DBMSBackend(ABC):
+    """
+    The DBMSBackend class is the interface of a database engine.
+    The connections it opens must behave like the ones of mysql.connector: cursor(buffered, prepared), commit,
+    rollback, is_connected and close. Their cursors must support execute and executemany (with %s and %(name)s
+    placeholders), callproc and stored_results (for the procedures of queries.sql), fetchall, description and close.
+    """
+    # The errors raised when a connection cannot be opened (they trip the circuit breaker of the pool)
+    connection_errors: Tuple[type, ...] = ()
+
+    @abstractmethod
+    def connect(self, config: dict) -> Any:
+        """
+        Opens a new connection to the database described by the configuration of the DBMS
+        """
+
+    def begin(self, connection: Any, read_only: bool):
+        """
+        Called when a transaction of several statements starts on a connection, before its first statement.
+        The engines starting their transactions implicitly (like MySQL) have nothing to do
+        """
+        pass
+
+    def replication_lag(self, connection: Any) -> Optional[float]:
+        """
+        Returns how far behind its primary is the replica the connection is open on (in seconds),
+        or None if it is not known (or the database is not a replica)
+        """
+        return None
+
+    def is_conflict(self, error: Exception) -> bool:
+        """
+        Returns True if the error means that the statement conflicted with a concurrent transaction
+        (a duplicate key, a deadlock): running it again may succeed
+        """
+        return False
+
+    def close(self):
+        """
+        Frees the resources of the backend, once every connection is closed
+        """
+        pass
+
+
+class MySQLBackend(DBMSBackend):
+    """
+    The MySQLBackend class connects to the MySQL (or MariaDB) server holding the tables of Tables.sql
+    and the procedures of queries.sql
+    """
+    connection_errors = (mysql.connector.Error,)
+
+    def connect(self, config: dict) -> Any:
+        return mysql.connector.connect(
+            host=config["host"],
+            user=config["user"],
+            password=config["password"],
+            database=config["database"]
+        )
+
+    def replication_lag(self, connection: Any) -> Optional[float]:
+        cursor = connection.cursor(dictionary=True, buffered=True)
+        try:
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except mysql.connector.Error:
+                # Before MySQL 8.0.22
+                cursor.execute("SHOW SLAVE STATUS")
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        if row is None:
+            return None
+        lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+        # It is NULL while the replication is stopped: the replica may be any far behind
+        return float("inf") if lag is None else float(lag)
+
+    def is_conflict(self, error: Exception) -> bool:
+        return isinstance(error, mysql.connector.Error) and error.errno in (errorcode.ER_DUP_ENTRY, errorcode.ER_LOCK_DEADLOCK)
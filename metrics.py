@@ -0,0 +1,71 @@
+"""
+The metrics.py file contains the tools used by the server to measure itself at runtime.
+"""
+import threading
+import bisect
+from typing import *
+
+# The upper bounds of the buckets of the latency histograms (in seconds). Anything slower goes in an overflow bucket
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram():
+    """
+    The Histogram class counts values in fixed buckets, so that recording is O(log buckets) and memory is constant.
+    Percentiles are approximated by the upper bound of the bucket they fall in.
+    It is designed to be used by multiple threads, so it is thread-safe.
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        """
+        The constructor of the Histogram class
+        """
+        self.buckets = tuple(buckets)
+        # One counter per bucket, plus the overflow bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, value: float):
+        """
+        Adds a value to the histogram
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> float:
+        """
+        Returns the upper bound of the bucket containing the p-th percentile (0 < p <= 100), or 0 if nothing was recorded.
+        For the overflow bucket, the maximum recorded value is returned
+        """
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            rank = p / 100 * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank and count:
+                    return self.buckets[index] if index < len(self.buckets) else self.max
+            return self.max
+
+    def snapshot(self) -> dict:
+        """
+        Returns the counters and the main percentiles of the histogram
+        """
+        with self.lock:
+            count, total, maximum = self.count, self.sum, self.max
+        return {
+            "count": count,
+            "average": total / count if count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": maximum
+        }
@@ -0,0 +1,50 @@
+-- Atomic message numbering
+-- Upgrades a database created with a previous version of Tables.sql and queries.sql (new databases already have it):
+-- the messages of a chat are numbered without races, and the ids of the new chats and messages are not read with MAX(ID).
+--
+-- The unique key can't be added if some messages already share a number in a chat. They can be found with:
+-- SELECT Id_chat, Message_number, COUNT(*) FROM message GROUP BY Id_chat, Message_number HAVING COUNT(*) > 1;
+
+-- The unique key also serves the lookups by chat
+ALTER TABLE `message`
+  ADD UNIQUE KEY `Chat_message_number` (`Id_chat`,`Message_number`),
+  DROP KEY `Id_chat`;
+
+DELIMITER $$
+DROP FUNCTION IF EXISTS `Create_chat`$$
+CREATE DEFINER=`root`@`localhost` FUNCTION `Create_chat` (`Chat_name` CHAR(32), `Chat_description` CHAR(255), `Chat_founder` INT(11), `Chat_photo` CHAR(32)) RETURNS INT(11) BEGIN
+INSERT INTO chat(Name,Description,Founder_id,Creation_date,Photo,Message_counter)
+VALUES(Chat_name,Chat_description,Chat_founder,CURRENT_DATE(),Chat_photo,0);
+-- The id of the chat inserted by this connection (MAX(ID) could be the chat of another one)
+RETURN LAST_INSERT_ID();
+END$$
+
+DROP FUNCTION IF EXISTS `create_message`$$
+CREATE DEFINER=`root`@`localhost` FUNCTION `create_message` (`sender_id` INT(11), `chat_id` INT(11), `body` BLOB) RETURNS INT(11) BEGIN
+
+DECLARE counter int;
+DECLARE x int DEFAULT 0;
+SELECT COUNT(*) FROM participate
+WHERE participate.Id_user = sender_id AND participate.Id_chat = chat_id INTO x;
+
+IF(x is null OR x = 0)
+THEN 
+RETURN null;
+END IF;
+
+-- The counter is incremented and read in a single statement: the row lock it takes makes the other senders
+-- of the chat wait until this message is committed, so that no two messages get the same number
+UPDATE chat
+SET chat.Message_counter = LAST_INSERT_ID(chat.Message_counter + 1)
+WHERE chat.ID = Chat_id;
+
+SET counter = LAST_INSERT_ID();
+
+INSERT INTO message(Id_chat,Id_sender,Body,Timestamp,Message_number)
+VALUES(Chat_id,Sender_id,Body,now(),counter);
+
+-- The id of the message inserted by this connection (MAX(ID) could be the message of another one, and scans the index)
+RETURN LAST_INSERT_ID();
+END$$
+
+DELIMITER ;
@@ -0,0 +1,22 @@
+-- Range scans for the unread messages
+-- Upgrades a database created with a previous version of queries.sql (new databases already have it), after 001.
+-- The unread messages are read from the (Id_chat, Message_number) key added by 001, between the last message read
+-- and the counter of the chat, instead of scanning the whole history of every chat of the user.
+--
+-- No index is added on participate(Id_user, Id_chat, Last_message_id): the primary key (Id_user, Id_chat) is the clustered
+-- index of InnoDB, so its rows already hold Last_message_id, and such an index would be written at every message read.
+
+DELIMITER $$
+DROP PROCEDURE IF EXISTS `Messages_not_received`$$
+CREATE DEFINER=`root`@`localhost` PROCEDURE `Messages_not_received` (IN `User_id` INT(11))  
+-- The chats with unread messages are found with their counter (the number of their last message), without reading the messages,
+-- then the unread messages of each chat are read from the (Id_chat, Message_number) key, between both numbers
+SELECT p.Id_chat,m.Message_number,u.Nick,u.IDN,m.Timestamp,m.Body
+FROM participate p
+JOIN chat c ON c.ID = p.Id_chat AND c.Message_counter > p.Last_message_id
+JOIN message m ON m.Id_chat = p.Id_chat AND m.Message_number BETWEEN p.Last_message_id + 1 AND c.Message_counter
+JOIN user u ON u.ID = m.Id_sender
+WHERE p.Id_user = User_id
+ORDER BY p.Id_chat, m.Message_number$$
+
+DELIMITER ;
@@ -0,0 +1,42 @@
+-- Indexed login and user lookups
+-- Upgrades a database created with a previous version of Tables.sql and queries.sql (new databases already have it), after 002.
+-- The logins, the lookups of a user by nick and tag, and the tag of a new user were full scans of the user table:
+-- they now read the unique (Nick, IDN) key. Running it takes a while on a large user table.
+-- Create_user is redefined to return the id of the user it inserted.
+--
+-- The unique key can't be added if some users already share a nick and a tag. They can be found with:
+-- SELECT Nick, IDN, COUNT(*) FROM user GROUP BY Nick, IDN HAVING COUNT(*) > 1;
+
+ALTER TABLE `user`
+  ADD UNIQUE KEY `Nick_IDN` (`Nick`,`IDN`);
+
+DELIMITER $$
+DROP FUNCTION IF EXISTS `Create_user`$$
+CREATE DEFINER=`root`@`localhost` FUNCTION `Create_user` (`Nick_` CHAR(32), `State_` INT(1), `Comunication_key_` BLOB, `User_password_` CHAR(32)) RETURNS INT(11) BEGIN
+
+DECLARE x int DEFAULT 0;
+
+-- The last tag of the nick is a single lookup on the (Nick, IDN) key. Two users registering the same nick at the
+-- same time may read the same tag: the unique key refuses the second insert, and the server tries again (see Server._register)
+SELECT max(IDN)
+FROM user
+WHERE Nick = Nick_ INTO x;
+
+if (x is null) THEN
+SET x = 0;
+END if;
+
+IF(x < 9999) THEN
+
+INSERT INTO user(IDN,Nick,State,Last_log_in,Comunication_key,User_password)
+VALUES(x+1,Nick_,State_,CURRENT_TIME(),Comunication_key_,User_password_);
+-- The id of the user inserted by this connection (MAX(ID) could be the user of another one)
+RETURN LAST_INSERT_ID();
+
+ELSE
+RETURN 0;
+END IF;
+
+END$$
+
+DELIMITER ;
@@ -0,0 +1,75 @@
+-- Archive of the old messages
+-- Upgrades a database created with a previous version of Tables.sql and queries.sql (new databases already have it), after 003.
+-- The old messages every partecipant read are moved from message to message_archive by the server
+-- (see Server._archive_messages), so that the message table and its indexes only hold the recent ones.
+-- The messages 1 to chat.Archived_number of a chat are archived, the following ones are in message.
+--
+-- The message table itself is not partitioned: MySQL requires every unique key of a partitioned table to contain
+-- the partitioning columns, and the (Id_chat, Message_number) key of 001 would have to include the time.
+
+ALTER TABLE `chat`
+  ADD `Archived_number` int(11) NOT NULL DEFAULT 0;
+
+CREATE TABLE `message_archive` (
+  `ID` int(11) NOT NULL,
+  `Id_chat` int(11) NOT NULL,
+  `Id_sender` int(11) NOT NULL,
+  `Body` blob NOT NULL,
+  `Timestamp` datetime NOT NULL,
+  `Message_number` int(11) NOT NULL,
+  PRIMARY KEY (`Id_chat`,`Message_number`),
+  KEY `Archive_sender_id` (`Id_sender`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 ROW_FORMAT=COMPRESSED;
+
+DELIMITER $$
+DROP TRIGGER IF EXISTS `Clean_up_user`$$
+CREATE TRIGGER `Clean_up_user` AFTER DELETE ON `user` FOR EACH ROW BEGIN
+DELETE FROM participate
+WHERE participate.Id_user = old.ID;
+
+UPDATE message
+SET message.Id_sender = 1
+WHERE message.Id_sender = old.ID;
+
+UPDATE message_archive
+SET message_archive.Id_sender = 1
+WHERE message_archive.Id_sender = old.ID;
+END$$
+
+DROP PROCEDURE IF EXISTS `Delete_chat`$$
+CREATE DEFINER=`root`@`localhost` PROCEDURE `Delete_chat`(IN `Chat_id` INT(11))
+BEGIN
+DELETE FROM chat
+WHERE chat.ID = Chat_id;
+
+DELETE FROM message
+WHERE message.Id_chat = Chat_id;
+
+DELETE FROM message_archive
+WHERE message_archive.Id_chat = Chat_id;
+
+DELETE FROM participate
+WHERE participate.Id_chat = Chat_id;
+END$$
+
+DROP PROCEDURE IF EXISTS `Messages_not_received`$$
+CREATE DEFINER=`root`@`localhost` PROCEDURE `Messages_not_received` (IN `User_id` INT(11))  
+-- The chats with unread messages are found with their counter (the number of their last message), without reading the messages,
+-- then the unread messages of each chat are read from the (Id_chat, Message_number) key, between both numbers
+SELECT p.Id_chat,m.Message_number,u.Nick,u.IDN,m.Timestamp,m.Body
+FROM participate p
+JOIN chat c ON c.ID = p.Id_chat AND c.Message_counter > p.Last_message_id
+JOIN message m ON m.Id_chat = p.Id_chat AND m.Message_number BETWEEN p.Last_message_id + 1 AND c.Message_counter
+JOIN user u ON u.ID = m.Id_sender
+WHERE p.Id_user = User_id
+UNION ALL
+-- Only the messages read by every partecipant are archived: a partecipant added later can still have some to read
+SELECT p.Id_chat,a.Message_number,u.Nick,u.IDN,a.Timestamp,a.Body
+FROM participate p
+JOIN chat c ON c.ID = p.Id_chat AND c.Archived_number > p.Last_message_id
+JOIN message_archive a ON a.Id_chat = p.Id_chat AND a.Message_number BETWEEN p.Last_message_id + 1 AND c.Archived_number
+JOIN user u ON u.ID = a.Id_sender
+WHERE p.Id_user = User_id
+ORDER BY 1, 2$$
+
+DELIMITER ;
@@ -0,0 +1,74 @@
+-- Inboxes of the small chats
+-- Upgrades a database created with a previous version of Tables.sql and queries.sql (new databases already have it), after 004.
+-- The partecipants of the chats created with up to inboxmaxchatsize partecipants (see Server) get a row in the inbox table
+-- for every new message (fan-out on write), and read their unread messages from it; the other ones still find them
+-- from the counters of their chats (fan-out on read). The existing chats keep reading from the counters.
+
+ALTER TABLE `participate`
+  ADD `Inbox` tinyint(1) NOT NULL DEFAULT 0;
+
+CREATE TABLE `inbox` (
+  `Id_user` int(11) NOT NULL,
+  `Id_chat` int(11) NOT NULL,
+  `Message_number` int(11) NOT NULL,
+  PRIMARY KEY (`Id_user`,`Id_chat`,`Message_number`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+DELIMITER $$
+DROP TRIGGER IF EXISTS `Clean_up_chat`$$
+CREATE TRIGGER `Clean_up_chat` AFTER DELETE ON `participate` FOR EACH ROW BEGIN
+
+DECLARE x int DEFAULT 0;
+
+DELETE FROM inbox
+WHERE inbox.Id_user = old.Id_user AND inbox.Id_chat = old.Id_chat;
+
+SELECT COUNT(*) FROM participate
+WHERE old.Id_chat = participate.Id_chat INTO x;
+
+IF(x = 0 or x is null)
+THEN
+DELETE FROM chat
+WHERE old.Id_chat = chat.ID;
+END IF;
+
+END$$
+
+DROP FUNCTION IF EXISTS `create_message`$$
+CREATE DEFINER=`root`@`localhost` FUNCTION `create_message` (`sender_id` INT(11), `chat_id` INT(11), `body` BLOB) RETURNS INT(11) BEGIN
+
+DECLARE counter int;
+DECLARE message_id int;
+DECLARE x int DEFAULT 0;
+SELECT COUNT(*) FROM participate
+WHERE participate.Id_user = sender_id AND participate.Id_chat = chat_id INTO x;
+
+IF(x is null OR x = 0)
+THEN 
+RETURN null;
+END IF;
+
+-- The counter is incremented and read in a single statement: the row lock it takes makes the other senders
+-- of the chat wait until this message is committed, so that no two messages get the same number
+UPDATE chat
+SET chat.Message_counter = LAST_INSERT_ID(chat.Message_counter + 1)
+WHERE chat.ID = Chat_id;
+
+SET counter = LAST_INSERT_ID();
+
+INSERT INTO message(Id_chat,Id_sender,Body,Timestamp,Message_number)
+VALUES(Chat_id,Sender_id,Body,now(),counter);
+
+-- The id of the message inserted by this connection (MAX(ID) could be the message of another one, and scans the index)
+SET message_id = LAST_INSERT_ID();
+
+-- The partecipants of the small chats get the message in their inbox (fan-out on write),
+-- the other ones find it from the counter of the chat (fan-out on read)
+INSERT INTO inbox(Id_user,Id_chat,Message_number)
+SELECT participate.Id_user, participate.Id_chat, counter FROM participate
+WHERE participate.Id_chat = chat_id AND participate.Inbox = 1;
+
+RETURN message_id;
+END$$
+
+DELIMITER ;
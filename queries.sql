@@ -53,6 +53,9 @@ WHERE chat.ID = Chat_id;
 DELETE FROM message
 WHERE message.Id_chat = Chat_id;
 
+DELETE FROM message_archive
+WHERE message_archive.Id_chat = Chat_id;
+
 DELETE FROM participate
 WHERE participate.Id_chat = Chat_id;
 END$$
@@ -85,12 +88,23 @@ VALUES(Search_user_id(User_tag,User_nick),Chat_id);
 END$$
 
 CREATE DEFINER=`root`@`localhost` PROCEDURE `Messages_not_received` (IN `User_id` INT(11))  
+-- The chats with unread messages are found with their counter (the number of their last message), without reading the messages,
+-- then the unread messages of each chat are read from the (Id_chat, Message_number) key, between both numbers
 SELECT p.Id_chat,m.Message_number,u.Nick,u.IDN,m.Timestamp,m.Body
-FROM message m, participate p, user u
-WHERE 	u.ID = m.Id_sender
-AND	  	p.Id_user = User_id
-AND		p.Id_chat = m.Id_chat
-AND     m.Message_number > p.Last_message_id$$
+FROM participate p
+JOIN chat c ON c.ID = p.Id_chat AND c.Message_counter > p.Last_message_id
+JOIN message m ON m.Id_chat = p.Id_chat AND m.Message_number BETWEEN p.Last_message_id + 1 AND c.Message_counter
+JOIN user u ON u.ID = m.Id_sender
+WHERE p.Id_user = User_id
+UNION ALL
+-- Only the messages read by every partecipant are archived: a partecipant added later can still have some to read
+SELECT p.Id_chat,a.Message_number,u.Nick,u.IDN,a.Timestamp,a.Body
+FROM participate p
+JOIN chat c ON c.ID = p.Id_chat AND c.Archived_number > p.Last_message_id
+JOIN message_archive a ON a.Id_chat = p.Id_chat AND a.Message_number BETWEEN p.Last_message_id + 1 AND c.Archived_number
+JOIN user u ON u.ID = a.Id_sender
+WHERE p.Id_user = User_id
+ORDER BY 1, 2$$
 
 CREATE DEFINER=`root`@`localhost` PROCEDURE `Chat_of_a_user`(IN `User_id` INT(11))
 SELECT c.ID,c.Name
@@ -140,12 +154,14 @@ END$$
 CREATE DEFINER=`root`@`localhost` FUNCTION `Create_chat` (`Chat_name` CHAR(32), `Chat_description` CHAR(255), `Chat_founder` INT(11), `Chat_photo` CHAR(32)) RETURNS INT(11) BEGIN
 INSERT INTO chat(Name,Description,Founder_id,Creation_date,Photo,Message_counter)
 VALUES(Chat_name,Chat_description,Chat_founder,CURRENT_DATE(),Chat_photo,0);
-RETURN (SELECT MAX(ID) FROM chat);
+-- The id of the chat inserted by this connection (MAX(ID) could be the chat of another one)
+RETURN LAST_INSERT_ID();
 END$$
 
 CREATE DEFINER=`root`@`localhost` FUNCTION `create_message` (`sender_id` INT(11), `chat_id` INT(11), `body` BLOB) RETURNS INT(11) BEGIN
 
 DECLARE counter int;
+DECLARE message_id int;
 DECLARE x int DEFAULT 0;
 SELECT COUNT(*) FROM participate
 WHERE participate.Id_user = sender_id AND participate.Id_chat = chat_id INTO x;
@@ -155,24 +171,35 @@ THEN
 RETURN null;
 END IF;
 
-SELECT chat.Message_counter 
-FROM chat 
-WHERE chat.id = Chat_id INTO counter; 
-
+-- The counter is incremented and read in a single statement: the row lock it takes makes the other senders
+-- of the chat wait until this message is committed, so that no two messages get the same number
 UPDATE chat
-SET chat.Message_counter = chat.Message_counter + 1
+SET chat.Message_counter = LAST_INSERT_ID(chat.Message_counter + 1)
 WHERE chat.ID = Chat_id;
 
+SET counter = LAST_INSERT_ID();
+
 INSERT INTO message(Id_chat,Id_sender,Body,Timestamp,Message_number)
-VALUES(Chat_id,Sender_id,Body,now(),counter + 1);
+VALUES(Chat_id,Sender_id,Body,now(),counter);
+
+-- The id of the message inserted by this connection (MAX(ID) could be the message of another one, and scans the index)
+SET message_id = LAST_INSERT_ID();
+
+-- The partecipants of the small chats get the message in their inbox (fan-out on write),
+-- the other ones find it from the counter of the chat (fan-out on read)
+INSERT INTO inbox(Id_user,Id_chat,Message_number)
+SELECT participate.Id_user, participate.Id_chat, counter FROM participate
+WHERE participate.Id_chat = chat_id AND participate.Inbox = 1;
 
-RETURN (SELECT max(ID) FROM message);
+RETURN message_id;
 END$$
 
 CREATE DEFINER=`root`@`localhost` FUNCTION `Create_user` (`Nick_` CHAR(32), `State_` INT(1), `Comunication_key_` BLOB, `User_password_` CHAR(32)) RETURNS INT(11) BEGIN
 
 DECLARE x int DEFAULT 0;
 
+-- The last tag of the nick is a single lookup on the (Nick, IDN) key. Two users registering the same nick at the
+-- same time may read the same tag: the unique key refuses the second insert, and the server tries again (see Server._register)
 SELECT max(IDN)
 FROM user
 WHERE Nick = Nick_ INTO x;  
@@ -185,8 +212,8 @@ IF(x < 9999) THEN
 
 INSERT INTO user(IDN,Nick,State,Last_log_in,Comunication_key,User_password)
 VALUES(x+1,Nick_,State_,CURRENT_TIME(),Comunication_key_,User_password_);
-SELECT MAX(ID) FROM user into x;
-RETURN x;
+-- The id of the user inserted by this connection (MAX(ID) could be the user of another one)
+RETURN LAST_INSERT_ID();
 
 ELSE
 RETURN 0;
@@ -14,21 +14,49 @@ import random                   # For the random number generation
 import datetime                 # For easy date and time management
 import argparse                 # For the command line arguments
 import copy                     # For the deepcopy function
+import re                       # For the conversion of the queries to prepared statements
+import functools                # For the cache of the converted queries and the connection of the replicas
+import itertools                # For the round robin on the read replicas
 from identity import Identity   # For the Identity class (see identity.py)
-import mysql.connector          # For the database connection
+from dbms_backend import *      # For the database engines (see dbms_backend.py)
 from typing import *            # For the type hints
 from TaggedQueue import *       # For the TaggedQueue class (see TaggedQueue.py)
+from metrics import Histogram   # For the Histogram class (see metrics.py)
+from collections import deque, OrderedDict, Counter  # For the pool and the prepared statements cache
 from User import *              # For the User class (see User.py)
 from serverPorts import *       # For the server ports (see serverPorts.py)
 
 ### CONSTANTS ###
 # Note: for now the constants are arbitrary, but they will be changed later
-MAX_DB_CONNECTION_ATTEMPTS = 5              # The maximum number of attempts to connect to the database
-DB_CONNECTION_DELAY = 1                     # The delay between two attempts to connect to the database (in seconds)
-WORKER_THREAD_QUEUE_CHECK_DELAY = 0.05      # The delay between two checks of the queue (in seconds)
+DB_CIRCUIT_FAILURE_THRESHOLD = 3            # The number of consecutive failed connections after which the database is considered down
+DB_CIRCUIT_PROBE_INTERVAL = 1               # The delay between two attempts of the watchdog to reconnect to a database that is down (in seconds)
+WORKER_THREAD_QUEUE_WAIT_TIMEOUT = 0.5      # The maximum time a worker thread blocks on an empty queue before checking its signal (in seconds)
 WATCHDOG_CHECK_DELAY = 5                    # The delay between two checks of the watchdog (in seconds)
 QUEUE_RESPONSE_TIMEOUT = 15                 # The maximum time to wait for a response from the queue (in seconds)
 QUEUE_CHECK_DELAY = 0.01                    # The delay between two checks of the queue (in seconds)
+BATCH_MAX_JOBS = 200                        # The maximum number of same-type jobs merged into one statement
+BATCH_MAX_WAIT = 0.005                      # The maximum time a worker waits for a batch to fill (in seconds)
+DB_POOL_SIZE = 12                           # The default maximum number of connections kept open to the database
+DB_POOL_CHECKOUT_TIMEOUT = 10               # The maximum time to wait for a free connection of the pool (in seconds)
+DB_POOL_IDLE_TIMEOUT = 300                  # Connections unused for longer than this are closed (in seconds)
+DB_POOL_HEALTH_CHECK_INTERVAL = 30          # Connections unused for longer than this are checked before being used (in seconds)
+DB_STATEMENT_CACHE_SIZE = 64                # The maximum number of prepared statements kept by each connection
+MAX_CHATS_PER_QUERY = 200                   # The maximum number of chats retrieved by a single query
+UNREAD_PAGE_MAX_ROWS = 500                  # The maximum number of unread messages delivered in a page
+UNREAD_PAGE_MAX_BYTES = 256 * 1024          # The maximum size of the bodies of the unread messages delivered in a page (in bytes)
+INBOX_MAX_CHAT_SIZE = 32                    # The chats created with up to this many partecipants deliver their messages through inboxes (0 for never)
+HISTORY_PAGE_MAX_ROWS = 100                 # The maximum number of messages delivered in a page of the history of a chat
+MAX_MESSAGE_NUMBER = 2 ** 31 - 1            # The highest number a message can have (the INT columns of the database)
+MESSAGE_ARCHIVE_AGE = 30 * 24 * 3600        # The messages older than this, read by every partecipant, are moved to the archive (in seconds)
+MESSAGE_ARCHIVE_INTERVAL = 3600             # The delay between two archivals of the old messages (in seconds)
+MESSAGE_ARCHIVE_BATCH = 1000                # The maximum number of messages moved to the archive by a single transaction
+MESSAGE_ARCHIVE_MAX_BATCHES = 100           # The maximum number of transactions of an archival (the rest is left to the next one)
+REGISTER_MAX_ATTEMPTS = 3                   # The maximum number of times a registration conflicting with a concurrent one is tried
+DB_REPLICA_READ_YOUR_WRITES_WINDOW = 2      # After a write, the reads of the same session go to the primary for this long (in seconds)
+DB_REPLICA_LAG_CHECK_INTERVAL = 10          # The delay between two measures of the replication lag of the replicas (in seconds)
+DB_SLOW_QUERY_THRESHOLD = 0.5               # Statements slower than this are written to the slow query log (in seconds)
+DB_SLOW_QUERY_LOG_SIZE = 1000               # The maximum number of slow statements kept in memory
+REDACTED_ARGS = ("message", "body", "password", "key")  # The arguments never written to the logs
 WATCHDOG_CHECK_DELAY = 0.5                  # The delay between two checks of the watchdog (in seconds)
 
 ### Utility functions ###
@@ -48,66 +76,667 @@ def _print_verbose(verbose: int, level: int, *args: Any):
     if level <= verbose:
         print(*args)
 
+@functools.lru_cache(maxsize = 1024)
+def _positional_query(query: str) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Converts a query with named placeholders (%(name)s) to positional ones (%s), as required by prepared statements.
+    Returns the converted query and the names of the placeholders, in order
+    """
+    names = tuple(re.findall(r"%\((\w+)\)s", query))
+    return re.sub(r"%\((\w+)\)s", "%s", query), names
+
+@functools.lru_cache(maxsize = 1024)
+def _statement_name(query: str, procedure: bool) -> str:
+    """
+    Returns the name the timings of a statement are kept under: the name of the procedure or of the function it calls,
+    or else its text, with the lists of placeholders collapsed (so that the batches of any size share a name)
+    """
+    if procedure:
+        return query
+    function = re.match(r"^\s*select\s+(\w+)\s*\(", query, re.IGNORECASE)
+    if function and not re.match(r"^\s*select\s+\w+\s*\(.*\)\s+from\s", query, re.IGNORECASE | re.DOTALL):
+        return function.group(1)
+    name = re.sub(r"%\((\w+)\)s|%s", "?", query)
+    name = re.sub(r"(When \? Then \?\s*)+", "When ? Then ? ... ", name, flags = re.IGNORECASE)
+    name = re.sub(r"\bin\s*\(\s*\([?,\s]+\)(\s*,\s*\([?,\s]+\))*\s*\)", "in ((?, ...), ...)", name, flags = re.IGNORECASE)
+    name = re.sub(r"\bin\s*\([?,\s]+\)", "in (?, ...)", name, flags = re.IGNORECASE)
+    return " ".join(name.split())
+
+def _redact(args: Any) -> Any:
+    """
+    Returns a copy of the arguments of a statement that can be logged: message bodies, passwords and keys are replaced by their size
+    """
+    def redacted(value: Any) -> str:
+        return "<redacted {} bytes>".format(len(value)) if isinstance(value, (str, bytes, bytearray)) else "<redacted>"
+    if isinstance(args, dict):
+        return {
+            name: redacted(value) if isinstance(value, (bytes, bytearray)) or any(word in name.lower() for word in REDACTED_ARGS) else value
+            for name, value in args.items()
+        }
+    if args is None:
+        return None
+    # The names of positional arguments are unknown (e.g. the password of Check_Log_In): only the numbers are kept
+    return [value if isinstance(value, (int, float)) else redacted(value) for value in args]
+
+def _to_positional(query: str, args: Any) -> Tuple[str, tuple]:
+    """
+    Returns the query and the arguments ready to be executed as a prepared statement
+    """
+    if isinstance(args, dict):
+        query, names = _positional_query(query)
+        return query, tuple(args[name] for name in names)
+    return query, tuple(args or ())
+
 ### CLASSES ###
 
+class StatementCache():
+    """
+    The StatementCache class keeps the prepared statements of a connection, least recently used first.
+    A prepared statement is parsed once by the database, and then only its arguments are sent.
+    """
+    def __init__(self, connection: Any, capacity: int, counters: Counter, counters_lock: threading.Lock):
+        """
+        The constructor of the StatementCache class
+        counters: where the hits, misses and evictions are counted (shared by the caches of every connection)
+        """
+        self.connection = connection
+        self.capacity = capacity
+        self.counters = counters
+        self.counters_lock = counters_lock
+        # query : prepared cursor
+        self.statements = OrderedDict()
+
+    def get(self, query: str) -> Any:
+        """
+        Returns the prepared cursor of the query, preparing it if it is not in the cache
+        """
+        cursor = self.statements.get(query)
+        if cursor is not None:
+            self.statements.move_to_end(query)
+            self._count("hits")
+            return cursor
+        self._count("misses")
+        # The statement is prepared by the database on its first execution
+        cursor = self.connection.cursor(prepared = True)
+        self.statements[query] = cursor
+        # If the cache is full, we deallocate the least recently used statement
+        if len(self.statements) > self.capacity:
+            _, evicted = self.statements.popitem(last = False)
+            self._count("evictions")
+            try:
+                evicted.close()
+            except Exception:
+                pass
+        return cursor
+
+    def clear(self):
+        """
+        Deallocates every prepared statement
+        """
+        for cursor in self.statements.values():
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        self.statements.clear()
+
+    def _count(self, counter: str):
+        with self.counters_lock:
+            self.counters[counter] += 1
+
+class PooledConnection():
+    """
+    The PooledConnection class wraps a connection of the pool, together with its prepared statements cache
+    """
+    def __init__(self, connection: Any, statements: StatementCache):
+        """
+        The constructor of the PooledConnection class
+        """
+        self.connection = connection
+        self.statements = statements
+
+    def cursor(self, **kwargs) -> Any:
+        return self.connection.cursor(**kwargs)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def is_connected(self) -> bool:
+        return self.connection.is_connected()
+
+    def close(self):
+        """
+        Deallocates the prepared statements and closes the connection
+        """
+        self.statements.clear()
+        self.connection.close()
+
+class DBMSUnavailable(Exception):
+    """
+    The DBMSUnavailable exception is raised instead of querying a database that doesn't answer
+    """
+    pass
+
+class CircuitBreaker():
+    """
+    The CircuitBreaker class stops the attempts to reach a database that doesn't answer.
+    After failure_threshold consecutive failed connections the circuit opens: connecting fails at once, so that the workers
+    answer in degraded mode instead of waiting, until a probe (run by the watchdog) manages to connect and closes it.
+    It is designed to be used by multiple threads, so it is thread-safe.
+    """
+    def __init__(self, failure_threshold: int = DB_CIRCUIT_FAILURE_THRESHOLD, probe_interval: float = DB_CIRCUIT_PROBE_INTERVAL):
+        """
+        The constructor of the CircuitBreaker class
+        """
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        # Consecutive failed connections
+        self.failures = 0
+        # When the circuit opened (None while it is closed), and when it was last probed
+        self.opened_at = None
+        self.last_probe = None
+        # Counters
+        self.opens = 0              # times the circuit opened
+        self.rejected = 0           # connections refused while the circuit was open
+        self.lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.opened_at is not None
+
+    def check(self):
+        """
+        Raises DBMSUnavailable if the circuit is open
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            self.rejected += 1
+            down_for = time.monotonic() - self.opened_at
+        raise DBMSUnavailable("DB not responding for {:.1f} seconds: waiting for the watchdog to reconnect".format(down_for))
+
+    def record_success(self):
+        """
+        Records a successful connection: the circuit closes
+        """
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> bool:
+        """
+        Records a failed connection. Returns True if the circuit opened because of it
+        """
+        with self.lock:
+            self.failures += 1
+            if self.opened_at is None and self.failures >= self.failure_threshold:
+                self.opened_at = self.last_probe = time.monotonic()
+                self.opens += 1
+                return True
+            return False
+
+    def probe_due(self) -> bool:
+        """
+        Returns True if the circuit is open and it is time to try to reconnect (only one caller is told so per probe interval)
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.opened_at is None or now - self.last_probe < self.probe_interval:
+                return False
+            self.last_probe = now
+            return True
+
+    def stats(self) -> dict:
+        """
+        Returns the state and the counters of the circuit
+        """
+        with self.lock:
+            return {
+                "open": self.opened_at is not None,
+                "down_for": time.monotonic() - self.opened_at if self.opened_at is not None else 0.0,
+                "failures": self.failures,
+                "opens": self.opens,
+                "rejected": self.rejected
+            }
+
+class ConnectionPool():
+    """
+    The ConnectionPool class keeps a bounded set of open connections to the database, shared by the threads.
+    Connections are checked out with acquire and given back with release, so that connecting
+    (TCP connection and authentication) is not paid on every query.
+    A circuit breaker guards the database: while it is open, acquire fails at once (see CircuitBreaker and probe).
+    It is designed to be used by multiple threads, so it is thread-safe.
+    """
+    def __init__(
+        self,
+        connect: Callable,
+        size: int = DB_POOL_SIZE,
+        checkout_timeout: float = DB_POOL_CHECKOUT_TIMEOUT,
+        idle_timeout: float = DB_POOL_IDLE_TIMEOUT,
+        health_check_interval: float = DB_POOL_HEALTH_CHECK_INTERVAL,
+        breaker: CircuitBreaker = None
+        ):
+        """
+        The constructor of the ConnectionPool class
+        connect: the function opening a new connection
+        """
+        self.connect = connect
+        self.breaker = breaker or CircuitBreaker()
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        # (connection, time it was released) of the connections nobody is using, most recently used last
+        self.idle = deque()
+        # The number of open connections (idle or in use)
+        self.open_connections = 0
+        # Notified every time a connection is released
+        self.available = threading.Condition(threading.Lock())
+        # Counters
+        self.connects = 0           # connections opened
+        self.discarded = 0          # connections closed because broken or idle for too long
+        self.checkout_wait = Histogram()
+
+    def acquire(self) -> Any:
+        """
+        Checks out a connection, opening one if the pool is not full, or waiting for one to be released.
+        Raises an Exception if no connection is released within the checkout timeout,
+        and DBMSUnavailable right away if the database is down
+        """
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        with self.available:
+            while True:
+                # We don't wait for a database that doesn't answer
+                self.breaker.check()
+                now = time.monotonic()
+                # We reuse the most recently used connection (so that the others can idle out)
+                if self.idle:
+                    connection, released = self.idle.pop()
+                    break
+                # We open a new connection if the pool is not full
+                if self.open_connections < self.size:
+                    self.open_connections += 1
+                    connection, released = None, None
+                    break
+                # We wait for a connection to be released
+                if now >= deadline or not self.available.wait(deadline - now):
+                    if not self.idle and self.open_connections >= self.size:
+                        self.checkout_wait.record(time.monotonic() - start)
+                        raise Exception("DB pool exhausted: no connection released in {} seconds".format(self.checkout_timeout))
+        # Connecting and health checks are done without holding the lock
+        if connection is not None and not self._is_healthy(connection, now - released):
+            # Its slot is kept for the connection replacing it
+            self._discard(connection)
+            connection = None
+        if connection is None:
+            connection = self._open()
+        self.checkout_wait.record(time.monotonic() - start)
+        return connection
+
+    def release(self, connection: Any, broken: bool = False):
+        """
+        Gives a connection back to the pool. A broken connection is closed instead
+        """
+        if broken:
+            self._close(connection)
+            return
+        with self.available:
+            self.idle.append((connection, time.monotonic()))
+            self.available.notify()
+
+    def recycle_idle(self):
+        """
+        Closes the connections unused for longer than the idle timeout. It should be called periodically
+        """
+        expired = []
+        with self.available:
+            now = time.monotonic()
+            # The least recently used connections are first
+            while self.idle and now - self.idle[0][1] > self.idle_timeout:
+                expired.append(self.idle.popleft()[0])
+        for connection in expired:
+            self._close(connection)
+
+    def probe(self) -> bool:
+        """
+        Tries to reconnect to the database if the circuit is open (at most once per probe interval).
+        If it succeeds, the circuit closes and the connection is kept in the pool. Returns True if the database is back.
+        It is meant to be called periodically by a single background thread, so that no worker waits for the database
+        """
+        if not self.breaker.probe_due():
+            return False
+        try:
+            connection = self.connect()
+        except Exception:
+            return False
+        with self.available:
+            if self.open_connections < self.size:
+                self.open_connections += 1
+                self.connects += 1
+                self.idle.append((connection, time.monotonic()))
+                connection = None
+            self.breaker.record_success()
+            self.available.notify_all()
+        if connection is not None:
+            # The pool is full: the probe was only a check
+            try:
+                connection.close()
+            except Exception:
+                pass
+        return True
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the pool
+        """
+        with self.available:
+            return {
+                "size": self.size,
+                "open": self.open_connections,
+                "idle": len(self.idle),
+                "in_use": self.open_connections - len(self.idle),
+                "connects": self.connects,
+                "discarded": self.discarded,
+                "checkout_wait": self.checkout_wait.snapshot(),
+                "circuit": self.breaker.stats()
+            }
+
+    def _is_healthy(self, connection: Any, idle_for: float) -> bool:
+        """
+        Returns False if the connection idled out, or if it was unused for a while and doesn't answer anymore
+        """
+        if idle_for > self.idle_timeout:
+            return False
+        if idle_for > self.health_check_interval:
+            try:
+                return connection.is_connected()
+            except Exception:
+                return False
+        return True
+
+    def _open(self) -> Any:
+        """
+        Opens a new connection, for a slot already reserved in open_connections
+        """
+        try:
+            connection = self.connect()
+        except BaseException as err:
+            # We free the slot we reserved
+            with self.available:
+                self.open_connections -= 1
+                # If the database is now considered down, the threads waiting for a connection stop waiting
+                if isinstance(err, Exception) and self.breaker.record_failure():
+                    self.available.notify_all()
+                else:
+                    self.available.notify()
+            raise
+        self.breaker.record_success()
+        with self.available:
+            self.connects += 1
+        return connection
+
+    def _discard(self, connection: Any):
+        """
+        Closes a connection, keeping its slot reserved in open_connections
+        """
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self.available:
+            self.discarded += 1
+
+    def _close(self, connection: Any):
+        """
+        Closes a connection and frees its slot
+        """
+        self._discard(connection)
+        with self.available:
+            self.open_connections -= 1
+            self.available.notify()
+
 class DBMS():
     """
     The DBMS class handles the communication between the server and the database.
+    The statements run on the primary database, unless they are read-only and read replicas are configured:
+    then they are spread over the replicas, except for the sessions that wrote recently (so that they read their own writes).
     """
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, backend: DBMSBackend = None):
         """
         The constructor of the DBMS class
+        config: the endpoint of the primary (host, user, password, database), and optionally "replicas":
+        the list of the endpoints of the read replicas (their missing keys are taken from the primary)
+        backend: the database engine the connections are opened with (MySQL by default)
         """
         # We store the configuration
         self.config = config
+        self.backend = backend or MySQLBackend()
+        # We keep the connections open in a pool
+        self.pool = ConnectionPool(self._connect, config.get("pool_size", DB_POOL_SIZE))
+        # And one pool for each read replica, used in turn
+        self.replica_pools = [
+            ConnectionPool(functools.partial(self._connect, replica), config.get("pool_size", DB_POOL_SIZE))
+            for replica in config.get("replicas", [])
+        ]
+        self.next_replica_pool = itertools.cycle(self.replica_pools)
+        # replica pool : its last replication lag measured (in seconds, None if not measured or not known)
+        self.replica_lags = {pool: None for pool in self.replica_pools}
+        # session : time of its last write
+        self.session_writes = {}
+        self.session_writes_lock = threading.Lock()
+        # statement name : connect, execute, fetch and total time histograms
+        self.statement_timings = {}
+        self.statement_timings_lock = threading.Lock()
+        # The statements slower than the threshold, most recent last (also appended to the slow_query_log file, if given)
+        self.slow_query_threshold = config.get("slow_query_threshold", DB_SLOW_QUERY_THRESHOLD)
+        self.slow_query_log = config.get("slow_query_log")
+        self.slow_queries = deque(maxlen = DB_SLOW_QUERY_LOG_SIZE)
+        self.slow_queries_lock = threading.Lock()
+        # Hits, misses and evictions of the prepared statements caches of the connections
+        self.statement_cache_size = config.get("statement_cache_size", DB_STATEMENT_CACHE_SIZE)
+        self.statement_counters = Counter()
+        self.statement_counters_lock = threading.Lock()
 
-    def query(self, results_queue: TaggedQueue, job_tag: int, query: str, args: TypedDict = None, procedure: bool = False, fetch: bool = True):
+    def query(self, results_queue: TaggedQueue, job_tag: int, query: str, args: TypedDict = None, procedure: bool = False, fetch: bool = True, no_reply: bool = False, prepare: bool = True, read_only: bool = False, session: Hashable = None):
         """
-        Executes a query on the database
+        Executes a query on the database, and puts the result in the queue with the given job_tag
         The query method is designed to be used by multiple threads, so it is thread-safe
-        TODO: try to reconnect to the database if the connection is lost (to prevent soft crashes)
+        If fetch is False, the rows are not fetched and an empty result is put in the queue (to signal completion)
+        If no_reply is True, nothing is fetched nor put in the queue: the job is fire-and-forget
+        """
+        results = self.execute(query, args, procedure = procedure, fetch = fetch and not no_reply, prepare = prepare, read_only = read_only, session = session, job_tag = job_tag)
+        if no_reply:
+            return
+        # Wrap them into the DBMSResult class
+        results = DBMSResult(job_tag, query, args, results)
+        # We put the results in the queue
+        results_queue.put_response(job_tag, results)
+
+    def execute(self, query: str, args: TypedDict = None, procedure: bool = False, fetch: bool = True, prepare: bool = True, read_only: bool = False, session: Hashable = None, job_tag: int = None) -> list:
+        """
+        Executes a query on the database, and returns the rows (an empty list if fetch is False)
+        If read_only is True, the query may run on a read replica (see reads_from_replica)
+        The job_tag is only used to trace the query in the slow query log
+        It runs in the calling thread, so a worker can use it to resolve the steps of a composite job
+        without queueing sub-jobs (and waiting for other workers to pick them up).
+        Queries (not procedures) are executed as prepared statements cached by the connection, unless prepare is False:
+        it should be False for queries whose text changes at every call, so that they don't push the hot ones out of the cache.
+        A broken connection is replaced by a new one. If the database is down, the circuit breaker of the pool makes
+        the statements fail at once with DBMSUnavailable, until the watchdog reconnects (see probe);
+        the reconnections and failures are counted in the stats of the pool.
         TODO: notify watchdow of how many queries are running (avoid overloading the database)
-        TODO: keep count of number of reconnections (detect bad connection)
         """
-        # We try to connect to the database
-        attempts = 0
-        while attempts < MAX_DB_CONNECTION_ATTEMPTS:
-            try:
-                connection = mysql.connector.connect(
-                    host=self.config["host"],
-                    user=self.config["user"],
-                    password=self.config["password"],
-                    database=self.config["database"]
-                )
-                # We store the cursor
-                cursor = connection.cursor()
-                break
-            except mysql.connector.Error as err:
-                # If we have too many attempts, we exit
-                if attempts > MAX_DB_CONNECTION_ATTEMPTS:
-                    print("Too many attempts to connect to the database. Exiting...")
-                    sys.exit(1)
-                # Else, we print the error and we wait a bit
-                print("Failed to connect to the database. Error: {}".format(err))
-                print("Trying again in {} seconds...".format(DB_CONNECTION_DELAY))
-                time.sleep(DB_CONNECTION_DELAY)
-                # We increment the number of attempts
-                attempts += 1
-                # We try again
-                continue
-        if attempts >= MAX_DB_CONNECTION_ATTEMPTS:
-            raise Exception("DB not responding: Too many attempts to connect to the database")
-        # We execute the query
-
-        if procedure:
-            # We execute the procedure
-            cursor.callproc(query, args)
-            if not fetch:
-                # We commit the changes
-                connection.commit()
-                # And we close the connection
-                connection.close()
-                return
+        # We check out a connection from the pool
+        pool = self._pool(read_only, session)
+        start = time.perf_counter()
+        connection = pool.acquire()
+        try:
+            results = self._run(connection, query, args, procedure, fetch, prepare, job_tag, time.perf_counter() - start)
+            # We commit the changes
+            connection.commit()
+        except BaseException:
+            # We give back the connection, unless it is not usable anymore
+            pool.release(connection, broken = not self._rollback(connection))
+            raise
+        # And we give back the connection
+        pool.release(connection)
+        return results
+
+    def transaction(self, read_only: bool = False, session: Hashable = None, job_tag: int = None) -> "Transaction":
+        """
+        Returns a unit of work: every statement executed through it runs on the same connection, in a single transaction.
+        It is meant to be used in a with block: the transaction is committed at the end of the block,
+        or rolled back if an exception is raised
+        If read_only is True, the transaction may run on a read replica (see reads_from_replica)
+        The job_tag is only used to trace the statements in the slow query log
+        """
+        return Transaction(self, self._pool(read_only, session), job_tag, read_only)
+
+    def reads_from_replica(self, session: Hashable = None) -> bool:
+        """
+        Returns whether the read-only statements of the session run on a replica.
+        They don't if there are no replicas, or if the session wrote in the last DB_REPLICA_READ_YOUR_WRITES_WINDOW
+        seconds: the replicas may not have received its write yet.
+        Reading its own writes is best-effort: the window is a guess of the replication lag, not a check of what the replica
+        applied. The replicas measured further behind than the window are not read from (see measure_replica_lags),
+        but one falling behind between two measures may still serve a read that misses the last write of the session
+        """
+        if not self.replica_pools:
+            return False
+        if session is None:
+            return True
+        with self.session_writes_lock:
+            last_write = self.session_writes.get(session)
+        return last_write is None or time.monotonic() - last_write > DB_REPLICA_READ_YOUR_WRITES_WINDOW
+
+    def measure_replica_lags(self):
+        """
+        Measures the replication lag of every replica that is up (see replica_stats).
+        It should be called periodically, by a single thread
+        """
+        for pool in self.replica_pools:
+            lag = None
+            if not pool.breaker.is_open():
+                try:
+                    connection = pool.acquire()
+                except Exception:
+                    connection = None
+                if connection is not None:
+                    try:
+                        lag = self.backend.replication_lag(connection.connection)
+                    except Exception:
+                        # The lag stays unknown until the next measure
+                        pass
+                    pool.release(connection, broken = not self._rollback(connection))
+            self.replica_lags[pool] = lag
+
+    def replica_stats(self) -> List[dict]:
+        """
+        Returns, for each replica, its last replication lag measured (None if not known) and the counters of its pool
+        """
+        return [{"lag": self.replica_lags[pool], "pool": pool.stats()} for pool in self.replica_pools]
+
+    def record_write(self, session: Hashable):
+        """
+        Records that the session just committed a write, so that its next reads see it
+        """
+        if session is None or not self.replica_pools:
+            return
+        with self.session_writes_lock:
+            self.session_writes[session] = time.monotonic()
+
+    def probe(self) -> List[ConnectionPool]:
+        """
+        Tries to reconnect to the databases (primary or replicas) that are down, and returns the pools of the ones that are back.
+        It should be called periodically, by a single thread
+        """
+        return [pool for pool in [self.pool] + self.replica_pools if pool.probe()]
+
+    def is_available(self) -> bool:
+        """
+        Returns False if the primary database is down: the statements fail at once until the watchdog reconnects
+        """
+        return not self.pool.breaker.is_open()
+
+    def recycle_idle(self):
+        """
+        Closes the connections unused for a while, and forgets the writes older than the read-your-writes window.
+        It should be called periodically
+        """
+        for pool in [self.pool] + self.replica_pools:
+            pool.recycle_idle()
+        with self.session_writes_lock:
+            now = time.monotonic()
+            for session, last_write in list(self.session_writes.items()):
+                if now - last_write > DB_REPLICA_READ_YOUR_WRITES_WINDOW:
+                    del self.session_writes[session]
+
+    def statement_cache_stats(self) -> dict:
+        """
+        Returns the hits, misses and evictions of the prepared statements caches of every connection
+        """
+        with self.statement_counters_lock:
+            hits = self.statement_counters["hits"]
+            misses = self.statement_counters["misses"]
+            return {
+                "size": self.statement_cache_size,
+                "hits": hits,
+                "misses": misses,
+                "evictions": self.statement_counters["evictions"],
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+            }
+
+    def statement_stats(self) -> Dict[str, dict]:
+        """
+        Returns, for each statement (see _statement_name), a snapshot of its connect, execute, fetch and total time histograms.
+        The connect time is the wait for a connection of the pool: the statements of a transaction after the first don't have one
+        """
+        with self.statement_timings_lock:
+            timings = dict(self.statement_timings)
+        return {
+            name: {phase: histogram.snapshot() for phase, histogram in histograms.items()}
+            for name, histograms in timings.items()
+        }
+
+    def slow_query_stats(self) -> List[dict]:
+        """
+        Returns the statements slower than the threshold kept in memory, most recent last
+        """
+        with self.slow_queries_lock:
+            return list(self.slow_queries)
+
+    def _run(self, connection: PooledConnection, query: str, args: TypedDict, procedure: bool, fetch: bool, prepare: bool, job_tag: int = None, connect_time: float = None) -> list:
+        """
+        Executes a statement on a connection checked out from the pool, without committing, and returns the rows
+        connect_time: how long the statement waited for the connection (None if it was already checked out, in a transaction)
+        """
+        start = time.perf_counter()
+        prepared = prepare and not procedure
+        if prepared:
+            # We execute the prepared statement (preparing it if the connection doesn't have it yet)
+            query_text, params = _to_positional(query, args)
+            cursor = connection.statements.get(query_text)
+            cursor.execute(query_text, params)
+        else:
+            # A buffered cursor reads the whole result, so the connection can be reused even if we don't fetch it
+            cursor = connection.cursor(buffered=True)
+            if procedure:
+                # We execute the procedure
+                cursor.callproc(query, args)
+            else:
+                # We execute the query
+                cursor.execute(query, args)
+        executed = time.perf_counter()
+        if not fetch:
+            results = []
+            # The rows of a prepared statement must be read before the connection is reused
+            if prepared and cursor.description:
+                cursor.fetchall()
+        elif procedure:
             # Get the results
             results = cursor.stored_results()
             # Store the results in a list with all the results of every stored procedure, not divided by procedure
@@ -117,26 +746,170 @@ class DBMS():
                     results_list.append(row)
             results = results_list
         else:
-            # We execute the query
-            cursor.execute(query, args)
-            if not fetch:
-                # We commit the changes
-                connection.commit()
-                # And we close the connection
-                connection.close()
-                return
             # We get the results
             results = cursor.fetchall()
-        
-        # We commit the changes
-        connection.commit()
-        # And we close the connection
-        connection.close()
-        # Wrap them into the DBMSResult class
-        results = DBMSResult(job_tag, query, args, results)
-        # We put the results in the queue
-        results_queue.put_response(job_tag, results)
+        # The prepared statements stay open in the cache
+        if not prepared:
+            cursor.close()
+        self._record_timing(_statement_name(query, procedure), job_tag, args, connect_time, executed - start, time.perf_counter() - executed)
+        return results
+
+    def _record_timing(self, name: str, job_tag: int, args: Any, connect_time: float, execute_time: float, fetch_time: float):
+        """
+        Records the timings of a statement, and logs it if it is slower than the threshold
+        """
+        total_time = (connect_time or 0) + execute_time + fetch_time
+        with self.statement_timings_lock:
+            timings = self.statement_timings.get(name)
+            if timings is None:
+                timings = self.statement_timings[name] = {
+                    "connect": Histogram(),
+                    "execute": Histogram(),
+                    "fetch": Histogram(),
+                    "total": Histogram()
+                }
+        if connect_time is not None:
+            timings["connect"].record(connect_time)
+        timings["execute"].record(execute_time)
+        timings["fetch"].record(fetch_time)
+        timings["total"].record(total_time)
+        if total_time < self.slow_query_threshold:
+            return
+        entry = {
+            "time": datetime.datetime.now(),
+            "statement": name,
+            "job_tag": job_tag,
+            # The message bodies (and the other secrets) never reach the log
+            "args": _redact(args),
+            "connect": connect_time,
+            "execute": execute_time,
+            "fetch": fetch_time,
+            "total": total_time
+        }
+        with self.slow_queries_lock:
+            self.slow_queries.append(entry)
+        # The file is written outside of the lock, so that a slow disk doesn't hold up the other workers
+        # (each line is appended by a single write)
+        if self.slow_query_log:
+            try:
+                with open(self.slow_query_log, "a") as log:
+                    log.write("{} {:.3f}s job#{} {} args={} (connect {}, execute {:.3f}s, fetch {:.3f}s)\n".format(
+                        entry["time"].isoformat(sep = " ", timespec = "milliseconds"), total_time, job_tag, name, entry["args"],
+                        "-" if connect_time is None else "{:.3f}s".format(connect_time), execute_time, fetch_time
+                    ))
+            except OSError:
+                # Logging must never make a query fail
+                pass
+
+    def _pool(self, read_only: bool, session: Hashable) -> ConnectionPool:
+        """
+        Returns the pool a statement runs on: the next replica that is up (and not lagging behind more than the
+        read-your-writes window) for the reads that can go to a replica, the primary otherwise
+        """
+        if read_only and self.reads_from_replica(session):
+            for _ in range(len(self.replica_pools)):
+                pool = next(self.next_replica_pool)
+                lag = self.replica_lags[pool]
+                if not pool.breaker.is_open() and (lag is None or lag <= DB_REPLICA_READ_YOUR_WRITES_WINDOW):
+                    return pool
+        return self.pool
+
+    def _connect(self, endpoint: dict = None) -> PooledConnection:
+        """
+        Opens a new connection to the database (the primary, or the replica at endpoint).
+        It is not tried again if it fails: the circuit breaker of the pool counts the failure,
+        and the watchdog reconnects in the background once the database is considered down
+        """
+        config = dict(self.config, **(endpoint or {}))
+        try:
+            connection = self.backend.connect(config)
+        except self.backend.connection_errors as err:
+            raise DBMSUnavailable("DB not responding: {}".format(err)) from err
+        return PooledConnection(
+            connection,
+            StatementCache(connection, self.statement_cache_size, self.statement_counters, self.statement_counters_lock)
+        )
+
+    def _rollback(self, connection: Any) -> bool:
+        """
+        Rolls back the current transaction of a connection. Returns False if the connection is broken
+        """
+        try:
+            connection.rollback()
+            return True
+        except Exception:
+            return False
     
+class Transaction():
+    """
+    The Transaction class is a unit of work on the database: its statements run on one connection of the pool,
+    and are committed (or rolled back) together.
+    """
+    def __init__(self, dbms: DBMS, pool: ConnectionPool = None, job_tag: int = None, read_only: bool = False):
+        """
+        The constructor of the Transaction class
+        pool: the pool of the database the transaction runs on (the primary by default)
+        job_tag: the job the transaction is run for (to trace its statements in the slow query log)
+        read_only: whether the transaction only reads (the backend may start it without taking the write lock)
+        """
+        self.dbms = dbms
+        self.pool = pool or dbms.pool
+        self.job_tag = job_tag
+        self.read_only = read_only
+        self.connection = None
+        # The wait for the connection, charged to the first statement
+        self.connect_time = None
+
+    def __enter__(self) -> "Transaction":
+        # We check out the connection used by every statement of the transaction
+        start = time.perf_counter()
+        self.connection = self.pool.acquire()
+        self.connect_time = time.perf_counter() - start
+        try:
+            self.dbms.backend.begin(self.connection.connection, self.read_only)
+        except BaseException:
+            self.pool.release(self.connection, broken = not self.dbms._rollback(self.connection))
+            self.connection = None
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        connection, self.connection = self.connection, None
+        if exc_type is None:
+            try:
+                # We commit every statement at once
+                connection.commit()
+            except BaseException:
+                self.pool.release(connection, broken = not self.dbms._rollback(connection))
+                raise
+            self.pool.release(connection)
+        else:
+            # Nothing of the transaction is kept
+            self.pool.release(connection, broken = not self.dbms._rollback(connection))
+        # Exceptions are not swallowed
+        return False
+
+    def execute(self, query: str, args: TypedDict = None, procedure: bool = False, fetch: bool = True, prepare: bool = True) -> list:
+        """
+        Executes a statement in the transaction, and returns the rows (an empty list if fetch is False)
+        """
+        connect_time, self.connect_time = self.connect_time, None
+        return self.dbms._run(self.connection, query, args, procedure, fetch, prepare, self.job_tag, connect_time)
+
+    def executemany(self, query: str, args_list: List[Any]):
+        """
+        Executes a statement once for every set of arguments, in a single batch (inserts are sent as one multi-row statement)
+        """
+        if not args_list:
+            return
+        connect_time, self.connect_time = self.connect_time, None
+        start = time.perf_counter()
+        cursor = self.connection.cursor()
+        cursor.executemany(query, args_list)
+        cursor.close()
+        # The arguments of every row would flood the log: only their number is kept
+        self.dbms._record_timing(_statement_name(query, False), self.job_tag, {"rows": len(args_list)}, connect_time, time.perf_counter() - start, 0.0)
+
 class DBMSResult(Response):
     """
     The DBMSResult class is used to store the results of a query
@@ -162,6 +935,23 @@ class DBMSResult(Response):
         """
         return "DBMS Result: Job#{} - Query: {} {}".format(self.job_tag, self.query, self.args)
 
+class JobHandler():
+    """
+    The JobHandler class describes how the worker threads resolve a job type
+    """
+    def __init__(self, function: Callable, max_concurrency: int = None, timeout: float = QUEUE_RESPONSE_TIMEOUT, batch: bool = False):
+        """
+        The constructor of the JobHandler class
+        function: the method resolving the job (it receives the list of jobs if batch is True)
+        max_concurrency: the maximum number of workers resolving this job type at once (None for no limit)
+        timeout: the maximum time a job may wait in the queue before being dropped (None for no limit)
+        batch: whether the pending jobs of the type are merged and resolved together
+        """
+        self.function = function
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.batch = batch
+
 class Server():
 
     def printv(self, *args: Any, level: int = 0):
@@ -180,6 +970,12 @@ class Server():
         dbuser: str = "root",
         dbpassword: str = "",
         dbname: str = "ChitChat",
+        dbbackend: DBMSBackend = None,
+        dbreplicas: List[dict] = None,
+        dbslowquerythreshold: float = DB_SLOW_QUERY_THRESHOLD,
+        dbslowquerylog: str = None,
+        messagearchiveage: float = MESSAGE_ARCHIVE_AGE,
+        inboxmaxchatsize: int = INBOX_MAX_CHAT_SIZE,
 
         key_port: int = 5556,
         max_key_connections: int = 250,
@@ -200,6 +996,12 @@ class Server():
         self.dbuser = dbuser
         self.dbpassword = dbpassword
         self.dbname = dbname
+        self.dbbackend = dbbackend
+        self.dbreplicas = dbreplicas or []
+        self.dbslowquerythreshold = dbslowquerythreshold
+        self.dbslowquerylog = dbslowquerylog
+        self.message_archive_age = messagearchiveage # None to never archive the old messages
+        self.inbox_max_chat_size = inboxmaxchatsize
         self.key_port = key_port
         self.max_key_connections = max_key_connections
         self.com_port_base = com_port_base
@@ -218,6 +1020,8 @@ class Server():
 
         # Setup the queue
         self.queue = TaggedQueue()
+        # Setup the job handlers
+        self._register_job_handlers()
 
         # Print startup message
         self.printv("Starting server...", level = 0)
@@ -227,7 +1031,12 @@ class Server():
             "host": self.dbhost,
             "user": self.dbuser,
             "password": self.dbpassword,
-            "database": self.dbname
+            "database": self.dbname,
+            # The read replicas (e.g. [{"host": "replica1"}]): the missing keys are taken from the primary
+            "replicas": self.dbreplicas,
+            # The statements slower than the threshold are logged (in memory, and in the dbslowquerylog file if given)
+            "slow_query_threshold": self.dbslowquerythreshold,
+            "slow_query_log": self.dbslowquerylog
         }
 
         # We also want the database to be thread-safe
@@ -235,7 +1044,7 @@ class Server():
         self.db_config["pool_size"] = self.worker_threads_count + 1 + 1 # We add one for the KeyMaster and one to avoid deadlocks 
     
         # We create the DBMS object
-        self.dbms = DBMS(self.db_config)
+        self.dbms = DBMS(self.db_config, self.dbbackend)
 
         # Print success message
         self.printv("Connected to DBMS", level = 1)
@@ -303,8 +1112,28 @@ class Server():
         # If the connection to the DBMS is lost, it will try to reconnect.
         # If a worker thread is stuck, it will be killed and restarted
         self.watchdog_signal = 0 # Signal that the watchdog is now running
+        dbms_available = True
+        next_archival = time.monotonic()
+        next_lag_check = time.monotonic()
         while self.watchdog_signal == 0:
-            # Check
+            # While a database is down the workers fail fast (see CircuitBreaker): we are the only one trying to reconnect
+            for pool in self.dbms.probe():
+                self.printv("[Watchdog] Reconnected to the {}".format("DBMS" if pool is self.dbms.pool else "read replica"), level = 1)
+            if dbms_available and not self.dbms.is_available():
+                self.printv("[Watchdog] DBMS not responding: answering in degraded mode until it is back", level = 1)
+            dbms_available = self.dbms.is_available()
+            # Free the responses nobody collected
+            self.queue.evict_expired_responses()
+            # Close the connections to the database unused for a while
+            self.dbms.recycle_idle()
+            # Measure how far behind the read replicas are, once in a while
+            if self.dbms.replica_pools and time.monotonic() >= next_lag_check:
+                next_lag_check = time.monotonic() + DB_REPLICA_LAG_CHECK_INTERVAL
+                self.dbms.measure_replica_lags()
+            # Move the old messages to the archive, once in a while (a worker does it, like any other job)
+            if self.message_archive_age is not None and dbms_available and time.monotonic() >= next_archival:
+                next_archival = time.monotonic() + MESSAGE_ARCHIVE_INTERVAL
+                self.archive_messages(datetime.datetime.now() - datetime.timedelta(seconds = self.message_archive_age))
             time.sleep(WATCHDOG_CHECK_DELAY) # To not overload the CPU
         # Check the exit signal, and log accordingly
         match self.watchdog_signal:
@@ -332,51 +1161,78 @@ class Server():
         # Communicate with the database
         # Resolve the job, by outputting a response
         while self.worker_signals[id] == 0:
-            # ... do stuff
-            # To not overload the CPU
-            job = self.queue.next()
+            # We block until a job is available (or the timeout expires, so that we can check our signal)
+            job = self.queue.next(WORKER_THREAD_QUEUE_WAIT_TIMEOUT)
             if job:
-                # TODO: instead of match-case, we call the function _"job_type" with job as argument
-                match job.type:
-                    case "get":
-                        # Get the data from the database
-                        pass # TODO
-                    case "register":
-                        # Ask to register a new user
-                        self._register(job)
-                    case "get_userid_info":
-                        # Get the info of a user
-                        self._get_userid_info(job)
-                    case "login":
-                        # Login a user
-                        self._login(job)
-                    case "set_last_seen":
-                        # Set the last seen time of a user
-                        self._set_last_seen(job)
-                    case "create_chat":
-                        # Create a new chat
-                        self._create_chat(job)
-                    case "send_message":
-                        # Send a message to a chat
-                        self._send_message(job)
-                    case "get_unread_messages":
-                        # Get the unread messages of a chat
-                        self._get_unread_messages(job)
-                    case "set_status":
-                        # Set the status of a user
-                        self._set_status(job)
-                    case "update_chats":
-                        # Update the chats of a user
-                        self._update_chats(job)
-                    case "get_chat":
-                        # Get the info of a chat
-                        self._get_chat(job)
-
-                pass
-            time.sleep(WORKER_THREAD_QUEUE_CHECK_DELAY)
+                self._resolve(job)
         # Restore free slot for any future worker thread allocated
         self.worker_signals[id] = -1
         return
+
+    def _register_job_handlers(self):
+        """
+        Builds the registry mapping every job type to its JobHandler, and sets the limits of each type in the queue
+        """
+        self.job_handlers = {
+            "register": JobHandler(self._register),
+            "get_userid_info": JobHandler(self._get_userid_info),
+            "login": JobHandler(self._login),
+            "set_last_seen": JobHandler(self._set_last_seen, timeout = None, batch = True),
+            # Creating a chat takes many statements: it can't take more than half of the workers
+            "create_chat": JobHandler(self._create_chat, max_concurrency = max(1, self.worker_threads_count // 2)),
+            "send_message": JobHandler(self._send_message),
+            # The ClientHandler waits up to 60 seconds for the unread messages
+            "get_unread_messages": JobHandler(self._get_unread_messages, timeout = 60),
+            "set_status": JobHandler(self._set_status, timeout = None, batch = True),
+            "update_chats": JobHandler(self._update_chats),
+            "get_chat": JobHandler(self._get_chat),
+            "get_chats": JobHandler(self._get_chats),
+            "get_chat_history": JobHandler(self._get_chat_history),
+            # A single archival at a time: the next one goes on from where it stopped
+            "archive_messages": JobHandler(self._archive_messages, max_concurrency = 1, timeout = None)
+        }
+        for job_type, handler in self.job_handlers.items():
+            self.queue.set_job_type_limits(job_type, handler.max_concurrency, handler.timeout)
+
+    def _put_request(self, job: Job) -> int:
+        """
+        Puts a job in the queue and returns its job_tag. Fails fast if no handler is registered for the job type
+        """
+        if job.type not in self.job_handlers:
+            raise ValueError("Unknown job type: {}".format(job.type))
+        return self.queue.put_request(job)
+
+    def _resolve(self, job: Job):
+        """
+        Resolves a job taken from the queue with the handler registered for its type
+        """
+        handler = self.job_handlers.get(job.type)
+        # The jobs resolved (more than one if they are merged in a batch)
+        jobs = [job]
+        try:
+            if handler is None:
+                raise ValueError("Unknown job type: {}".format(job.type))
+            if handler.batch:
+                jobs = self._next_batch(job)
+                handler.function(jobs)
+            else:
+                handler.function(job)
+        except Exception as err:
+            self.printv("[Worker] Job#{} ({}) failed: {}".format(job.job_tag, job.type, err), level = 1)
+            # We answer right away, so that nobody waits for the timeout
+            for failed in jobs:
+                if not failed.no_reply:
+                    self.queue.put_response(failed.job_tag, Response(failed.job_tag, None))
+        finally:
+            # Record the latencies of the jobs
+            for done in jobs:
+                self.queue.job_done(done)
+
+    def _next_batch(self, job: Job) -> List[Job]:
+        """
+        Returns the job together with the other jobs of the same type waiting in the queue (up to BATCH_MAX_JOBS)
+        """
+        return [job] + self.queue.next_batch(job.type, BATCH_MAX_JOBS - 1, BATCH_MAX_WAIT)
     
     def login(self, username, user_tag, password):
         # This function will create a new job for the queue, and return the job_tag
@@ -389,7 +1245,7 @@ class Server():
                 "user_password": password
             }
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
     def _login(self, job : Job):
@@ -417,7 +1273,7 @@ class Server():
                 "key" : key
             }
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
     def _register(self, job):
@@ -426,15 +1282,22 @@ class Server():
         It will be called by the _worker_thread function.
         """
         query = "Select create_user (%(username)s, %(state)s, %(key)s, %(password)s)" # TODO: to be replaced by query from dbms developement branch
-        response = self.dbms.query(self.queue, job.job_tag, query, 
-            {
-             "username" : job.args["username"],
-             "password" : job.args["password"],
-             "state" : job.args["state"],
-             "key" : job.args["key"]
-            }
-        )
-
+        args = {
+            "username" : job.args["username"],
+            "password" : job.args["password"],
+            "state" : job.args["state"],
+            "key" : job.args["key"]
+        }
+        for attempt in range(REGISTER_MAX_ATTEMPTS):
+            try:
+                rows = self.dbms.execute(query, args, job_tag = job.job_tag)
+                break
+            except Exception as err:
+                # Two users registering the same nick at once may pick the same tag: the unique (Nick, IDN) key refuses
+                # the second one (or the database rolls it back as a deadlock), which tries again and gets the next tag
+                if attempt == REGISTER_MAX_ATTEMPTS - 1 or not self.dbms.backend.is_conflict(err):
+                    raise
+        self.queue.put_response(job.job_tag, DBMSResult(job.job_tag, query, args, rows))
         return job.job_tag
     
     def set_last_seen(self, user_id):
@@ -444,21 +1307,29 @@ class Server():
             type = "set_last_seen",
             args = {
                 "user_id": str(user_id)
-            }
+            },
+            priority = PRIORITY_BACKGROUND,
+            no_reply = True
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
-    def _set_last_seen(self, job):
+    def _set_last_seen(self, jobs: List[Job]):
         """
-        The _set_last_seen method is the actual code executed by workers to resolve a set_last_seen request.
+        The _set_last_seen method is the actual code executed by workers to resolve a batch of set_last_seen requests.
+        The whole batch is written with a single statement.
         It will be called by the _worker_thread function.
         """
-        query = "Update User Set last_log_in = now() Where id = %(user_id)s"
-        response = self.dbms.query(self.queue, job.job_tag, query, {
-            "user_id" : job.args["user_id"]
-        }, fetch=False)
-        return job.job_tag
+        # Every user appears once, whatever the number of requests
+        user_ids = list(dict.fromkeys(job.args["user_id"] for job in jobs))
+        query = "Update user Set last_log_in = now() Where id in ({})".format(
+            ", ".join("%(user_id{})s".format(i) for i in range(len(user_ids)))
+        )
+        # The text of the query depends on the size of the batch: it is not worth preparing
+        self.dbms.query(self.queue, None, query, {
+            "user_id{}".format(i): user_id for i, user_id in enumerate(user_ids)
+        }, no_reply=True, prepare=False)
+        return [job.job_tag for job in jobs]
     
     def get_userid_info(self, user):
         # This function will create a new job for the queue, and return the job_tag
@@ -469,7 +1340,7 @@ class Server():
                 "user": str(user)
             }
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
     def _get_userid_info(self, job):
@@ -477,15 +1348,18 @@ class Server():
         The _get_userid_info method will query the db, making sure that the user exists.
         It will be called by the _worker_thread function.
         """
+        # We read it from the primary: the user was just registered, a replica may not have it yet
         query = "Select IDN from user where ID = %(userid)s"
         response = self.dbms.query(self.queue, job.job_tag, query, {
             "userid": job.args["user"]
         })
         return job.job_tag
     
-    def create_chat(self, creator, name, description, partecipants):
+    def create_chat(self, creator, name, description, partecipants, session = None):
         # This function will create a new job for the queue, and return the job_tag
         # The job will be resolved by the worker threads, which will then put the response in the queue
+        # The job is not tied to the session (the chat is created even if the client disconnects),
+        # but the next reads of the session will see the chat
         job = Job(
             type = "create_chat",
             args = {
@@ -493,10 +1367,11 @@ class Server():
                 "name": name,
                 "description": description,
                 "partecipants": partecipants,
-                "photo" : "photos/default.png"
+                "photo" : "photos/default.png",
+                "session": session
             }
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
     def _create_chat(self, job):
@@ -505,80 +1380,77 @@ class Server():
         It will be called by the _worker_thread function.
         """
         
-        query = "SELECT create_chat(%(chat_name)s, %(chat_description)s, %(chat_creator)s, %(chat_photo)s)"
-        response = self.dbms.query(self.queue, str(job.job_tag)+"-1", query, {
-            "chat_creator": job.args["creator"].ID,
-            "chat_name": job.args["name"],
-            "chat_description": job.args["description"],
-            "chat_photo": job.args["photo"]
-        })
-        # Wait for the chat to be created   
-        creation = self.queue.wait_for_result(str(job.job_tag)+"-1")
-        chat_id = creation[0][0]
-        # Add creator as partecipant
-        query = "Insert_participant"
-        response = self.dbms.query(self.queue, str(job.job_tag)+"-2", query, (
-            int(job.args["creator"].tag),
-            str(job.args["creator"].username),
-            chat_id
-        ), procedure=True)
-        # Wait for the partecipant to be added
-        self.queue.wait_for_result(str(job.job_tag)+"-2")
-        # Add the partecipants
-        for partecipant in job.args["partecipants"]:
-            # Check if the user exists
-            query = "Select count(*) from user where nick = %(nick)s AND IDN = %(idn)s"
-            response = self.dbms.query(self.queue, str(job.job_tag)+"-3", query, {
-                "nick": partecipant[0],
-                "idn": partecipant[1]
-            })
-            # Wait for the query to be resolved
-            
-            result = self.queue.wait_for_result(str(job.job_tag)+"-3")
-            if result[0][0] == 0:
-                # Delete the chat
-                query = "delete_chat"
-                response = self.dbms.query(self.queue, str(job.job_tag)+"-1", query, [
-                    chat_id
-                ], procedure=True, fetch=False) # Don't wait for the result
-                # User does not exist
-                response = Response (
-                    job_tag = job.job_tag,
-                    result = "User does not exist"
+        # Every step is executed inline by this worker: waiting for sub-jobs picked up by other workers could deadlock the pool
+        creator = job.args["creator"]
+        # Every partecipant once, whatever the case of the nick
+        partecipants = list({(str(nick).lower(), str(tag)): (nick, tag) for nick, tag in job.args["partecipants"]}.values())
+        # The chat is created, and its partecipants added, in a single transaction: if anything fails, nothing is kept
+        with self.dbms.transaction(job_tag = job.job_tag) as transaction:
+            # Check that every partecipant exists, with a single query (a point lookup on the (Nick, IDN) key for each of them)
+            user_ids = []
+            if partecipants:
+                query = "Select ID from user where (Nick, IDN) in ({})".format(
+                    ", ".join("(%(nick{0})s, %(idn{0})s)".format(i) for i in range(len(partecipants)))
                 )
-                self.queue.put_response(job.job_tag, response)
-                return job.job_tag
-            query = "Insert_participant"
-            response = self.dbms.query(self.queue, str(job.job_tag)+"-4", query, (
-                partecipant[1],
-                partecipant[0],
-                chat_id
-            ), procedure=True)
-            # Wait for the partecipant to be added
-            self.queue.wait_for_result(str(job.job_tag)+"-4")
-        # Redirect the request to be a get_chat request
-        chat = self.queue.wait_for_result(self.get_chat(job.args["creator"].ID, job.args["creator"].username, job.args["creator"].tag, chat_id))
-        # Create the response with the original job_tag (since the job_tag was already generated, and we must use the one given to the ClientHandler)
+                args = {}
+                for i, (nick, tag) in enumerate(partecipants):
+                    args["nick{}".format(i)] = nick
+                    args["idn{}".format(i)] = tag
+                # The text of the query depends on the number of partecipants: it is not worth preparing
+                user_ids = [row[0] for row in transaction.execute(query, args, prepare=False)]
+                if len(user_ids) < len(partecipants):
+                    # User does not exist
+                    response = Response (
+                        job_tag = job.job_tag,
+                        result = "User does not exist"
+                    )
+                    self.queue.put_response(job.job_tag, response)
+                    return job.job_tag
+            # Create the chat
+            query = "SELECT create_chat(%(chat_name)s, %(chat_description)s, %(chat_creator)s, %(chat_photo)s)"
+            chat_id = transaction.execute(query, {
+                "chat_creator": creator.ID,
+                "chat_name": job.args["name"],
+                "chat_description": job.args["description"],
+                "chat_photo": job.args["photo"]
+            })[0][0]
+            # Add the creator and the partecipants, with a single statement
+            user_ids = list(dict.fromkeys([creator.ID] + user_ids))
+            # In a small chat every message is written to the inbox of each partecipant (fan-out on write), so that they read
+            # their own inbox only; in a big one that would take too many writes, so they read the messages of the chat (fan-out on read)
+            inbox = 1 if len(user_ids) <= self.inbox_max_chat_size else 0
+            query = "Insert into participate(Id_user, Id_chat, Last_message_id, Inbox) values (%s, %s, 0, %s)"
+            transaction.executemany(query, [
+                (user_id, chat_id, inbox) for user_id in user_ids
+            ])
+        # The reads of the session go to the primary until the replicas have the chat
+        self.dbms.record_write(job.args.get("session"))
+        # Retrieve the chat as a get_chat request would, in this same worker
+        chats = self._chats_details(creator.ID, [chat_id], job_tag = job.job_tag)
         response = Response(
             job_tag = job.job_tag,
-            result = chat.result
+            # The chat may be gone already, if every partecipant left it in the meantime
+            result = chats[0] if chats else "Chat does not exist"
         )
         # Put the response in the queue
         self.queue.put_response(job.job_tag, response)
         return job.job_tag
 
-    def send_message(self, user_id, chat_id, message):
+    def send_message(self, user_id, chat_id, message, session = None):
         # This function will create a new job for the queue, and return the job_tag
         # The job will be resolved by the worker threads, which will then put the response in the queue
+        # The job is not tied to the session (the message is sent even if the client disconnects),
+        # but the next reads of the session will see the message
         job = Job(
             type = "send_message",
             args = {
                 "user_id": user_id,
                 "chat_id": chat_id,
-                "message": message
+                "message": message,
+                "session": session
             }
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
     def _send_message(self, job):
@@ -587,62 +1459,326 @@ class Server():
         It will be called by the _worker_thread function.
         """
         query = "Select create_message(%(sender_id)s, %(chat_id)s, %(message)s)"
-        response = self.dbms.query(self.queue, job.job_tag, query, {
+        args = {
             "sender_id": job.args["user_id"],
             "chat_id": job.args["chat_id"],
             "message": job.args["message"]
-        })
+        }
+        results = self.dbms.execute(query, args, job_tag = job.job_tag)
+        # The write is recorded before the client gets the response, so that its next reads go to the primary
+        self.dbms.record_write(job.args.get("session"))
+        self.queue.put_response(job.job_tag, DBMSResult(job.job_tag, query, args, results))
         return job.job_tag
     
-    def get_unread_messages(self, user_id):
+    def get_unread_messages(self, user_id, session = None, after = None, max_rows = UNREAD_PAGE_MAX_ROWS, max_bytes = UNREAD_PAGE_MAX_BYTES):
         # This function will create a new job for the queue, and return the job_tag
         # The job will be resolved by the worker threads, which will then put the response in the queue
+        # If the session ends before a worker takes the job, the job is cancelled (and the messages stay unread)
+        # The messages are delivered in pages of at most max_rows messages and max_bytes of bodies, starting
+        # after the (chat id, message number) cursor returned with the previous page
         job = Job(
             type = "get_unread_messages",
             args = {
-                "user_id": user_id
-            }
+                "user_id": user_id,
+                "after": after or (0, 0),
+                "max_rows": max_rows,
+                "max_bytes": max_bytes
+            },
+            session = session
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
     def _get_unread_messages(self, job):
         """
-        The _get_unread_messages method will query the db, retrieving the unread messages.
+        The _get_unread_messages method will query the db, retrieving a page of unread messages.
+        The page holds the first unread messages ordered by (chat id, message number) after the cursor of the job,
+        up to max_rows messages and max_bytes of bodies (at least one message is always delivered).
+        Only the chats of the delivered messages are marked as read: the rest is delivered by the next pages.
+        The messages of the small chats are read from the inbox of the user, and removed from it once delivered (fan-out on write),
+        the ones of the other chats from the messages of the chats (fan-out on read).
         It will be called by the _worker_thread function.
         """
-        query = "messages_not_received"
-        response = self.dbms.query(self.queue, str(job.job_tag) + "-1", query, (
-            job.args["user_id"],
-        ), procedure=True)
-        result = self.queue.wait_for_result(str(job.job_tag) + "-1")
-  
-        # Find the highest relative message id for each chat (second element in the tuple)
-        highest_ids = {}
-        for message in result.result:
-            if message[0] in highest_ids:
-                if message[1] > highest_ids[message[0]]:
-                    highest_ids[message[0]] = message[1]
-            else:
-                highest_ids[message[0]] = message[1]
-        # Update the last message id for each chat
-        for chat_id in highest_ids:
-            query = "update_last_message"
-            response = self.dbms.query(self.queue, str(job.job_tag) + "-2", query, (
-                job.args["user_id"],
-                chat_id,
-                highest_ids[chat_id]
-            ), procedure=True)
-            self.queue.wait_for_result(str(job.job_tag) + "-2")
+        after_chat, after_number = job.args["after"]
+        messages = []
+        more = False
+        # The chats after the cursor with messages the user didn't read: the counter of a chat is the number of its last message,
+        # so they are found without reading the messages (most polls stop here, with no chat)
+        chats_query = (
+            "Select p.Id_chat, p.Last_message_id, c.Archived_number, c.Message_counter "
+            "From participate p "
+            "Join chat c On c.ID = p.Id_chat "
+            "Where p.Id_user = %(user_id)s And p.Inbox = 0 And c.Message_counter > p.Last_message_id "
+            "And (p.Id_chat > %(after_chat)s Or (p.Id_chat = %(after_chat)s And c.Message_counter > %(after_number)s)) "
+            "Order By p.Id_chat "
+            "Limit %(limit)s"
+        )
+        chats_args = {"user_id": job.args["user_id"], "after_chat": after_chat, "after_number": after_number}
+        # The messages in the inbox of the user after the cursor (the range of its primary key)
+        inbox_query = (
+            "Select * From (Select m.Id_chat, m.Message_number, u.Nick, u.IDN, m.Timestamp, m.Body "
+            "From inbox i "
+            "Join message m On m.Id_chat = i.Id_chat And m.Message_number = i.Message_number "
+            "Join user u On u.ID = m.Id_sender "
+            "Where i.Id_user = %(user_id)s "
+            "And (i.Id_chat > %(after_chat)s Or (i.Id_chat = %(after_chat)s And i.Message_number > %(after_number)s)) "
+            "Order By i.Id_chat, i.Message_number Limit %(limit)s) As unread_inbox"
+        )
+        # Unless the session wrote recently, a replica tells if there is anything to deliver,
+        # and only then the primary is asked for the messages (a replica lagging behind only delays them to the next poll)
+        if not self.dbms.reads_from_replica(job.session) or any(self.dbms.execute(
+            query,
+            dict(chats_args, limit = 1),
+            read_only = True,
+            session = job.session,
+            job_tag = job.job_tag
+        ) for query in (chats_query, inbox_query)):
+            # The messages are read, and the last message read of each chat advanced, in a single transaction
+            with self.dbms.transaction(job_tag = job.job_tag) as transaction:
+                # Every chat has at least a message to deliver: more chats than messages in a page are never needed
+                chat_limit = min(job.args["max_rows"], MAX_CHATS_PER_QUERY)
+                chats = transaction.execute(chats_query, dict(chats_args, limit = chat_limit + 1))
+                # The last message read of each chat (the cursor may be inside the first one)
+                froms = [max(last_id, after_number) if chat_id == after_chat else last_id for chat_id, last_id, _, _ in chats]
+                # The chats are taken until their unread messages fill the page (and the row read beyond it):
+                # the messages of the next chats could not be in it, there is no point in reading them
+                taken = 0
+                unread = 0
+                while taken < min(len(chats), chat_limit) and unread <= job.args["max_rows"]:
+                    unread += chats[taken][3] - froms[taken]
+                    taken += 1
+                more_chats = len(chats) > taken
+                chats = chats[:taken]
+                chat_ids = {chat[0] for chat in chats}
+                # The unread messages of each chat are a range of its (Id_chat, Message_number) index:
+                # one range scan per chat, with constant bounds, instead of a join on a non constant range
+                # One more row than the page is read, to know if there are more
+                args = dict(chats_args, limit = job.args["max_rows"] + 1)
+                parts = [inbox_query]
+                for i, (chat_id, _, archived_number, _) in enumerate(chats):
+                    args["chat_id{}".format(i)] = chat_id
+                    args["from{}".format(i)] = froms[i]
+                    for table in ("message", "message_archive"):
+                        # Only the messages read by every partecipant are archived: the archive is only read
+                        # for the partecipants added later, who didn't read them yet
+                        if table == "message_archive" and args["from{}".format(i)] >= archived_number:
+                            continue
+                        parts.append(
+                            "Select * From (Select m.Id_chat, m.Message_number, u.Nick, u.IDN, m.Timestamp, m.Body "
+                            "From {1} m Join user u On u.ID = m.Id_sender "
+                            "Where m.Id_chat = %(chat_id{0})s And m.Message_number > %(from{0})s "
+                            "Order By m.Message_number Limit %(limit)s) As unread{0}_{1}".format(i, table)
+                        )
+                query = " Union All ".join(parts) + " Order By 1, 2 Limit %(limit)s"
+                # The text of the query depends on the number of chats: it is only worth preparing without any (the inbox alone)
+                rows = transaction.execute(query, args, prepare = not chats)
+                # We keep the messages fitting in the page
+                size = 0
+                for row in rows[:job.args["max_rows"]]:
+                    size += len(row[5])
+                    if messages and size > job.args["max_bytes"]:
+                        break
+                    messages.append(row)
+                # The chats left out of this page are delivered by the next ones
+                more = len(messages) < len(rows) or more_chats
+
+                # Find the highest relative message id for each chat (second element in the tuple)
+                highest_ids = {}
+                for message in messages:
+                    if message[0] in highest_ids:
+                        if message[1] > highest_ids[message[0]]:
+                            highest_ids[message[0]] = message[1]
+                    else:
+                        highest_ids[message[0]] = message[1]
+                # Update the last message id of every chat with a single statement
+                if highest_ids:
+                    args = {"user_id": job.args["user_id"]}
+                    cases = []
+                    for i, (chat_id, last_id) in enumerate(highest_ids.items()):
+                        args["chat_id{}".format(i)] = chat_id
+                        args["last_id{}".format(i)] = last_id
+                        cases.append("When %(chat_id{0})s Then %(last_id{0})s".format(i))
+                    query = "Update participate Set Last_message_id = Case Id_chat {} End Where Id_user = %(user_id)s And Id_chat in ({})".format(
+                        " ".join(cases),
+                        ", ".join("%(chat_id{})s".format(i) for i in range(len(highest_ids)))
+                    )
+                    # The text of the query depends on the number of chats: it is not worth preparing
+                    transaction.execute(query, args, fetch=False, prepare=False)
+                    # The delivered messages of the chats not read from their counters came from the inbox
+                    inbox_chats = [(chat_id, last_id) for chat_id, last_id in highest_ids.items() if chat_id not in chat_ids]
+                    if inbox_chats:
+                        args = {"user_id": job.args["user_id"]}
+                        cases = []
+                        for i, (chat_id, last_id) in enumerate(inbox_chats):
+                            args["chat_id{}".format(i)] = chat_id
+                            args["last_id{}".format(i)] = last_id
+                            cases.append("When %(chat_id{0})s Then %(last_id{0})s".format(i))
+                        query = "Delete From inbox Where Id_user = %(user_id)s And Id_chat in ({}) And Message_number <= Case Id_chat {} End".format(
+                            ", ".join("%(chat_id{})s".format(i) for i in range(len(inbox_chats))),
+                            " ".join(cases)
+                        )
+                        transaction.execute(query, args, fetch=False, prepare=False)
         # Create the response
         response = Response(
             job_tag = job.job_tag,
-            result = result.result
+            result = {
+                "messages": messages,
+                "more": more,
+                # The keyset cursor of the next page
+                "cursor": (messages[-1][0], messages[-1][1]) if messages else (after_chat, after_number)
+            }
         )
         # Put the response in the queue
         self.queue.put_response(job.job_tag, response)
         return job.job_tag
     
+    def get_chat_history(self, user_id, chat_id, before = MAX_MESSAGE_NUMBER, max_rows = HISTORY_PAGE_MAX_ROWS, session = None):
+        # This function will create a new job for the queue, and return the job_tag
+        # The job will be resolved by the worker threads, which will then put the response in the queue
+        # The history is read backwards: the page holds the messages before the message number given (the last ones by default)
+        # If the session ends before a worker takes the job, the job is cancelled
+        job = Job(
+            type = "get_chat_history",
+            args = {
+                "user_id": user_id,
+                "chat_id": chat_id,
+                "before": before,
+                "max_rows": max_rows
+            },
+            session = session
+        )
+        job_tag = self._put_request(job)
+        return job_tag
+
+    def _get_chat_history(self, job):
+        """
+        The _get_chat_history method will query the db, retrieving a page of the history of a chat, ordered by message number.
+        The old messages are in message_archive and the recent ones in message: both are read, by a single statement.
+        Only the partecipants of the chat can read its history.
+        It will be called by the _worker_thread function.
+        """
+        parts = []
+        for table in ("message", "message_archive"):
+            parts.append(
+                "Select * From (Select m.Id_chat, m.Message_number, u.Nick, u.IDN, m.Timestamp, m.Body "
+                "From participate p Join {0} m On m.Id_chat = p.Id_chat Join user u On u.ID = m.Id_sender "
+                "Where p.Id_user = %(user_id)s And p.Id_chat = %(chat_id)s And m.Message_number < %(before)s "
+                "Order By m.Message_number Desc Limit %(limit)s) As history_{0}".format(table)
+            )
+        query = " Union All ".join(parts) + " Order By 2 Desc Limit %(limit)s"
+        # One more row than the page is read, to know if there are more
+        rows = self.dbms.execute(query, {
+            "user_id": job.args["user_id"],
+            "chat_id": job.args["chat_id"],
+            "before": job.args["before"],
+            "limit": job.args["max_rows"] + 1
+        }, read_only = True, session = job.session, job_tag = job.job_tag)
+        messages = list(reversed(rows[:job.args["max_rows"]]))
+        # Create the response
+        response = Response(
+            job_tag = job.job_tag,
+            result = {
+                "messages": messages,
+                "more": len(rows) > job.args["max_rows"],
+                # The cursor of the previous page
+                "cursor": messages[0][1] if messages else job.args["before"]
+            }
+        )
+        # Put the response in the queue
+        self.queue.put_response(job.job_tag, response)
+        return job.job_tag
+
+    def archive_messages(self, before):
+        # This function will create a new job for the queue, and return the job_tag
+        # The job will be resolved by the worker threads
+        # It is queued by the watchdog: nobody waits for it, so it never produces a response
+        job = Job(
+            type = "archive_messages",
+            args = {
+                "before": before
+            },
+            priority = PRIORITY_BACKGROUND,
+            no_reply = True
+        )
+        job_tag = self._put_request(job)
+        return job_tag
+
+    def _archive_messages(self, job):
+        """
+        The _archive_messages method will query the db, moving the messages sent before the given time and read by every
+        partecipant of their chat from message to message_archive. The number of messages moved is logged.
+        The messages of a chat are moved in order of number, so that its archived messages are always its first ones
+        (up to chat.Archived_number) and the unread messages are never archived.
+        It will be called by the _worker_thread function.
+        """
+        # The chats with messages read by every partecipant that are not archived yet
+        # (the participate table is read, not the message table: its size doesn't depend on the history)
+        chats = deque(self.dbms.execute(
+            "Select c.ID, c.Archived_number, min(p.Last_message_id) From chat c Join participate p On p.Id_chat = c.ID "
+            "Group By c.ID, c.Archived_number Having min(p.Last_message_id) > c.Archived_number",
+            job_tag = job.job_tag
+        ))
+        # The messages of each chat are read from the (Id_chat, Message_number) key, after the last one archived
+        select_query = (
+            "Select ID, Message_number, Timestamp < %(before)s From message "
+            "Where Id_chat = %(chat_id)s And Message_number > %(archived)s And Message_number <= %(read)s "
+            "Order By Message_number Limit %(limit)s"
+        )
+        archived = 0
+        for _ in range(MESSAGE_ARCHIVE_MAX_BATCHES):
+            if not chats:
+                break
+            with self.dbms.transaction(job_tag = job.job_tag) as transaction:
+                # chat id : highest message number archived, and the ids of the messages of the batch
+                highest_numbers = {}
+                ids = []
+                # The batch is filled with the messages of as many chats as needed
+                while chats and len(ids) < MESSAGE_ARCHIVE_BATCH:
+                    chat_id, archived_number, read_number = chats[0]
+                    limit = MESSAGE_ARCHIVE_BATCH - len(ids)
+                    rows = transaction.execute(select_query, {
+                        "before": job.args["before"],
+                        "chat_id": chat_id,
+                        "archived": archived_number,
+                        "read": read_number,
+                        "limit": limit
+                    })
+                    # Only the first messages of the chat are archived: we stop at the first one too recent
+                    old = list(itertools.takewhile(lambda row: row[2], rows))
+                    if old:
+                        highest_numbers[chat_id] = old[-1][1]
+                        ids.extend(message_id for message_id, _, _ in old)
+                    if len(rows) == limit and len(old) == limit:
+                        # The chat may have more messages to archive, in the next batch
+                        chats[0] = (chat_id, old[-1][1], read_number)
+                    else:
+                        chats.popleft()
+                if not ids:
+                    break
+                args = {"id{}".format(i): message_id for i, message_id in enumerate(ids)}
+                id_list = ", ".join("%(id{})s".format(i) for i in range(len(ids)))
+                # The text of the queries depends on the size of the batch: it is not worth preparing
+                transaction.execute(
+                    "Insert into message_archive(ID, Id_chat, Id_sender, Body, Timestamp, Message_number) "
+                    "Select ID, Id_chat, Id_sender, Body, Timestamp, Message_number From message Where ID in ({})".format(id_list),
+                    args, fetch = False, prepare = False
+                )
+                transaction.execute("Delete From message Where ID in ({})".format(id_list), args, fetch = False, prepare = False)
+                args = {}
+                cases = []
+                for i, (chat_id, message_number) in enumerate(highest_numbers.items()):
+                    args["chat_id{}".format(i)] = chat_id
+                    args["number{}".format(i)] = message_number
+                    cases.append("When %(chat_id{0})s Then %(number{0})s".format(i))
+                query = "Update chat Set Archived_number = Case ID {} End Where ID in ({})".format(
+                    " ".join(cases),
+                    ", ".join("%(chat_id{})s".format(i) for i in range(len(highest_numbers)))
+                )
+                transaction.execute(query, args, fetch = False, prepare = False)
+            archived += len(ids)
+        self.printv("[Archive] {} messages moved to the archive".format(archived), level = 2)
+        return job.job_tag
+
     def set_status(self, user_id, status):
         # This function will create a new job for the queue, and return the job_tag
         # The job will be resolved by the worker threads, which will then put the response in the queue
@@ -651,33 +1787,49 @@ class Server():
             args = {
                 "user_id": user_id,
                 "status": status
-            }
+            },
+            priority = PRIORITY_BACKGROUND,
+            no_reply = True
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
-    def _set_status(self, job):
+    def _set_status(self, jobs: List[Job]):
         """
-        The _set_status method will query the db, updating the user status.
+        The _set_status method will query the db, updating the status of the users of a batch of set_status requests.
+        Only the last status of each user is kept, and the whole batch is written with a single statement.
         It will be called by the _worker_thread function.
         """
-        query = "Update_user_state"
-        response = self.dbms.query(self.queue, job.job_tag, query, (
-            job.args["status"],
-            job.args["user_id"]
-        ), procedure=True, fetch = False)
-        return job.job_tag
+        # The jobs are in queue order, so the last status of a user overwrites the previous ones
+        statuses = {}
+        for job in jobs:
+            statuses[job.args["user_id"]] = job.args["status"]
+        args = {}
+        cases = []
+        for i, (user_id, status) in enumerate(statuses.items()):
+            args["user_id{}".format(i)] = user_id
+            args["status{}".format(i)] = status
+            cases.append("When %(user_id{0})s Then %(status{0})s".format(i))
+        query = "Update user Set State = Case ID {} End Where ID in ({})".format(
+            " ".join(cases),
+            ", ".join("%(user_id{})s".format(i) for i in range(len(statuses)))
+        )
+        # The text of the query depends on the size of the batch: it is not worth preparing
+        self.dbms.query(self.queue, None, query, args, no_reply=True, prepare=False)
+        return [job.job_tag for job in jobs]
     
-    def update_chats(self, user_id):
+    def update_chats(self, user_id, session = None):
         # This function will create a new job for the queue, and return the job_tag
         # The job will be resolved by the worker threads, which will then put the response in the queue
+        # If the session ends before a worker takes the job, the job is cancelled
         job = Job(
             type = "update_chats",
             args = {
                 "user_id": user_id
-            }
+            },
+            session = session
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
     def _update_chats(self, job):
@@ -688,12 +1840,13 @@ class Server():
         query = "Chat_of_a_user"
         response = self.dbms.query(self.queue, job.job_tag, query, [
             int(job.args["user_id"])
-        ], procedure=True)
+        ], procedure=True, read_only=True, session=job.session)
         return job.job_tag
     
-    def get_chat(self, user_id, user_name, user_tag, chat_id):
+    def get_chat(self, user_id, user_name, user_tag, chat_id, session = None):
         # This function will create a new job for the queue, and return the job_tag
         # The job will be resolved by the worker threads, which will then put the response in the queue
+        # If the session ends before a worker takes the job, the job is cancelled
         job = Job(
             type = "get_chat",
             args = {
@@ -701,9 +1854,10 @@ class Server():
                 "user_name": user_name,
                 "user_tag": user_tag,
                 "chat_id": chat_id
-            }
+            },
+            session = session
         )
-        job_tag = self.queue.put_request(job)
+        job_tag = self._put_request(job)
         return job_tag
     
     def _get_chat(self, job):
@@ -711,57 +1865,83 @@ class Server():
         The _get_chat method will query the db, retrieving the chat with the given id.
         It will be called by the _worker_thread function.
         """
-        # Get the chat partecipants
-        query = "GET_CHAT_PARTICIPANTS"
-        response = self.dbms.query(self.queue, str(job.job_tag)+"-1", query, [
-            job.args["chat_id"]
-        ], procedure=True)
-        # Wait for the partecipants to be retrieved
-        partecipants = self.queue.wait_for_result(str(job.job_tag)+"-1")
-        # check if the user is partecipant. The user name and user tag are the second and third element of the tuple
-        is_partecipant = False
-        for partecipant in partecipants.result:
-            if partecipant[0] == job.args["user_name"] and str(partecipant[1]) == str(job.args["user_tag"]):
-                is_partecipant = True
-                break
-        # If the user is not partecipant, return an error
-        if not is_partecipant:
-            response = Response(
-                job_tag = job.job_tag,
-                result = []
-            )
-            self.queue.put_response(job.job_tag, response)
-            return job.job_tag
-        # Retrieve chat info
-        query = "Select ID, Name, Description, Creation_date from Chat where ID = %(chat_id)s"
-        response = self.dbms.query(self.queue, str(job.job_tag)+"-2", query, {
-            "chat_id": job.args["chat_id"]
-        })
-        # Wait for the chat info to be retrieved
-        chat_info = self.queue.wait_for_result(str(job.job_tag)+"-2")
-        # If the user is not partecipant, return an error
-        if not chat_info.result or not chat_info.result[0]:
-            response = Response(
-                job_tag=job.job_tag,
-                result=[]
-            )
-            self.queue.put_response(job.job_tag, response)
-            return job.job_tag
-        # Combine a response
+        chats = self._chats_details(job.args["user_id"], [job.args["chat_id"]], read_only = True, session = job.session, job_tag = job.job_tag)
         response = Response(
             job_tag = job.job_tag,
-            result = {
-                "chat_id": chat_info.result[0][0],
-                "chat_name": chat_info.result[0][1],
-                "description": chat_info.result[0][2],
-                "creation_date": chat_info.result[0][3],
-                "partecipants": partecipants.result
-            }
+            result = chats[0] if chats else []
         )
         # Put the response in the queue
         self.queue.put_response(job.job_tag, response)
         return job.job_tag
 
+    def get_chats(self, user_id, chat_ids, session = None):
+        # This function will create a new job for the queue, and return the job_tag
+        # The job will be resolved by the worker threads, which will then put the response in the queue
+        # If the session ends before a worker takes the job, the job is cancelled
+        job = Job(
+            type = "get_chats",
+            args = {
+                "user_id": user_id,
+                "chat_ids": list(chat_ids)
+            },
+            session = session
+        )
+        job_tag = self._put_request(job)
+        return job_tag
+
+    def _get_chats(self, job):
+        """
+        The _get_chats method will query the db, retrieving all the chats with the given ids at once.
+        The chats the user is not partecipant of are left out.
+        It will be called by the _worker_thread function.
+        """
+        response = Response(
+            job_tag = job.job_tag,
+            result = self._chats_details(job.args["user_id"], job.args["chat_ids"], read_only = True, session = job.session, job_tag = job.job_tag)
+        )
+        # Put the response in the queue
+        self.queue.put_response(job.job_tag, response)
+        return job.job_tag
+
+    def _chats_details(self, user_id, chat_ids, read_only = False, session = None, job_tag = None) -> List[dict]:
+        """
+        The _chats_details method retrieves the info and the partecipants of the chats, in the calling worker.
+        A single query is run for every MAX_CHATS_PER_QUERY chats: it returns one row per partecipant of each chat
+        the user is partecipant of. The chats that don't exist or the user is not partecipant of are left out.
+        If read_only is True, the chats may be read from a replica (unless the session wrote recently).
+        """
+        # Every chat once, in the order they were asked
+        chat_ids = list(dict.fromkeys(chat_ids))
+        chats = {}
+        with self.dbms.transaction(read_only = read_only, session = session, job_tag = job_tag) as transaction:
+            for start in range(0, len(chat_ids), MAX_CHATS_PER_QUERY):
+                chunk = chat_ids[start:start + MAX_CHATS_PER_QUERY]
+                query = (
+                    "Select c.ID, c.Name, c.Description, c.Creation_date, u.Nick, u.IDN, others.Last_message_id "
+                    "From participate p "
+                    "Join chat c On c.ID = p.Id_chat "
+                    "Join participate others On others.Id_chat = c.ID "
+                    "Join user u On u.ID = others.Id_user "
+                    "Where p.Id_user = %(user_id)s And c.ID in ({})"
+                ).format(", ".join("%(chat_id{})s".format(i) for i in range(len(chunk))))
+                args = {"user_id": user_id}
+                for i, chat_id in enumerate(chunk):
+                    args["chat_id{}".format(i)] = chat_id
+                # The single chat query is the hot one: the others change with the number of chats and are not prepared
+                for row in transaction.execute(query, args, prepare = len(chunk) == 1):
+                    chat = chats.get(row[0])
+                    if chat is None:
+                        chat = chats[row[0]] = {
+                            "chat_id": row[0],
+                            "chat_name": row[1],
+                            "description": row[2],
+                            "creation_date": row[3],
+                            "partecipants": []
+                        }
+                    chat["partecipants"].append((row[4], row[5], row[6]))
+        # Combine the result
+        return [chats[chat_id] for chat_id in chat_ids if chat_id in chats]
+
 
     def shutdown(self):
         # Shutdown the server
@@ -1,14 +1,26 @@
 import socket
+import select
 import threading
 import pickle
 import datetime
-from server import Server
+from server import Server, MAX_MESSAGE_NUMBER
 from TaggedQueue import *  
 from cipher import *
 from message import Packet, PacketItem
 from identity import Identity
 from User import User
 import json
+import uuid
+
+UNREAD_MAX_PAGES_PER_POLL = 20 # The maximum number of pages of unread messages sent for a single msg_get
+SERVER_UNAVAILABLE_ERROR = "The server can't reach its database, try again later" # Sent when a job failed or timed out
+
+def failed(response: Response) -> bool:
+    """
+    Returns True if the job got no result: it timed out (no response), or it failed (the database is down, see Server._resolve)
+    """
+    return response is None or response.result is None
+
 # Two classes:
 # KeyExchanger : Binds to one port, accepts all incoming connections, used for public e2e keys sharing
 # ClientSocket : Used to communicate with a client.
@@ -91,14 +103,22 @@ class LoginManager:
                     self.server.printv("Login request from " + str(address) + " for user " + username + " usertag " + str(tag), level = 2)
                     # Wait for the job to finish
                     result = queue.wait_for_result(server.login(username, tag, password))
-                    # If the result is None, then the login failed
-                    if result.result is None or len(result.result) == 0:
+                    # If the job failed, the credentials could not be checked
+                    if failed(result):
+                        send_ciphered_message(Packet(
+                            [
+                                PacketItem("success", False),
+                                PacketItem("error", SERVER_UNAVAILABLE_ERROR)
+                            ]
+                        ), client, client_identity)
+                    # If the result is empty, then the login failed
+                    elif len(result.result) == 0:
                         # Send a failure message
                         send_ciphered_message( Packet(
                             [
                                 PacketItem("success", False)
                             ]
-                        ), client, self.server.identity)
+                        ), client, client_identity)
 
                     # Parse the result
                     else:
@@ -124,7 +144,15 @@ class LoginManager:
                     # print the request
                     self.server.printv("Register request from " + str(address) + " for user: " + username + " password: " + user_password, level = 2)
                     result = queue.wait_for_result(server.register(username, user_password, client_identity.export_public_key_bytes()))
-                    #
+                    if failed(result):
+                        send_ciphered_message(Packet(
+                            [
+                                PacketItem("success", False),
+                                PacketItem("error", SERVER_UNAVAILABLE_ERROR)
+                            ]
+                        ), client, client_identity)
+                        attempts += 1
+                        continue
                     # Result will be the user_id
                     user_id = result.result[0][0]
                     if user_id <= 0:
@@ -140,6 +168,16 @@ class LoginManager:
                     else:
                         # Get the user and tag of the new user
                         result = queue.wait_for_result(server.get_userid_info(user_id))
+                        if failed(result):
+                            # The user is registered, it can log in once the database is back
+                            send_ciphered_message(Packet(
+                                [
+                                    PacketItem("success", False),
+                                    PacketItem("error", SERVER_UNAVAILABLE_ERROR)
+                                ]
+                            ), client, client_identity)
+                            attempts += 1
+                            continue
                         user_tag = result.result[0][0]
                         # Create response
                         response = Packet(
@@ -152,7 +190,7 @@ class LoginManager:
                         send_ciphered_message(response, client, client_identity)
                         # Start the client handler
                         user = User(user_id, username, user_tag, user_password, client_identity.export_public_key_bytes())
-                        ClientHandler(client, address, client_identity, server, result["user"]).run()
+                        ClientHandler(client, address, client_identity, server, user).run()
                         
                         return
                 else:
@@ -183,12 +221,19 @@ class ClientHandler():
         self.user_password = user.password
         self.server_identity = server.identity
         self.user = user
+        # The read jobs of this connection are tied to the session, so that they are cancelled when it drops
+        # (its writes only carry it, so that the next reads of the connection see them)
+        self.session = uuid.uuid4().hex
 
     def run(self):
-        self.input_thread = threading.Thread(target=self._input, daemon= True)
+        self.input_thread = threading.Thread(target=self._serve, daemon= True)
         self.input_thread.start()
         # Wait for the threads to finish
         self.input_thread.join()
+        # Cancel the jobs of the connection no worker took yet (nobody will read their result)
+        cancelled = self.queue.cancel_session(self.session)
+        if cancelled:
+            self.server.printv("Cancelled " + str(cancelled) + " jobs of " + str(self.address), level = 3)
         # Set the last seen time
         self.server.set_last_seen(self.user_id) # Don't wait for the result
         # Connection should be closed by now, but we close it again just in case
@@ -197,6 +242,45 @@ class ClientHandler():
         except:
             pass
 
+    def _wait(self, tag: int, timeout: float = QUEUE_RESPONSE_TIMEOUT) -> Response:
+        """
+        Waits for the result of a job of the connection.
+        If the client disconnects meanwhile, the jobs of the session still queued are cancelled at once
+        (not after the wait times out), and ConnectionAbortedError is raised
+        """
+        result = self.queue.wait_for_result(tag, timeout, interrupted = self._disconnected)
+        if result is None and self._disconnected():
+            cancelled = self.queue.cancel_session(self.session)
+            self.server.printv("Cancelled " + str(cancelled) + " jobs of " + str(self.address) + " (disconnected while waiting)", level = 3)
+            raise ConnectionAbortedError("The client disconnected while waiting for job " + str(tag))
+        return result
+
+    def _disconnected(self) -> bool:
+        """
+        Returns True if the client closed the connection, without reading its next packet
+        """
+        try:
+            readable, _, _ = select.select([self.client], [], [], 0)
+            # A closed connection is readable, and has nothing left to read
+            return bool(readable) and self.client.recv(1, socket.MSG_PEEK) == b""
+        except (OSError, ValueError):
+            return True
+
+    def _serve(self):
+        try:
+            self._input()
+        except ConnectionError:
+            # The client dropped the connection while we were serving it
+            self.client.close()
+
+    def error_packet(error: str):
+        # Tell the client that its request could not be served
+        return Packet(
+            [
+                PacketItem("error", error)
+            ]
+        )
+
     def ping_packet(data: datetime.datetime):
         # Send a ping response
         return Packet(
@@ -205,23 +289,29 @@ class ClientHandler():
             ]
         )
     
-    def msg_get_packet(response: Response):
+    def msg_get_packet(messages: list):
         # create packet
         packet = Packet(data=[])
 
         # Add the messages to the packet
-        for message in response:
+        for message in messages:
             packet.append(PacketItem("msg", message))
         
         return packet
         
+    def history_packet(chat_id: int, response: Response):
+        # Create packet: the page of messages, whether there are older ones, and the cursor to ask for them
+        return Packet([
+            PacketItem("history", (chat_id, response["messages"], response["more"], response["cursor"]))
+        ])
+
     def update_chat_packet(response: Response):
         # Create packet
         return Packet([
             PacketItem("update_chats", [response.result[i][0] for i in range(len(response.result))])
         ])
     
-    def get_chat_packet_item(response: Response):
+    def get_chat_packet_item(response: Union[Response, dict]):
         # Create packet
         return PacketItem("get_chat", (
             response["chat_id"],
@@ -238,7 +328,12 @@ class ClientHandler():
         ])
     
     def create_chat_packet(response: Response):
-        if response and response.result != "User does not exist":
+        if failed(response):
+            return Packet([
+                PacketItem("create_chat_fail", SERVER_UNAVAILABLE_ERROR)
+            ])
+        # The result is the chat, or the reason it was not created
+        if isinstance(response.result, dict):
             # We send the result to the client
             return Packet([
                 PacketItem("create_chat_success", (
@@ -252,7 +347,7 @@ class ClientHandler():
         else:
             # We send the result to the client
             return Packet( [
-                PacketItem("create_chat_fail", None if response is None else response.result)
+                PacketItem("create_chat_fail", response.result)
             ])
     
     def _input(self):
@@ -290,24 +385,47 @@ class ClientHandler():
                         return
     
                     case "msg_get":
-                        # We get the messages
-                        # result = self.queue.wait_for_result(self.server.get_messages(self.user_id, chat_id, last_message_id))
-                        result = self.queue.wait_for_result(self.server.get_unread_messages(self.user_id), timeout = 60)
+                        # We get the messages, one bounded page at a time (each page is sent as its own packet)
+                        after = None
+                        for page in range(UNREAD_MAX_PAGES_PER_POLL):
+                            result = self._wait(self.server.get_unread_messages(self.user_id, session = self.session, after = after), timeout = 60)
 
-                        # Check if the result is None
-                        if result is None or len(result.result) == 0:
-                            continue # No new messages (sadly)
-                        
-                        # Create packet
-                        packet = ClientHandler.msg_get_packet(result)
-                        
-                        # Send the packet
-                        send_ciphered_message(packet, self.client, self.identity)
+                            # Check if the job failed
+                            if failed(result):
+                                send_ciphered_message(ClientHandler.error_packet(SERVER_UNAVAILABLE_ERROR), self.client, self.identity)
+                                break
+                            if len(result["messages"]) == 0:
+                                break # No new messages (sadly)
+                            
+                            # Create packet
+                            packet = ClientHandler.msg_get_packet(result["messages"])
+                            
+                            # Send the packet
+                            send_ciphered_message(packet, self.client, self.identity)
+
+                            # The rest of the backlog is sent with the next pages (or the next msg_get)
+                            if not result["more"]:
+                                break
+                            after = result["cursor"]
+
+                    case "history_get":
+                        # We expect a message with the following format:
+                        # [chat_id, before] (before is the cursor of the last page received, None for the last messages)
+                        chat_id = item.data[0]
+                        before = MAX_MESSAGE_NUMBER if item.data[1] is None else item.data[1]
+                        result = self._wait(self.server.get_chat_history(self.user_id, chat_id, before, session = self.session))
+                        if failed(result):
+                            send_ciphered_message(ClientHandler.error_packet(SERVER_UNAVAILABLE_ERROR), self.client, self.identity)
+                            continue
+                        # The page is empty if the user is not in the chat
+                        send_ciphered_message(ClientHandler.history_packet(chat_id, result), self.client, self.identity)
 
                     case "update_chats":
                         # We expect empty data
-                        result = self.queue.wait_for_result(self.server.update_chats(self.user_id))
-                        results = result.result
+                        result = self._wait(self.server.update_chats(self.user_id, session = self.session))
+                        if failed(result):
+                            send_ciphered_message(ClientHandler.error_packet(SERVER_UNAVAILABLE_ERROR), self.client, self.identity)
+                            continue
                         # Send the result
                         packet = ClientHandler.update_chat_packet(result)
                         send_ciphered_message(packet, self.client, self.identity)
@@ -315,7 +433,10 @@ class ClientHandler():
                     case "get_chat":
                         # We expect a chat_id
                         chat_id = item.data
-                        result = self.queue.wait_for_result(self.server.get_chat(self.user_id, self.user_name, self.user_tag, chat_id))
+                        result = self._wait(self.server.get_chat(self.user_id, self.user_name, self.user_tag, chat_id, session = self.session))
+                        if failed(result):
+                            send_ciphered_message(ClientHandler.error_packet(SERVER_UNAVAILABLE_ERROR), self.client, self.identity)
+                            continue
                         # If result is empty, then the user is trying to get a chat that he is not in, in which case we just ignore the request
                         if len(result.result) == 0:
                             continue
@@ -326,13 +447,14 @@ class ClientHandler():
                     case "get_chats":
                         packet = Packet(data=[])
                         # We expect a chat_id list
-                        # We get the chat
-                        for chat in item.data:
-                            result = self.queue.wait_for_result(self.server.get_chat(self.user_id, self.user_name, self.user_tag, chat))
-                            # If result is empty, then the user is trying to get a chat that he is not in, in which case we just ignore the request
-                            if not result.result or len(result.result) == 0:
-                                continue
-                            packet.append(ClientHandler.get_chat_packet_item(result))
+                        # We get all the chats with a single job. The chats the user is not in are left out of the result
+                        result = self._wait(self.server.get_chats(self.user_id, item.data, session = self.session))
+                        if failed(result):
+                            send_ciphered_message(ClientHandler.error_packet(SERVER_UNAVAILABLE_ERROR), self.client, self.identity)
+                            continue
+                        if result.result:
+                            for chat in result.result:
+                                packet.append(ClientHandler.get_chat_packet_item(chat))
                         # We send the result to the client
                         send_ciphered_message(packet, self.client, self.identity)
 
@@ -343,7 +465,7 @@ class ClientHandler():
                         description = item.data[1]
                         users = item.data[2]
                         # We create the chat
-                        result = self.queue.wait_for_result(self.server.create_chat(self.user, name, description, users))
+                        result = self._wait(self.server.create_chat(self.user, name, description, users, session = self.session))
                         send_ciphered_message(ClientHandler.create_chat_packet(result), self.client, self.identity)
                     
                     case "msg_send":
@@ -351,8 +473,10 @@ class ClientHandler():
                         # [chat_id, message]
                         chat_id = item.data[0]
                         message = item.data[1]
-                        # We send the message, and don't wait for the result
-                        result = self.queue.wait_for_result(self.server.send_message(self.user_id, chat_id, message))
+                        # We send the message, and tell the client only if it was lost
+                        result = self._wait(self.server.send_message(self.user_id, chat_id, message, session = self.session))
+                        if failed(result):
+                            send_ciphered_message(ClientHandler.error_packet(SERVER_UNAVAILABLE_ERROR), self.client, self.identity)
 
                     case "set_status":
                         # We expect a message with the following format:
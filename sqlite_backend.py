@@ -0,0 +1,498 @@
+"""
+An in-process stand-in for the MySQL database of the server, on SQLite.
+It reproduces the tables and triggers of Tables.sql, and the procedures and functions of queries.sql,
+so that the whole server can be tested and benchmarked without a database server.
+Every change to Tables.sql or queries.sql must be reproduced here.
+"""
+import sqlite3                  # For the database
+import threading                # For the lock on the creation of the schema
+import tempfile                 # For the directory of the temporary database
+import shutil                   # For the removal of the temporary database
+import os                       # For the path of the database
+import re                       # For the translation of the MySQL placeholders
+import datetime                 # For the dates and times stored in the database
+from typing import *            # For the type hints
+from dbms_backend import *      # For the DBMSBackend class (see dbms_backend.py)
+
+SQLITE_BUSY_TIMEOUT = 30        # The maximum time a connection waits for another one to commit (in seconds)
+
+# The tables and triggers of Tables.sql (participate is clustered on its primary key, as InnoDB does)
+SCHEMA = """
+CREATE TABLE user (
+  ID INTEGER PRIMARY KEY AUTOINCREMENT,
+  IDN int NOT NULL,
+  Nick char(32) NOT NULL COLLATE NOCASE,
+  State int NOT NULL,
+  Photo char(32) NOT NULL,
+  Last_log_in datetime DEFAULT NULL,
+  Comunication_key blob NOT NULL,
+  User_password char(32) NOT NULL
+);
+CREATE UNIQUE INDEX Nick_IDN ON user (Nick, IDN);
+
+INSERT INTO user (ID, IDN, Nick, State, Photo, Last_log_in, Comunication_key, User_password) VALUES
+(1, 1, 'Deleted_user', 0, '', NULL, '', 'apache1234');
+
+CREATE TABLE chat (
+  ID INTEGER PRIMARY KEY AUTOINCREMENT,
+  Name char(32) NOT NULL,
+  Photo char(32) NOT NULL,
+  Description char(255) DEFAULT NULL,
+  Creation_date date NOT NULL,
+  Founder_id int NOT NULL REFERENCES user (ID),
+  Message_counter int NOT NULL,
+  Archived_number int NOT NULL DEFAULT 0
+);
+CREATE INDEX Founder_id ON chat (Founder_id);
+
+CREATE TABLE message (
+  ID INTEGER PRIMARY KEY AUTOINCREMENT,
+  Id_chat int NOT NULL,
+  Id_sender int NOT NULL,
+  Body blob NOT NULL,
+  Timestamp datetime NOT NULL,
+  Message_number int NOT NULL
+);
+CREATE INDEX Foreign_key_sender_id ON message (Id_sender);
+CREATE UNIQUE INDEX Chat_message_number ON message (Id_chat, Message_number);
+
+CREATE TABLE message_archive (
+  ID int NOT NULL,
+  Id_chat int NOT NULL,
+  Id_sender int NOT NULL,
+  Body blob NOT NULL,
+  Timestamp datetime NOT NULL,
+  Message_number int NOT NULL,
+  PRIMARY KEY (Id_chat, Message_number)
+) WITHOUT ROWID;
+CREATE INDEX Archive_sender_id ON message_archive (Id_sender);
+
+CREATE TABLE participate (
+  Id_user int NOT NULL,
+  Id_chat int NOT NULL,
+  Last_message_id int NOT NULL,
+  Inbox int NOT NULL DEFAULT 0,
+  PRIMARY KEY (Id_user, Id_chat)
+) WITHOUT ROWID;
+
+CREATE TABLE inbox (
+  Id_user int NOT NULL,
+  Id_chat int NOT NULL,
+  Message_number int NOT NULL,
+  PRIMARY KEY (Id_user, Id_chat, Message_number)
+) WITHOUT ROWID;
+
+CREATE TRIGGER Clean_up_chat AFTER DELETE ON participate FOR EACH ROW
+BEGIN
+DELETE FROM inbox
+WHERE inbox.Id_user = old.Id_user AND inbox.Id_chat = old.Id_chat;
+
+DELETE FROM chat
+WHERE chat.ID = old.Id_chat AND NOT EXISTS (SELECT 1 FROM participate WHERE participate.Id_chat = old.Id_chat);
+END;
+
+CREATE TRIGGER Clean_up_user AFTER DELETE ON user FOR EACH ROW
+BEGIN
+DELETE FROM participate
+WHERE participate.Id_user = old.ID;
+
+UPDATE message
+SET Id_sender = 1
+WHERE message.Id_sender = old.ID;
+
+UPDATE message_archive
+SET Id_sender = 1
+WHERE message_archive.Id_sender = old.ID;
+END;
+"""
+
+# A MySQL placeholder (%s or %(name)s), or an escaped %
+PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+# A statement calling a single function: Select name(arguments)
+READ_STATEMENT = re.compile(r"^\s*select\b", re.IGNORECASE)
+FUNCTION_CALL = re.compile(r"^\s*select\s+(\w+)\s*\((.*)\)\s*;?\s*$", re.IGNORECASE | re.DOTALL)
+
+
+def _now() -> str:
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def _today() -> str:
+    return datetime.date.today().isoformat()
+
+# The dates and times are read back as the datetime objects mysql.connector returns
+# (the converters only apply to the connections opened with detect_types, that is the ones of the SQLiteBackend)
+sqlite3.register_converter("datetime", lambda value: datetime.datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("date", lambda value: datetime.date.fromisoformat(value.decode()))
+
+def _to_sqlite(query: str, args: Any) -> Tuple[str, Any]:
+    """
+    Translates the MySQL placeholders of a query to the SQLite ones (%s to ?, %(name)s to :name)
+    """
+    def replace(match):
+        if match.group(1):
+            return ":" + match.group(1)
+        return "%" if match.group(0) == "%%" else "?"
+    query = PLACEHOLDER.sub(replace, query)
+    if args is None:
+        return query, ()
+    if isinstance(args, dict):
+        return query, args
+    return query, tuple(args)
+
+
+# Procedures of queries.sql: they take the connection and the arguments of the call, and return the result sets
+def _check_log_in(db, user_tag, user_nick, user_password):
+    return [db.execute(
+        "SELECT user.ID, user.Comunication_key FROM user WHERE IDN = ? AND Nick = ? AND User_password = ?",
+        (user_tag, user_nick, user_password)
+    ).fetchall()]
+
+def _delete_participant(db, user_tag, user_nick, chat_id):
+    db.execute(
+        "DELETE FROM participate WHERE Id_user = ? AND Id_chat = ?",
+        (_search_user_id(db, user_tag, user_nick), chat_id)
+    )
+    return []
+
+def _get_chat_founder(db, chat_id):
+    return [db.execute(
+        "SELECT u.ID, u.IDN, u.Nick FROM user u, chat c WHERE c.ID = ? AND u.ID = c.Founder_id",
+        (chat_id,)
+    ).fetchall()]
+
+def _delete_chat(db, chat_id):
+    db.execute("DELETE FROM chat WHERE chat.ID = ?", (chat_id,))
+    db.execute("DELETE FROM message WHERE message.Id_chat = ?", (chat_id,))
+    db.execute("DELETE FROM message_archive WHERE message_archive.Id_chat = ?", (chat_id,))
+    db.execute("DELETE FROM participate WHERE participate.Id_chat = ?", (chat_id,))
+    return []
+
+def _get_chat_participants(db, chat_id):
+    return [db.execute(
+        "SELECT u.Nick, u.IDN, p.Last_message_id FROM participate p, user u WHERE p.Id_chat = ? AND u.ID = p.Id_user",
+        (chat_id,)
+    ).fetchall()]
+
+def _delete_user(db, user_id):
+    db.execute("UPDATE chat SET Founder_id = 1 WHERE Founder_id = ?", (user_id,))
+    db.execute("DELETE FROM user WHERE ID = ?", (user_id,))
+    return []
+
+def _insert_participant(db, user_tag, user_nick, chat_id):
+    # MySQL (not in strict mode) stores 0 in the missing Last_message_id
+    db.execute(
+        "INSERT INTO participate(Id_user, Id_chat, Last_message_id) VALUES(?, ?, 0)",
+        (_search_user_id(db, user_tag, user_nick), chat_id)
+    )
+    return []
+
+def _messages_not_received(db, user_id):
+    return [db.execute(
+        "SELECT p.Id_chat, m.Message_number, u.Nick, u.IDN, m.Timestamp, m.Body "
+        "FROM participate p "
+        "JOIN chat c ON c.ID = p.Id_chat AND c.Message_counter > p.Last_message_id "
+        "JOIN message m ON m.Id_chat = p.Id_chat AND m.Message_number BETWEEN p.Last_message_id + 1 AND c.Message_counter "
+        "JOIN user u ON u.ID = m.Id_sender "
+        "WHERE p.Id_user = ? "
+        "UNION ALL "
+        "SELECT p.Id_chat, a.Message_number, u.Nick, u.IDN, a.Timestamp, a.Body "
+        "FROM participate p "
+        "JOIN chat c ON c.ID = p.Id_chat AND c.Archived_number > p.Last_message_id "
+        "JOIN message_archive a ON a.Id_chat = p.Id_chat AND a.Message_number BETWEEN p.Last_message_id + 1 AND c.Archived_number "
+        "JOIN user u ON u.ID = a.Id_sender "
+        "WHERE p.Id_user = ? "
+        "ORDER BY 1, 2",
+        (user_id, user_id)
+    ).fetchall()]
+
+def _chat_of_a_user(db, user_id):
+    return [db.execute(
+        "SELECT c.ID, c.Name FROM participate p, chat c WHERE p.Id_chat = c.ID AND p.Id_user = ?",
+        (user_id,)
+    ).fetchall()]
+
+def _update_chat_counter(db, chat_id):
+    db.execute("UPDATE chat SET Message_counter = Message_counter + 1 WHERE ID = ?", (chat_id,))
+    return []
+
+def _update_chat_description(db, chat_id, new_description):
+    db.execute("UPDATE chat SET Description = ? WHERE ID = ?", (new_description, chat_id))
+    return []
+
+def _update_chat_name(db, chat_id, new_name):
+    db.execute("UPDATE chat SET Name = ? WHERE ID = ?", (new_name, chat_id))
+    return []
+
+def _update_last_message(db, user_id, chat_id, last_message_id):
+    db.execute(
+        "UPDATE participate SET Last_message_id = ? WHERE Id_user = ? AND Id_chat = ?",
+        (last_message_id, user_id, chat_id)
+    )
+    return []
+
+def _update_user_password(db, user_id, new_password):
+    db.execute("UPDATE user SET User_password = ? WHERE ID = ?", (new_password, user_id))
+    return []
+
+def _update_user_state(db, new_state, user_id):
+    db.execute("UPDATE user SET State = ? WHERE ID = ?", (new_state, user_id))
+    return []
+
+# Functions of queries.sql: they take the connection and the arguments of the call, and return a single value
+def _create_chat(db, chat_name, chat_description, chat_founder, chat_photo):
+    return db.execute(
+        "INSERT INTO chat(Name, Description, Founder_id, Creation_date, Photo, Message_counter) VALUES(?, ?, ?, ?, ?, 0)",
+        (chat_name, chat_description, chat_founder, _today(), chat_photo)
+    ).lastrowid
+
+def _create_message(db, sender_id, chat_id, body):
+    # Only the partecipants of a chat can write in it
+    if not db.execute(
+        "SELECT COUNT(*) FROM participate WHERE Id_user = ? AND Id_chat = ?", (sender_id, chat_id)
+    ).fetchone()[0]:
+        return None
+    # The counter is incremented and read in a single statement (as LAST_INSERT_ID(expr) does in MySQL)
+    counter = db.execute(
+        "UPDATE chat SET Message_counter = Message_counter + 1 WHERE ID = ? RETURNING Message_counter", (chat_id,)
+    ).fetchone()[0]
+    message_id = db.execute(
+        "INSERT INTO message(Id_chat, Id_sender, Body, Timestamp, Message_number) VALUES(?, ?, ?, ?, ?)",
+        (chat_id, sender_id, body, _now(), counter)
+    ).lastrowid
+    # The partecipants of the small chats get the message in their inbox (fan-out on write)
+    db.execute(
+        "INSERT INTO inbox(Id_user, Id_chat, Message_number) SELECT Id_user, Id_chat, ? FROM participate WHERE Id_chat = ? AND Inbox = 1",
+        (counter, chat_id)
+    )
+    return message_id
+
+def _create_user(db, nick, state, comunication_key, user_password):
+    # The tag of a new user is the next one free for its nick
+    tag = db.execute("SELECT max(IDN) FROM user WHERE Nick = ?", (nick,)).fetchone()[0] or 0
+    if tag >= 9999:
+        return 0
+    return db.execute(
+        "INSERT INTO user(IDN, Nick, State, Photo, Last_log_in, Comunication_key, User_password) VALUES(?, ?, ?, '', ?, ?, ?)",
+        (tag + 1, nick, state, _now(), comunication_key, user_password)
+    ).lastrowid
+
+def _search_user_id(db, tag, nick):
+    row = db.execute("SELECT ID FROM user WHERE IDN = ? AND Nick = ?", (tag, nick)).fetchone()
+    return row[0] if row else None
+
+# The names are case insensitive, as in MySQL
+PROCEDURES = {
+    "check_log_in": _check_log_in,
+    "delete_participant": _delete_participant,
+    "get_chat_founder": _get_chat_founder,
+    "delete_chat": _delete_chat,
+    "get_chat_participants": _get_chat_participants,
+    "delete_user": _delete_user,
+    "insert_participant": _insert_participant,
+    "messages_not_received": _messages_not_received,
+    "chat_of_a_user": _chat_of_a_user,
+    "update_chat_counter": _update_chat_counter,
+    "update_chat_description": _update_chat_description,
+    "update_chat_name": _update_chat_name,
+    "update_last_message": _update_last_message,
+    "update_user_password": _update_user_password,
+    "update_user_state": _update_user_state
+}
+FUNCTIONS = {
+    "create_chat": _create_chat,
+    "create_message": _create_message,
+    "create_user": _create_user,
+    "search_user_id": _search_user_id
+}
+# The procedures and functions that only read
+READ_ONLY_ROUTINES = {
+    "check_log_in",
+    "get_chat_founder",
+    "get_chat_participants",
+    "messages_not_received",
+    "chat_of_a_user",
+    "search_user_id"
+}
+
+
+class StoredResult():
+    """
+    The StoredResult class is a result set of a procedure, as returned by stored_results
+    """
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def fetchall(self) -> list:
+        return self.rows
+
+
+class SQLiteCursor():
+    """
+    The SQLiteCursor class is a cursor of a SQLiteConnection, with the interface of the mysql.connector ones.
+    The calls to the functions of queries.sql (Select name(arguments)) and to its procedures are run in Python.
+    """
+    def __init__(self, connection: "SQLiteConnection"):
+        """
+        The constructor of the SQLiteCursor class
+        """
+        self.connection = connection
+        self.cursor = connection.connection.cursor()
+        # The rows of the last function call, and the result sets of the last procedure
+        self.rows = None
+        self.results = []
+        self.description = None
+        self.lastrowid = None
+
+    def execute(self, query: str, args: Any = None):
+        query, args = _to_sqlite(query, args)
+        match = FUNCTION_CALL.match(query)
+        if match and match.group(1).lower() in FUNCTIONS:
+            self.connection.begin(write=match.group(1).lower() not in READ_ONLY_ROUTINES)
+        else:
+            self.connection.begin(write=not READ_STATEMENT.match(query))
+        if match and match.group(1).lower() in FUNCTIONS:
+            # The arguments are evaluated by SQLite, the function by Python
+            arguments = self.cursor.execute("SELECT " + match.group(2), args).fetchone()
+            self.rows = [(FUNCTIONS[match.group(1).lower()](self.cursor, *arguments),)]
+            self.description = ((match.group(1), None, None, None, None, None, None),)
+            return
+        self.rows = None
+        self.cursor.execute(query, args)
+        self.description = self.cursor.description
+        self.lastrowid = self.cursor.lastrowid
+
+    def executemany(self, query: str, args_list: List[Any]):
+        self.connection.begin(write=True)
+        query, _ = _to_sqlite(query, None)
+        self.rows = None
+        self.cursor.executemany(query, [args if isinstance(args, dict) else tuple(args) for args in args_list])
+        self.description = None
+
+    def callproc(self, name: str, args: Sequence = ()) -> Sequence:
+        self.connection.begin(write=name.lower() not in READ_ONLY_ROUTINES)
+        procedure = PROCEDURES.get(name.lower())
+        if procedure is None:
+            raise sqlite3.OperationalError("PROCEDURE {} does not exist".format(name))
+        self.results = [StoredResult(rows) for rows in procedure(self.cursor, *args)]
+        return args
+
+    def stored_results(self) -> Iterator[StoredResult]:
+        return iter(self.results)
+
+    def fetchall(self) -> list:
+        if self.rows is not None:
+            rows, self.rows = self.rows, []
+            return rows
+        return self.cursor.fetchall()
+
+    def fetchone(self) -> Any:
+        if self.rows is not None:
+            return self.rows.pop(0) if self.rows else None
+        return self.cursor.fetchone()
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection():
+    """
+    The SQLiteConnection class is a connection to the SQLite database, with the interface of the mysql.connector ones:
+    every statement runs in a transaction, which lasts until commit or rollback.
+    """
+    def __init__(self, connection: sqlite3.Connection):
+        """
+        The constructor of the SQLiteConnection class
+        """
+        self.connection = connection
+
+    def begin(self, write: bool):
+        """
+        Starts a transaction, unless one is already running.
+        A write transaction takes the write lock immediately: SQLite locks the whole database, and a transaction
+        upgrading from read to write after another one committed would fail instead of waiting.
+        A read transaction is deferred, so that the reads run alongside the writer (on the snapshot of the WAL).
+        The statements run outside of DBMS.transaction start their own transaction, so a read can't be followed by a write
+        """
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+
+    def cursor(self, buffered: bool = False, prepared: bool = False, **kwargs) -> SQLiteCursor:
+        # SQLite reads the rows on demand and caches the compiled statements of each connection by itself
+        return SQLiteCursor(self)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def is_connected(self) -> bool:
+        try:
+            self.connection.execute("SELECT 1").fetchall()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def close(self):
+        self.connection.close()
+
+
+class SQLiteBackend(DBMSBackend):
+    """
+    The SQLiteBackend class runs the database of the server in process, on SQLite.
+    The schema is created on the first connection. The connections of the pool share the database through a file:
+    if no path is given, a new database is created in a temporary directory, deleted by close.
+    Unlike MySQL, SQLite lets one transaction write at a time.
+    """
+    connection_errors = (sqlite3.Error,)
+
+    def __init__(self, path: str = None):
+        """
+        The constructor of the SQLiteBackend class
+        """
+        self.directory = None
+        if path is None:
+            self.directory = tempfile.mkdtemp(prefix="chitchat-")
+            path = os.path.join(self.directory, "chitchat.db")
+        self.path = path
+        self.schema_lock = threading.Lock()
+        self.schema_created = False
+
+    def is_conflict(self, error: Exception) -> bool:
+        # The writers are serialized by the write lock, only a duplicate key can happen
+        return isinstance(error, sqlite3.IntegrityError)
+
+    def begin(self, connection: SQLiteConnection, read_only: bool):
+        # The transactions which may write take the write lock before their first read (see SQLiteConnection.begin)
+        connection.begin(write=not read_only)
+
+    def connect(self, config: dict) -> SQLiteConnection:
+        # The connections of the pool are used by every worker thread, one at a time
+        connection = sqlite3.connect(
+            self.path,
+            timeout=SQLITE_BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+            detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.create_function("now", 0, _now)
+        with self.schema_lock:
+            if not self.schema_created:
+                self._create_schema(connection)
+                self.schema_created = True
+        return SQLiteConnection(connection)
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def _create_schema(self, connection: sqlite3.Connection):
+        """
+        Creates the tables, unless the database already has them
+        """
+        # Readers don't block the writer (and the other way round)
+        connection.execute("PRAGMA journal_mode = WAL")
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user'").fetchone() is None:
+            connection.executescript(SCHEMA)
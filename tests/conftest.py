@@ -0,0 +1,55 @@
+import sys
+sys.path.append('../ChitChat')
+
+import pytest
+import threading
+
+import serverPorts  # server and serverPorts import each other, serverPorts must be imported first
+from server import *
+
+
+def build_server(dbms: Any, worker_threads_count: int = 4, start_workers: bool = False) -> Server:
+    """
+    Builds a server on the given DBMS, without identity, sockets nor watchdog.
+    Its jobs are resolved by calling _resolve, or by its worker threads if they are started (see stop_server)
+    """
+    server = Server.__new__(Server)
+    server.verbose = 0
+    server.worker_threads_count = worker_threads_count
+    server.message_archive_age = None
+    server.inbox_max_chat_size = INBOX_MAX_CHAT_SIZE
+    server.queue = TaggedQueue()
+    server.dbms = dbms
+    server._register_job_handlers()
+    server.worker_signals = [0] * worker_threads_count
+    server.worker_threads = [threading.Thread(target=server._worker_thread, daemon=True, args=(i,)) for i in range(worker_threads_count)]
+    if start_workers:
+        for thread in server.worker_threads:
+            thread.start()
+    return server
+
+
+def stop_server(server: Server):
+    """
+    Stops the worker threads of a server built by build_server, and waits for them
+    """
+    for i in range(len(server.worker_signals)):
+        server.worker_signals[i] = 1
+    for thread in server.worker_threads:
+        if thread.ident is not None:
+            thread.join()
+
+
+@pytest.fixture
+def make_server():
+    # make_server(dbms, worker_threads_count = 4, start_workers = False): the servers are stopped after the test
+    servers = []
+
+    def make(dbms: Any, **kwargs) -> Server:
+        server = build_server(dbms, **kwargs)
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        stop_server(server)
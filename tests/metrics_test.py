@@ -0,0 +1,28 @@
+import sys
+sys.path.append('../ChitChat')
+
+from metrics import Histogram
+
+
+def test_empty_histogram() -> None:
+    h = Histogram()
+    assert h.percentile(50) == 0
+    assert h.snapshot()["count"] == 0
+
+
+def test_percentiles_use_bucket_upper_bounds() -> None:
+    h = Histogram(buckets=(1, 2, 3))
+    for value in (0.5, 0.5, 1.5, 2.5):
+        h.record(value)
+    assert h.percentile(50) == 1
+    assert h.percentile(75) == 2
+    assert h.percentile(100) == 3
+    assert h.snapshot()["average"] == 1.25
+
+
+def test_overflow_bucket_reports_max() -> None:
+    h = Histogram(buckets=(1,))
+    h.record(0.5)
+    h.record(42)
+    assert h.percentile(99) == 42
+    assert h.snapshot()["max"] == 42
@@ -0,0 +1,87 @@
+import sys
+sys.path.append('../ChitChat')
+
+from pytest_mock import MockerFixture
+import pytest
+import socket
+import threading
+import time
+
+import serverPorts  # server and serverPorts import each other, serverPorts must be imported first
+from server import *
+from serverPorts import ClientHandler, SERVER_UNAVAILABLE_ERROR
+from message import Packet, PacketItem
+from User import User
+
+
+@pytest.fixture
+def sockets():
+    # The socket of the handler, and the one of the client
+    handler_socket, client_socket = socket.socketpair()
+    yield handler_socket, client_socket
+    handler_socket.close()
+    client_socket.close()
+
+
+def _handler(mocker: MockerFixture, server: Server, client: socket.socket, packets: list) -> Tuple[ClientHandler, Any]:
+    """
+    Returns a client handler receiving the packets (then disconnecting), and the mock of the packets it sends
+    """
+    server.identity = None
+    mocker.patch("serverPorts.receive_ciphered_message", side_effect=packets + [None])
+    send = mocker.patch("serverPorts.send_ciphered_message")
+    return ClientHandler(client, ("127.0.0.1", 1), None, server, User(2, "alice", "1", "pw", b"key")), send
+
+
+def test_client_gets_errors_while_the_database_is_down(mocker: MockerFixture, make_server, sockets) -> None:
+    server = make_server(DBMS({"host": "primary"}, mocker.MagicMock()), start_workers=True)
+    for _ in range(DB_CIRCUIT_FAILURE_THRESHOLD):
+        server.dbms.pool.breaker.record_failure()
+    assert not server.dbms.is_available()
+    handler, send = _handler(mocker, server, sockets[0], [Packet([
+        PacketItem("msg_get", None),
+        PacketItem("update_chats", None),
+        PacketItem("get_chat", 1),
+        PacketItem("get_chats", [1, 2]),
+        PacketItem("create_chat", ("chat", "", [("bob", 1)])),
+        PacketItem("msg_send", (1, b"hello")),
+        PacketItem("ping", 0)
+    ])])
+    handler.run()
+    assert [(call.args[0][0].type, call.args[0][0].data) for call in send.call_args_list] == [
+        ("error", SERVER_UNAVAILABLE_ERROR),
+        ("error", SERVER_UNAVAILABLE_ERROR),
+        ("error", SERVER_UNAVAILABLE_ERROR),
+        ("error", SERVER_UNAVAILABLE_ERROR),
+        ("create_chat_fail", SERVER_UNAVAILABLE_ERROR),
+        ("error", SERVER_UNAVAILABLE_ERROR),
+        ("pong", 0)
+    ]
+
+
+def test_queued_jobs_are_dropped_when_the_client_disconnects(mocker: MockerFixture, make_server, sockets) -> None:
+    # No worker runs, so the job of the client stays in the queue
+    server = make_server(mocker.MagicMock())
+    handler, send = _handler(mocker, server, sockets[0], [Packet([PacketItem("update_chats", None)])])
+    thread = threading.Thread(target=handler.run)
+    thread.start()
+    while len(server.queue) == 0:
+        time.sleep(0.01)
+    sockets[1].close()
+    # The handler stops waiting long before QUEUE_RESPONSE_TIMEOUT, and takes the job out of the queue
+    thread.join(timeout=QUEUE_RESPONSE_TIMEOUT / 3)
+    assert not thread.is_alive()
+    assert [job.type for job in server.queue.request_queue] == ["set_last_seen"]
+    assert server.queue.cancelled_jobs["update_chats"] == 1
+    assert not send.called
+
+
+def test_client_reads_the_history_of_a_chat(mocker: MockerFixture, make_server, sockets) -> None:
+    dbms = mocker.MagicMock()
+    dbms.execute.return_value = [(1, 3, "bob", 1, None, b"three"), (1, 2, "bob", 1, None, b"two")]
+    server = make_server(dbms, start_workers=True)
+    handler, send = _handler(mocker, server, sockets[0], [Packet([PacketItem("history_get", (1, None)), PacketItem("history_get", (1, 2))])])
+    handler.run()
+    assert [call.args[1]["before"] for call in dbms.execute.call_args_list] == [MAX_MESSAGE_NUMBER, 2]
+    packet = send.call_args_list[0].args[0]
+    assert (packet[0].type, packet[0].data) == ("history", (1, [(1, 2, "bob", 1, None, b"two"), (1, 3, "bob", 1, None, b"three")], False, 2))
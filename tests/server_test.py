@@ -0,0 +1,594 @@
+import sys
+sys.path.append('../ChitChat')
+
+from pytest_mock import MockerFixture
+import pytest
+
+import serverPorts  # server and serverPorts import each other, serverPorts must be imported first
+from server import *
+from server import _statement_name
+
+
+def _mock_connection(mocker: MockerFixture, rows: list = None):
+    connection = mocker.MagicMock()
+    connection.cursor.return_value.fetchall.return_value = rows or []
+    mocker.patch("mysql.connector.connect", return_value=connection)
+    return connection
+
+
+def test_query_puts_result_in_queue(mocker: MockerFixture) -> None:
+    _mock_connection(mocker, [(1,)])
+    q = TaggedQueue()
+    DBMS({"host": "", "user": "", "password": "", "database": ""}).query(q, 1, "Select 1")
+    assert q.responses[1].result == [(1,)]
+
+
+def test_query_without_fetch_signals_completion(mocker: MockerFixture) -> None:
+    connection = _mock_connection(mocker, [(1,)])
+    q = TaggedQueue()
+    DBMS({"host": "", "user": "", "password": "", "database": ""}).query(q, 1, "Update_user_state", (1, 1), procedure=True, fetch=False)
+    assert q.responses[1].result == []
+    connection.commit.assert_called_once()
+
+
+def test_no_reply_query_does_not_touch_the_queue(mocker: MockerFixture) -> None:
+    connection = _mock_connection(mocker)
+    q = TaggedQueue()
+    DBMS({"host": "", "user": "", "password": "", "database": ""}).query(q, None, "Update_user_state", (1, 1), procedure=True, no_reply=True)
+    assert q.responses == {}
+    assert q.waiters == {}
+    connection.commit.assert_called_once()
+    connection.cursor.return_value.stored_results.assert_not_called()
+
+
+def test_create_chat_runs_inline(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    transaction.execute.side_effect = [
+        [(2,)],                                         # the partecipants exist
+        [(7,)],                                         # create_chat
+        [                                               # chat info and partecipants
+            (7, "chat", "description", "2022-11-02", "creator", 1, 0),
+            (7, "chat", "description", "2022-11-02", "friend", 2, 0)
+        ]
+    ]
+    tag = server.create_chat(User(1, "creator", 1, "password", b""), "chat", "description", [("friend", 2), ("Friend", "2")])
+    server._create_chat(server.queue.next())
+    # No sub-job was queued for another worker
+    assert len(server.queue) == 0
+    # The partecipants are checked with one query, and inserted with one statement
+    assert transaction.execute.call_args_list[0].args[1] == {"nick0": "Friend", "idn0": "2"}
+    transaction.executemany.assert_called_once()
+    # A small chat: its messages are delivered through the inboxes
+    assert transaction.executemany.call_args.args[1] == [(1, 7, 1), (2, 7, 1)]
+    response = server.queue.wait_for_result(tag, timeout=0)
+    assert response["chat_id"] == 7
+    assert response["partecipants"] == [("creator", 1, 0), ("friend", 2, 0)]
+
+
+def test_create_chat_left_by_everybody_at_once(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    # The chat was deleted before its details were read
+    transaction.execute.side_effect = [[(2,)], [(7,)], []]
+    tag = server.create_chat(User(1, "creator", 1, "password", b""), "chat", "description", [("friend", 2)])
+    server._create_chat(server.queue.next())
+    response = server.queue.wait_for_result(tag, timeout=0)
+    assert response.result == "Chat does not exist"
+    packet = serverPorts.ClientHandler.create_chat_packet(response)
+    assert (packet[0].type, packet[0].data) == ("create_chat_fail", "Chat does not exist")
+
+
+def test_create_chat_with_unknown_user(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    transaction.execute.side_effect = [[(2,)]]
+    tag = server.create_chat(User(1, "creator", 1, "password", b""), "chat", "description", [("friend", 2), ("nobody", 3)])
+    server._create_chat(server.queue.next())
+    assert server.queue.wait_for_result(tag, timeout=0).result == "User does not exist"
+    # The chat was never created
+    assert transaction.execute.call_count == 1
+    transaction.executemany.assert_not_called()
+
+
+def test_register_tries_again_when_a_concurrent_one_took_the_tag(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    server.dbms.backend = MySQLBackend()
+    server.dbms.execute.side_effect = [mysql.connector.errors.IntegrityError(errno=1062), [(5,)]]
+    tag = server.register("alice", "pw", b"")
+    server._resolve(server.queue.next())
+    assert server.queue.wait_for_result(tag, timeout=0).result == [(5,)]
+    # Any other error is not tried again
+    server.dbms.execute.side_effect = [mysql.connector.errors.IntegrityError(errno=1048), [(6,)]]
+    tag = server.register("bob", "pw", b"")
+    server._resolve(server.queue.next())
+    assert server.queue.wait_for_result(tag, timeout=0).result is None
+    assert server.dbms.execute.call_count == 3
+
+
+def test_transaction_commits_once(mocker: MockerFixture) -> None:
+    connection = _mock_connection(mocker, [(7,)])
+    dbms = DBMS({"host": "", "user": "", "password": "", "database": ""})
+    with dbms.transaction() as transaction:
+        assert transaction.execute("SELECT create_chat(%(name)s)", {"name": "chat"}) == [(7,)]
+        transaction.executemany("Insert into participate(Id_user, Id_chat, Last_message_id) values (%s, %s, 0)", [(1, 7), (2, 7)])
+    connection.commit.assert_called_once()
+    mysql.connector.connect.assert_called_once()
+    assert dbms.pool.stats()["idle"] == 1
+
+
+def test_transaction_rolls_back_on_failure(mocker: MockerFixture) -> None:
+    connection = _mock_connection(mocker)
+    dbms = DBMS({"host": "", "user": "", "password": "", "database": ""})
+    with pytest.raises(ValueError):
+        with dbms.transaction() as transaction:
+            transaction.execute("SELECT create_chat(%(name)s)", {"name": "chat"})
+            raise ValueError("insert failed")
+    connection.commit.assert_not_called()
+    connection.rollback.assert_called_once()
+    assert dbms.pool.stats()["idle"] == 1
+
+
+def test_set_status_batch_keeps_last_status_per_user(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    server.set_status(1, 1)
+    server.set_status(2, 2)
+    server.set_status(1, 3)
+    server._set_status(server._next_batch(server.queue.next()))
+    assert len(server.queue) == 0
+    server.dbms.query.assert_called_once()
+    query, args = server.dbms.query.call_args.args[2:4]
+    assert query.count("When") == 2
+    assert args == {"user_id0": 1, "status0": 3, "user_id1": 2, "status1": 2}
+
+
+def test_set_last_seen_batch(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    for user_id in (1, 2, 1):
+        server.set_last_seen(user_id)
+    server._set_last_seen(server._next_batch(server.queue.next()))
+    server.dbms.query.assert_called_once()
+    assert server.dbms.query.call_args.args[3] == {"user_id0": "1", "user_id1": "2"}
+
+
+def test_unknown_job_type_fails_fast(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    with pytest.raises(ValueError):
+        server._put_request(Job("get", {}))
+    assert len(server.queue) == 0
+
+
+def test_failing_job_is_answered_right_away(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    server.dbms.query.side_effect = Exception("DB down")
+    tag = server.login("user", 1, "password")
+    server._resolve(server.queue.next())
+    assert server.queue.wait_for_result(tag, timeout=0).result is None
+    assert server.queue.running_jobs["login"] == 0
+
+
+def test_create_chat_concurrency_is_limited(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    creator = User(1, "creator", 1, "password", b"")
+    for _ in range(3):
+        server.create_chat(creator, "chat", "description", [])
+    tag = server.login("user", 1, "password")
+    # Only half of the workers can create chats: the login job overtakes the third chat
+    taken = [server.queue.next() for _ in range(3)]
+    assert [job.type for job in taken] == ["create_chat", "create_chat", "login"]
+    assert server.queue.next() is None
+    server.queue.job_done(taken[0])
+    assert server.queue.next().type == "create_chat"
+
+
+def test_pool_reuses_connections(mocker: MockerFixture) -> None:
+    _mock_connection(mocker, [(1,)])
+    dbms = DBMS({"host": "", "user": "", "password": "", "database": ""})
+    dbms.execute("Select 1")
+    dbms.execute("Select 1")
+    mysql.connector.connect.assert_called_once()
+    assert dbms.pool.stats()["idle"] == 1
+    assert dbms.pool.stats()["checkout_wait"]["count"] == 2
+
+
+def test_pool_discards_broken_connections(mocker: MockerFixture) -> None:
+    connection = _mock_connection(mocker)
+    connection.cursor.return_value.execute.side_effect = Exception("Lost connection")
+    connection.rollback.side_effect = Exception("Lost connection")
+    dbms = DBMS({"host": "", "user": "", "password": "", "database": ""})
+    with pytest.raises(Exception):
+        dbms.execute("Select 1")
+    assert dbms.pool.stats()["open"] == 0
+    assert dbms.pool.stats()["discarded"] == 1
+
+
+def test_pool_waits_for_a_released_connection(mocker: MockerFixture) -> None:
+    pool = ConnectionPool(mocker.MagicMock, size=1, checkout_timeout=5)
+    connection = pool.acquire()
+    threading.Timer(0.05, pool.release, args=(connection,)).start()
+    assert pool.acquire() is connection
+    assert pool.stats()["connects"] == 1
+
+
+def test_pool_checkout_timeout(mocker: MockerFixture) -> None:
+    pool = ConnectionPool(mocker.MagicMock, size=1, checkout_timeout=0.01)
+    pool.acquire()
+    with pytest.raises(Exception):
+        pool.acquire()
+
+
+def test_pool_recycles_idle_connections(mocker: MockerFixture) -> None:
+    pool = ConnectionPool(mocker.MagicMock, size=2, idle_timeout=0.01)
+    connection = pool.acquire()
+    pool.release(connection)
+    time.sleep(0.02)
+    pool.recycle_idle()
+    connection.close.assert_called_once()
+    assert pool.stats()["open"] == 0
+
+
+def test_pool_replaces_unhealthy_connections_in_their_slot(mocker: MockerFixture) -> None:
+    pool = ConnectionPool(mocker.MagicMock, size=1, checkout_timeout=0.01, health_check_interval=0)
+    connection = pool.acquire()
+    connection.is_connected.return_value = False
+    pool.release(connection)
+    replacement = pool.acquire()
+    assert replacement is not connection
+    connection.close.assert_called_once()
+    assert pool.stats()["open"] == 1
+    assert pool.stats()["discarded"] == 1
+    # The pool is still full
+    with pytest.raises(Exception):
+        pool.acquire()
+
+
+def test_pool_frees_the_slot_once_if_the_replacement_fails(mocker: MockerFixture) -> None:
+    connect = mocker.MagicMock()
+    pool = ConnectionPool(connect, size=1, health_check_interval=0)
+    connection = pool.acquire()
+    connection.is_connected.return_value = False
+    pool.release(connection)
+    connect.side_effect = Exception("Can't connect")
+    with pytest.raises(Exception):
+        pool.acquire()
+    assert pool.stats()["open"] == 0
+
+
+def test_queries_are_prepared_once_per_connection(mocker: MockerFixture) -> None:
+    connection = _mock_connection(mocker, [(1,)])
+    dbms = DBMS({"host": "", "user": "", "password": "", "database": ""})
+    assert dbms.execute("Select IDN from user where ID = %(userid)s", {"userid": 1}) == [(1,)]
+    dbms.execute("Select IDN from user where ID = %(userid)s", {"userid": 2})
+    connection.cursor.assert_called_once_with(prepared=True)
+    connection.cursor.return_value.execute.assert_called_with("Select IDN from user where ID = %s", (2,))
+    stats = dbms.statement_cache_stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_statement_cache_evicts_least_recently_used(mocker: MockerFixture) -> None:
+    counters = Counter()
+    cache = StatementCache(mocker.MagicMock(), 2, counters, threading.Lock())
+    first = cache.get("Select 1")
+    cache.get("Select 2")
+    cache.get("Select 1")
+    cache.get("Select 3")
+    assert list(cache.statements) == ["Select 1", "Select 3"]
+    assert cache.get("Select 1") is first
+    assert counters == {"hits": 2, "misses": 3, "evictions": 1}
+
+
+def test_get_chats_in_one_query(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    transaction.execute.return_value = [
+        (8, "second", "", "2022-11-02", "user", 1, 3),
+        (7, "first", "", "2022-11-01", "user", 1, 0),
+        (7, "first", "", "2022-11-01", "friend", 2, 5)
+    ]
+    # The user is not partecipant of chat 9
+    tag = server.get_chats(1, [7, 8, 9, 7])
+    server._resolve(server.queue.next())
+    transaction.execute.assert_called_once()
+    query, args = transaction.execute.call_args.args
+    assert args == {"user_id": 1, "chat_id0": 7, "chat_id1": 8, "chat_id2": 9}
+    chats = server.queue.wait_for_result(tag, timeout=0).result
+    assert [chat["chat_id"] for chat in chats] == [7, 8]
+    assert chats[0]["partecipants"] == [("user", 1, 0), ("friend", 2, 5)]
+
+
+def test_get_chat_of_another_user(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    server.dbms.transaction.return_value.__enter__.return_value.execute.return_value = []
+    tag = server.get_chat(1, "user", 1, 9)
+    server._resolve(server.queue.next())
+    assert server.queue.wait_for_result(tag, timeout=0).result == []
+
+
+def test_get_unread_messages_advances_every_chat_at_once(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    messages = [
+        (7, 1, "friend", 2, "2022-11-02", b"hello"),
+        (7, 2, "friend", 2, "2022-11-02", b"how are you?"),
+        (8, 5, "other", 3, "2022-11-02", b"hi")
+    ]
+    transaction.execute.side_effect = [[(7, 0, 0, 2), (8, 4, 0, 5)], messages, []]
+    tag = server.get_unread_messages(1)
+    server._resolve(server.queue.next())
+    assert transaction.execute.call_count == 3
+    # The inbox, and one range per chat, from its last read message
+    query, args = transaction.execute.call_args_list[1].args
+    assert query.count("Union All") == 2
+    assert args == {"user_id": 1, "after_chat": 0, "after_number": 0, "limit": 501, "chat_id0": 7, "from0": 0, "chat_id1": 8, "from1": 4}
+    query, args = transaction.execute.call_args.args
+    assert query.startswith("Update participate")
+    assert args == {"user_id": 1, "chat_id0": 7, "last_id0": 2, "chat_id1": 8, "last_id1": 5}
+    assert server.queue.wait_for_result(tag, timeout=0).result == {"messages": messages, "more": False, "cursor": (8, 5)}
+
+
+def test_get_unread_messages_pages_by_rows(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    messages = [(7, number, "friend", 2, "2022-11-02", b"hi") for number in range(1, 4)]
+    transaction.execute.side_effect = [[(7, 0, 0, 3)], messages, []]
+    tag = server.get_unread_messages(1, after=(7, 0), max_rows=2)
+    server._resolve(server.queue.next())
+    query, args = transaction.execute.call_args_list[0].args
+    assert "Limit %(limit)s" in query
+    assert args == {"user_id": 1, "after_chat": 7, "after_number": 0, "limit": 3}
+    assert transaction.execute.call_args_list[1].args[1] == {"user_id": 1, "after_chat": 7, "after_number": 0, "limit": 3, "chat_id0": 7, "from0": 0}
+    # Only the delivered messages are marked as read
+    assert transaction.execute.call_args.args[1] == {"user_id": 1, "chat_id0": 7, "last_id0": 2}
+    assert server.queue.wait_for_result(tag, timeout=0).result == {"messages": messages[:2], "more": True, "cursor": (7, 2)}
+
+
+def test_get_unread_messages_pages_by_bytes(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    messages = [(7, 1, "friend", 2, "2022-11-02", b"x" * 10), (8, 1, "other", 3, "2022-11-02", b"y" * 10)]
+    transaction.execute.side_effect = [[(7, 0, 0, 1), (8, 0, 0, 1)], messages, []]
+    tag = server.get_unread_messages(1, max_bytes=5)
+    server._resolve(server.queue.next())
+    # A message bigger than the budget is still delivered alone
+    assert server.queue.wait_for_result(tag, timeout=0).result == {"messages": messages[:1], "more": True, "cursor": (7, 1)}
+
+
+def test_get_unread_messages_without_unread_chats_reads_no_message(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    server.dbms.reads_from_replica.return_value = False
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    transaction.execute.return_value = []
+    tag = server.get_unread_messages(1)
+    server._resolve(server.queue.next())
+    # The chats are found without reading their messages, and the inbox is a range of its primary key
+    assert transaction.execute.call_count == 2
+    assert "From participate p Join chat c" in transaction.execute.call_args_list[0].args[0]
+    query = transaction.execute.call_args.args[0]
+    assert "From inbox i" in query and "Union All" not in query
+    assert server.queue.wait_for_result(tag, timeout=0).result == {"messages": [], "more": False, "cursor": (0, 0)}
+
+
+def test_get_unread_messages_resumes_the_chat_of_the_cursor(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    transaction.execute.side_effect = [[(7, 2, 0, 6), (8, 0, 0, 1)], [], []]
+    server.get_unread_messages(1, after=(7, 5), max_rows=1)
+    server._resolve(server.queue.next())
+    # The pages after the first one start after the cursor, and never read more chats than messages
+    assert transaction.execute.call_args_list[0].args[1]["limit"] == 2
+    assert transaction.execute.call_args_list[1].args[1] == {"user_id": 1, "after_chat": 7, "after_number": 5, "limit": 2, "chat_id0": 7, "from0": 5}
+
+
+def test_get_unread_messages_reads_only_the_chats_filling_the_page(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    messages = [(7, number, "friend", 2, "2022-11-02", b"hi") for number in range(1, 4)]
+    # Chat 7 alone has more unread messages than the page
+    transaction.execute.side_effect = [[(7, 0, 0, 5), (8, 0, 0, 1)], messages, []]
+    tag = server.get_unread_messages(1, max_rows=2)
+    server._resolve(server.queue.next())
+    query, args = transaction.execute.call_args_list[1].args
+    assert "chat_id1" not in args and "unread1" not in query
+    assert server.queue.wait_for_result(tag, timeout=0).result == {"messages": messages[:2], "more": True, "cursor": (7, 2)}
+
+
+def test_get_unread_messages_empties_the_inbox_as_it_goes(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    # Chat 7 is read from its counter, chat 9 from the inbox of the user
+    messages = [(7, 1, "friend", 2, "2022-11-02", b"hello"), (9, 3, "other", 3, "2022-11-02", b"hi")]
+    transaction.execute.side_effect = [[(7, 0, 0, 1)], messages, [], []]
+    tag = server.get_unread_messages(1)
+    server._resolve(server.queue.next())
+    assert transaction.execute.call_count == 4
+    query, args = transaction.execute.call_args.args
+    assert query.startswith("Delete From inbox")
+    assert args == {"user_id": 1, "chat_id0": 9, "last_id0": 3}
+    assert server.queue.wait_for_result(tag, timeout=0).result["messages"] == messages
+
+
+def test_get_unread_messages_reads_the_archive_only_below_its_number(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    transaction = server.dbms.transaction.return_value.__enter__.return_value
+    # The partecipant of chat 8 was added after some of its messages were archived
+    transaction.execute.side_effect = [[(7, 4, 3, 5), (8, 0, 6, 9)], [], []]
+    server.get_unread_messages(1)
+    server._resolve(server.queue.next())
+    query = transaction.execute.call_args_list[1].args[0]
+    assert query.count("From message_archive m") == 1
+    assert "As unread1_message_archive" in query
+
+
+def test_reads_are_routed_to_replicas(mocker: MockerFixture) -> None:
+    backend = mocker.MagicMock()
+    backend.connect.side_effect = lambda config: mocker.MagicMock(host=config["host"])
+    dbms = DBMS({"host": "primary", "replicas": [{"host": "replica1"}, {"host": "replica2"}]}, backend)
+    hosts = lambda: [call.args[0]["host"] for call in backend.connect.call_args_list]
+    dbms.execute("Select 1", read_only=True)
+    dbms.execute("Select 1", read_only=True)
+    dbms.execute("Update user Set State = 1")
+    assert hosts() == ["replica1", "replica2", "primary"]
+    # The session reads its own writes on the primary
+    dbms.record_write("session")
+    assert not dbms.reads_from_replica("session")
+    assert dbms.reads_from_replica("other session")
+    with dbms.transaction(read_only=True, session="session") as transaction:
+        assert transaction.pool is dbms.pool
+    mocker.patch("time.monotonic", return_value=time.monotonic() + DB_REPLICA_READ_YOUR_WRITES_WINDOW + 1)
+    assert dbms.reads_from_replica("session")
+    dbms.recycle_idle()
+    assert dbms.session_writes == {}
+
+
+def test_replicas_lagging_behind_are_not_read_from(mocker: MockerFixture) -> None:
+    backend = mocker.MagicMock()
+    backend.connect.side_effect = lambda config: mocker.MagicMock(host=config["host"])
+    backend.replication_lag.side_effect = lambda connection: {"replica1": 0.0, "replica2": 30.0}[connection.host]
+    dbms = DBMS({"host": "primary", "replicas": [{"host": "replica1"}, {"host": "replica2"}]}, backend)
+    dbms.measure_replica_lags()
+    assert [replica["lag"] for replica in dbms.replica_stats()] == [0.0, 30.0]
+    assert {dbms._pool(True, None) for _ in range(4)} == {dbms.replica_pools[0]}
+    # A replica whose lag can't be measured is still read from
+    backend.replication_lag.side_effect = Exception("no status")
+    dbms.measure_replica_lags()
+    assert [replica["lag"] for replica in dbms.replica_stats()] == [None, None]
+    assert {dbms._pool(True, None) for _ in range(4)} == set(dbms.replica_pools)
+
+
+def test_without_replicas_everything_runs_on_the_primary(mocker: MockerFixture) -> None:
+    dbms = DBMS({"host": ""}, mocker.MagicMock())
+    dbms.record_write("session")
+    assert not dbms.reads_from_replica()
+    assert dbms.transaction(read_only=True).pool is dbms.pool
+    assert dbms.session_writes == {}
+
+
+def test_empty_unread_poll_is_answered_by_a_replica(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    server.dbms.reads_from_replica.return_value = True
+    server.dbms.execute.return_value = []
+    tag = server.get_unread_messages(1, session="session")
+    server._resolve(server.queue.next())
+    assert server.dbms.execute.call_args.kwargs == {"read_only": True, "session": "session", "job_tag": tag}
+    server.dbms.transaction.assert_not_called()
+    assert server.queue.wait_for_result(tag, timeout=0).result == {"messages": [], "more": False, "cursor": (0, 0)}
+
+
+def test_send_message_records_the_write_of_the_session(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    server.dbms.execute.return_value = [(12,)]
+    tag = server.send_message(1, 7, b"hello", session="session")
+    server._resolve(server.queue.next())
+    server.dbms.record_write.assert_called_once_with("session")
+    assert server.queue.wait_for_result(tag, timeout=0).result == [(12,)]
+
+
+def test_statement_name_groups_batches() -> None:
+    assert _statement_name("Check_Log_In", True) == "Check_Log_In"
+    assert _statement_name("Select create_message(%(sender_id)s, %(chat_id)s, %(message)s)", False) == "create_message"
+    assert _statement_name("Select count(*) from user", False) == "Select count(*) from user"
+    one = _statement_name("Update user Set State = Case ID When %(user_id0)s Then %(status0)s End Where ID in (%(user_id0)s)", False)
+    two = _statement_name("Update user Set State = Case ID When %(user_id0)s Then %(status0)s When %(user_id1)s Then %(status1)s End Where ID in (%(user_id0)s, %(user_id1)s)", False)
+    assert one == two == "Update user Set State = Case ID When ? Then ? ... End Where ID in (?, ...)"
+
+
+def test_statement_timings_and_slow_query_log(mocker: MockerFixture, tmp_path) -> None:
+    connection = _mock_connection(mocker, [(12,)])
+    log = tmp_path / "slow.log"
+    dbms = DBMS({"host": "", "user": "", "password": "", "database": "", "slow_query_threshold": 0.05, "slow_query_log": str(log)})
+    dbms.execute("Select create_message(%(sender_id)s, %(chat_id)s, %(message)s)", {"sender_id": 1, "chat_id": 7, "message": b"secret"}, job_tag=3)
+    assert dbms.slow_query_stats() == []
+    # The next statement takes longer than the threshold
+    connection.cursor.return_value.fetchall.side_effect = lambda: time.sleep(0.06) or [(13,)]
+    dbms.execute("Select create_message(%(sender_id)s, %(chat_id)s, %(message)s)", {"sender_id": 1, "chat_id": 7, "message": b"secret"}, job_tag=4, prepare=False)
+    stats = dbms.statement_stats()["create_message"]
+    assert stats["total"]["count"] == 2
+    assert stats["connect"]["count"] == 2
+    assert stats["fetch"]["max"] >= 0.06
+    [entry] = dbms.slow_query_stats()
+    assert entry["job_tag"] == 4
+    assert entry["args"] == {"sender_id": 1, "chat_id": 7, "message": "<redacted 6 bytes>"}
+    assert "job#4 create_message" in log.read_text()
+    assert "secret" not in log.read_text()
+
+
+def test_slow_query_log_is_written_without_holding_the_lock(mocker: MockerFixture, tmp_path) -> None:
+    dbms = DBMS({"host": "", "slow_query_threshold": 0, "slow_query_log": str(tmp_path / "slow.log")}, mocker.MagicMock())
+    opened = mocker.patch("builtins.open", side_effect=lambda *args, **kwargs: (
+        pytest.fail("the log is written holding the lock") if dbms.slow_queries_lock.locked() else mocker.MagicMock()
+    ))
+    dbms._record_timing("create_message", 1, {}, None, 0.1, 0.0)
+    opened.assert_called_once()
+    assert len(dbms.slow_query_stats()) == 1
+
+
+def test_transaction_charges_the_connection_wait_to_its_first_statement(mocker: MockerFixture) -> None:
+    _mock_connection(mocker, [(7,)])
+    dbms = DBMS({"host": "", "user": "", "password": "", "database": ""})
+    with dbms.transaction(job_tag=5) as transaction:
+        transaction.execute("Select 1")
+        transaction.execute("Select 1")
+        transaction.executemany("Insert into participate(Id_user, Id_chat, Last_message_id) values (%s, %s, 0)", [(1, 7), (2, 7)])
+    stats = dbms.statement_stats()
+    assert stats["Select 1"]["connect"]["count"] == 1
+    assert stats["Select 1"]["execute"]["count"] == 2
+    assert stats["Insert into participate(Id_user, Id_chat, Last_message_id) values (?, ?, 0)"]["total"]["count"] == 1
+
+
+def test_circuit_opens_after_failed_connections_and_fails_fast(mocker: MockerFixture) -> None:
+    connect = mocker.MagicMock(side_effect=DBMSUnavailable("down"))
+    pool = ConnectionPool(connect, size=2, breaker=CircuitBreaker(failure_threshold=2, probe_interval=0))
+    for _ in range(2):
+        with pytest.raises(DBMSUnavailable):
+            pool.acquire()
+    assert pool.breaker.is_open()
+    # No more connections are attempted by the callers
+    with pytest.raises(DBMSUnavailable):
+        pool.acquire()
+    assert connect.call_count == 2
+    assert pool.stats()["circuit"]["rejected"] == 1
+    # The probe reconnects, and the connection it opened is used
+    assert not pool.probe()
+    connect.side_effect = None
+    assert pool.probe()
+    assert not pool.breaker.is_open()
+    assert pool.acquire() is connect.return_value
+    assert connect.call_count == 4
+    assert pool.stats()["open"] == 1
+
+
+def test_probe_waits_for_the_interval(mocker: MockerFixture) -> None:
+    breaker = CircuitBreaker(failure_threshold=1, probe_interval=60)
+    breaker.record_failure()
+    assert not breaker.probe_due()
+    mocker.patch("time.monotonic", return_value=time.monotonic() + 61)
+    assert breaker.probe_due()
+    assert not breaker.probe_due()
+
+
+def test_degraded_jobs_are_answered_at_once(mocker: MockerFixture, make_server) -> None:
+    backend = mocker.MagicMock(connection_errors=(ConnectionError,))
+    backend.connect.side_effect = ConnectionError("down")
+    server = make_server(DBMS({"host": "primary"}, backend))
+    for _ in range(DB_CIRCUIT_FAILURE_THRESHOLD + 2):
+        tag = server.get_userid_info(1)
+        server._resolve(server.queue.next())
+        assert server.queue.wait_for_result(tag, timeout=0).result is None
+    assert not server.dbms.is_available()
+    assert backend.connect.call_count == DB_CIRCUIT_FAILURE_THRESHOLD
+
+
+def test_reads_skip_replicas_that_are_down(mocker: MockerFixture) -> None:
+    backend = mocker.MagicMock()
+    dbms = DBMS({"host": "primary", "replicas": [{"host": "replica"}]}, backend)
+    for _ in range(DB_CIRCUIT_FAILURE_THRESHOLD):
+        dbms.replica_pools[0].breaker.record_failure()
+    dbms.execute("Select 1", read_only=True)
+    assert backend.connect.call_args.args[0]["host"] == "primary"
+
+
+def test_user_tag_of_a_new_user_is_read_from_the_primary(mocker: MockerFixture, make_server) -> None:
+    server = make_server(mocker.MagicMock())
+    server.get_userid_info(3)
+    server._resolve(server.queue.next())
+    assert not server.dbms.query.call_args.kwargs.get("read_only", False)
@@ -0,0 +1,234 @@
+import sys
+sys.path.append('../ChitChat')
+
+from pytest_mock import MockerFixture
+import pytest
+import datetime
+
+import serverPorts  # server and serverPorts import each other, serverPorts must be imported first
+from server import *
+from sqlite_backend import *
+from sqlite_backend import _to_sqlite
+
+
+@pytest.fixture
+def backend():
+    backend = SQLiteBackend()
+    yield backend
+    backend.close()
+
+
+def _call(server: Server, job_tag: int) -> Any:
+    server._resolve(server.queue.next())
+    return server.queue.wait_for_result(job_tag, timeout=0).result
+
+
+def _archive(server: Server, before: datetime.datetime):
+    server.archive_messages(before)
+    server._resolve(server.queue.next())
+
+
+def test_translates_placeholders() -> None:
+    assert _to_sqlite("Select %(a)s, %s, '%%'", None)[0] == "Select :a, ?, '%'"
+
+
+def test_backends_must_implement_connect() -> None:
+    with pytest.raises(TypeError):
+        DBMSBackend()
+
+
+def test_functions_and_procedures(backend: SQLiteBackend) -> None:
+    dbms = DBMS({}, backend)
+    user_id = dbms.execute("Select create_user(%(nick)s, 0, %(key)s, %(password)s)", {"nick": "alice", "key": b"key", "password": "pw"})[0][0]
+    # The tags of a nick are given in order
+    assert dbms.execute("Select create_user(%s, 0, %s, %s)", ("Alice", b"key", "pw"), prepare=False) == [(user_id + 1,)]
+    assert dbms.execute("Check_log_in", (1, "ALICE", "pw"), procedure=True) == [(user_id, b"key")]
+    assert dbms.execute("Select Search_user_id(2, 'alice')") == [(user_id + 1,)]
+    with pytest.raises(Exception):
+        dbms.execute("Missing_procedure", (), procedure=True)
+
+
+def test_rollback_keeps_nothing(backend: SQLiteBackend) -> None:
+    dbms = DBMS({}, backend)
+    with pytest.raises(ValueError):
+        with dbms.transaction() as transaction:
+            transaction.execute("Select create_user('bob', 0, '', 'pw')")
+            raise ValueError()
+    assert dbms.execute("Select count(*) from user") == [(1,)]
+
+
+def test_reads_do_not_wait_for_the_writer(backend: SQLiteBackend) -> None:
+    dbms = DBMS({}, backend)
+    with dbms.transaction() as transaction:
+        transaction.execute("Select create_user('bob', 0, '', 'pw')")
+        # The write lock is held until the commit, the reads see the database as it was
+        assert dbms.execute("Select count(*) from user") == [(1,)]
+        assert dbms.execute("Check_log_in", (1, "bob", "pw"), procedure=True) == []
+        with dbms.transaction(read_only=True) as reader:
+            assert reader.execute("Select Search_user_id(1, 'bob')") == [(None,)]
+    assert dbms.execute("Select count(*) from user") == [(2,)]
+
+
+def test_server_end_to_end(backend: SQLiteBackend, make_server) -> None:
+    server = make_server(DBMS({}, backend))
+    alice = _call(server, server.register("alice", "pw", b"alice key"))[0][0]
+    bob = _call(server, server.register("bob", "pw", b"bob key"))[0][0]
+    assert _call(server, server.login("alice", 1, "pw")) == [(alice, b"alice key")]
+
+    creator = User(alice, "alice", "1", "pw", b"alice key")
+    chat = _call(server, server.create_chat(creator, "chat", "description", [("BOB", 1)]))
+    assert chat["chat_name"] == "chat"
+    assert isinstance(chat["creation_date"], datetime.date)
+    assert sorted(user[0] for user in chat["partecipants"]) == ["alice", "bob"]
+    assert _call(server, server.create_chat(creator, "chat", "", [("carol", 1)])) == "User does not exist"
+
+    for body in (b"hello", b"how are you?"):
+        _call(server, server.send_message(alice, chat["chat_id"], body))
+    # Only the partecipants can write
+    assert _call(server, server.send_message(1, chat["chat_id"], b"spam")) == [(None,)]
+
+    page = _call(server, server.get_unread_messages(bob, max_rows=1))
+    assert [message[5] for message in page["messages"]] == [b"hello"]
+    assert isinstance(page["messages"][0][4], datetime.datetime)
+    assert page["more"]
+    page = _call(server, server.get_unread_messages(bob, after=page["cursor"]))
+    assert [message[5] for message in page["messages"]] == [b"how are you?"]
+    assert not page["more"]
+    assert _call(server, server.get_unread_messages(bob))["messages"] == []
+
+    assert _call(server, server.update_chats(bob)) == [(chat["chat_id"], "chat")]
+    server.set_status(bob, 2)
+    server._resolve(server.queue.next())
+    assert server.dbms.execute("Select State from user where ID = %s", (bob,)) == [(2,)]
+
+
+def test_concurrent_senders_get_distinct_numbers(backend: SQLiteBackend) -> None:
+    dbms = DBMS({"pool_size": 8}, backend)
+    senders = [dbms.execute("Select create_user(%s, 0, '', 'pw')", ("user{}".format(i),))[0][0] for i in range(8)]
+    chat_id = dbms.execute("Select create_chat('hot', '', %s, '')", (senders[0],))[0][0]
+    with dbms.transaction() as transaction:
+        transaction.executemany("Insert into participate(Id_user, Id_chat, Last_message_id) values (%s, %s, 0)", [(sender, chat_id) for sender in senders])
+    ids = []
+    def send(sender):
+        for _ in range(10):
+            ids.append((sender, dbms.execute("Select create_message(%s, %s, 'hi')", (sender, chat_id))[0][0]))
+    threads = [threading.Thread(target=send, args=(sender,)) for sender in senders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rows = dbms.execute("Select ID, Id_sender, Message_number from message where Id_chat = %s", (chat_id,))
+    assert sorted(number for _, _, number in rows) == list(range(1, 81))
+    # Every sender got the id of its own message
+    assert sorted(ids) == sorted((sender, message_id) for message_id, sender, _ in rows)
+    with pytest.raises(Exception):
+        dbms.execute("Insert into message(Id_chat, Id_sender, Body, Timestamp, Message_number) values (%s, %s, '', now(), 1)", (chat_id, senders[0]))
+
+
+def test_unread_messages_are_paged_across_chats(backend: SQLiteBackend, make_server) -> None:
+    server = make_server(DBMS({}, backend))
+    alice = _call(server, server.register("alice", "pw", b""))[0][0]
+    bob = _call(server, server.register("bob", "pw", b""))[0][0]
+    creator = User(alice, "alice", "1", "pw", b"")
+    chat_ids = [_call(server, server.create_chat(creator, "chat", "", [("bob", 1)]))["chat_id"] for _ in range(3)]
+    for chat_id in chat_ids:
+        for body in (b"one", b"two"):
+            _call(server, server.send_message(alice, chat_id, body))
+    # The procedure sees what the pages will deliver
+    assert len(server.dbms.execute("Messages_not_received", (bob,), procedure=True)) == 6
+    delivered = []
+    after = None
+    while True:
+        page = _call(server, server.get_unread_messages(bob, after=after, max_rows=4))
+        delivered += [(message[0], message[1]) for message in page["messages"]]
+        if not page["more"]:
+            break
+        after = page["cursor"]
+    assert delivered == [(chat_id, number) for chat_id in chat_ids for number in (1, 2)]
+    assert server.dbms.execute("Messages_not_received", (bob,), procedure=True) == []
+
+
+def test_users_are_looked_up_by_nick_and_tag(backend: SQLiteBackend) -> None:
+    dbms = DBMS({}, backend)
+    dbms.execute("Select create_user('alice', 0, '', 'pw')")
+    plan = dbms.execute("Explain query plan Select ID from user where Nick = 'alice' and IDN = 1")
+    assert "Nick_IDN" in plan[0][3]
+    with pytest.raises(Exception):
+        dbms.execute("Insert into user(IDN, Nick, State, Photo, Comunication_key, User_password) values (1, 'ALICE', 0, '', '', 'pw')")
+
+
+def test_old_messages_read_by_everybody_are_archived(backend: SQLiteBackend, make_server) -> None:
+    server = make_server(DBMS({}, backend))
+    alice = _call(server, server.register("alice", "pw", b""))[0][0]
+    bob = _call(server, server.register("bob", "pw", b""))[0][0]
+    creator = User(alice, "alice", "1", "pw", b"")
+    chat_id = _call(server, server.create_chat(creator, "chat", "", [("bob", 1)]))["chat_id"]
+    for body in (b"one", b"two", b"three"):
+        _call(server, server.send_message(alice, chat_id, body))
+    server.dbms.execute("Update participate Set Last_message_id = 2 Where Id_chat = %s", (chat_id,))
+    # Nothing is old enough yet, then only the messages everybody read are moved
+    _archive(server, datetime.datetime.now() - datetime.timedelta(days=1))
+    assert server.dbms.execute("Select count(*) from message_archive") == [(0,)]
+    _archive(server, datetime.datetime.now() + datetime.timedelta(days=1))
+    assert server.dbms.execute("Select Message_number from message") == [(3,)]
+    assert server.dbms.execute("Select Message_number from message_archive order by 1") == [(1,), (2,)]
+    assert server.dbms.execute("Select Archived_number from chat") == [(2,)]
+    # The job is fire-and-forget
+    assert server.queue.response_stats()["stored"] == 0
+
+    # The history reads both tables
+    page = _call(server, server.get_chat_history(bob, chat_id, max_rows=2))
+    assert [message[5] for message in page["messages"]] == [b"two", b"three"]
+    assert page["more"]
+    page = _call(server, server.get_chat_history(bob, chat_id, before=page["cursor"]))
+    assert [message[5] for message in page["messages"]] == [b"one"]
+    assert not page["more"]
+    assert _call(server, server.get_chat_history(1, chat_id))["messages"] == []
+
+    # A partecipant added later still gets the archived messages
+    carol = _call(server, server.register("carol", "pw", b""))[0][0]
+    server.dbms.execute("Insert_participant", (1, "carol", chat_id), procedure=True)
+    assert [message[1] for message in server.dbms.execute("Messages_not_received", (carol,), procedure=True)] == [1, 2, 3]
+    page = _call(server, server.get_unread_messages(carol))
+    assert [message[5] for message in page["messages"]] == [b"one", b"two", b"three"]
+
+
+def test_small_chats_fan_out_on_write(backend: SQLiteBackend, make_server) -> None:
+    server = make_server(DBMS({}, backend))
+    server.inbox_max_chat_size = 2
+    alice = _call(server, server.register("alice", "pw", b""))[0][0]
+    bob = _call(server, server.register("bob", "pw", b""))[0][0]
+    _call(server, server.register("carol", "pw", b""))
+    creator = User(alice, "alice", "1", "pw", b"")
+    small = _call(server, server.create_chat(creator, "small", "", [("bob", 1)]))["chat_id"]
+    big = _call(server, server.create_chat(creator, "big", "", [("bob", 1), ("carol", 1)]))["chat_id"]
+    for chat_id in (small, big):
+        _call(server, server.send_message(alice, chat_id, b"hi"))
+    # Only the messages of the small chat are written to the inboxes, of both its partecipants
+    assert server.dbms.execute("Select Id_user, Id_chat, Message_number from inbox order by Id_user") == [(alice, small, 1), (bob, small, 1)]
+    page = _call(server, server.get_unread_messages(bob))
+    assert [(message[0], message[1]) for message in page["messages"]] == [(small, 1), (big, 1)]
+    assert server.dbms.execute("Select Id_user from inbox") == [(alice,)]
+    assert server.dbms.execute("Select Last_message_id from participate where Id_user = %s order by Id_chat", (bob,)) == [(1,), (1,)]
+    assert _call(server, server.get_unread_messages(bob))["messages"] == []
+    # Leaving the chat empties the inbox
+    server.dbms.execute("Delete_participant", (1, "alice", small), procedure=True)
+    assert server.dbms.execute("Select count(*) from inbox") == [(0,)]
+
+
+def test_archival_moves_the_first_messages_of_each_chat(backend: SQLiteBackend, make_server, monkeypatch) -> None:
+    server = make_server(DBMS({}, backend))
+    alice = _call(server, server.register("alice", "pw", b""))[0][0]
+    creator = User(alice, "alice", "1", "pw", b"")
+    chats = [_call(server, server.create_chat(creator, name, "", []))["chat_id"] for name in ("one", "two")]
+    for chat_id in chats:
+        for body in (b"a", b"b", b"c"):
+            _call(server, server.send_message(alice, chat_id, body))
+    server.dbms.execute("Update participate Set Last_message_id = 3")
+    # The second message of the first chat is recent: the ones after it stay too
+    server.dbms.execute("Update message Set Timestamp = '2000-01-01 00:00:00' Where not (Id_chat = %s And Message_number = 2)", (chats[0],))
+    # The batches are smaller than a chat
+    monkeypatch.setattr("server.MESSAGE_ARCHIVE_BATCH", 2)
+    _archive(server, datetime.datetime(2001, 1, 1))
+    assert server.dbms.execute("Select Id_chat, Message_number from message_archive order by 1, 2") == [(chats[0], 1), (chats[1], 1), (chats[1], 2), (chats[1], 3)]
+    assert server.dbms.execute("Select ID, Archived_number from chat order by 1") == [(chats[0], 1), (chats[1], 3)]
@@ -2,6 +2,9 @@ import sys
 sys.path.append('../ChitChat')
 
 from TaggedQueue import *
+import threading
+import time
+import pytest
 
 
 def test_put_request() -> None:
@@ -35,4 +38,230 @@ def test_next() -> None:
     tag = q.put_request(j)
     r = Response(tag, 'test')
     q.put_response(tag, r)
-    assert q.next().job_tag == j.job_tag
\ No newline at end of file
+    assert q.next().job_tag == j.job_tag
+
+
+def test_wait_for_result_wakes_up_on_put_response() -> None:
+    q = TaggedQueue()
+    tag = q.put_request(Job('test', 'test'))
+    r = Response(tag, 'test')
+    threading.Timer(0.05, q.put_response, args=(tag, r)).start()
+    start = time.time()
+    assert q.wait_for_result(tag, timeout=5) is r
+    assert time.time() - start < 1
+    assert tag not in q.responses
+
+
+def test_wait_for_result_timeout() -> None:
+    q = TaggedQueue()
+    tag = q.put_request(Job('test', 'test'))
+    assert q.wait_for_result(tag, timeout=0.01) is None
+    assert tag not in q.waiters
+
+
+def test_wait_for_result_without_pop() -> None:
+    q = TaggedQueue()
+    tag = q.put_request(Job('test', 'test'))
+    r = Response(tag, 'test')
+    q.put_response(tag, r)
+    assert q.wait_for_result(tag, pop_response=False) is r
+    assert q.wait_for_result(tag) is r
+    assert tag not in q.responses
+
+
+def test_next_is_fifo() -> None:
+    q = TaggedQueue()
+    tags = [q.put_request(Job('test', i)) for i in range(5)]
+    assert [q.next().job_tag for _ in range(5)] == tags
+    assert q.next() is None
+    assert len(q) == 0
+
+
+def test_next_blocks_until_a_job_arrives() -> None:
+    q = TaggedQueue()
+    j = Job('test', 'test')
+    threading.Timer(0.05, q.put_request, args=(j,)).start()
+    assert q.next(timeout=5) is j
+
+
+def test_next_timeout() -> None:
+    q = TaggedQueue()
+    start = time.time()
+    assert q.next(timeout=0.05) is None
+    assert time.time() - start >= 0.04
+
+
+def test_interactive_jobs_are_served_first() -> None:
+    q = TaggedQueue()
+    background = Job('set_status', 'test', priority=PRIORITY_BACKGROUND)
+    interactive = Job('login', 'test')
+    q.put_request(background)
+    q.put_request(interactive)
+    assert q.next() is interactive
+    assert q.next() is background
+
+
+def test_background_lane_does_not_starve() -> None:
+    q = TaggedQueue(lane_weights={PRIORITY_INTERACTIVE: 3, PRIORITY_BACKGROUND: 1})
+    for i in range(10):
+        q.put_request(Job('login', i))
+        q.put_request(Job('set_status', i, priority=PRIORITY_BACKGROUND))
+    served = [q.next().priority for _ in range(8)]
+    assert served.count(PRIORITY_BACKGROUND) == 2
+    assert served[:4] == [PRIORITY_INTERACTIVE] * 3 + [PRIORITY_BACKGROUND]
+
+
+def test_lane_stats() -> None:
+    q = TaggedQueue()
+    q.put_request(Job('login', 'test'))
+    q.put_request(Job('set_status', 'test', priority=PRIORITY_BACKGROUND))
+    q.put_request(Job('set_status', 'test', priority=PRIORITY_BACKGROUND))
+    q.next()
+    stats = q.lane_stats()
+    assert stats[PRIORITY_INTERACTIVE]["depth"] == 0
+    assert stats[PRIORITY_INTERACTIVE]["served"] == 1
+    assert stats[PRIORITY_BACKGROUND]["depth"] == 2
+    assert stats[PRIORITY_BACKGROUND]["served"] == 0
+    assert stats[PRIORITY_INTERACTIVE]["max_wait_time"] >= 0
+
+
+def test_unknown_priority() -> None:
+    q = TaggedQueue()
+    with pytest.raises(ValueError):
+        q.put_request(Job('test', 'test', priority=42))
+
+
+def test_responses_expire_after_ttl() -> None:
+    q = TaggedQueue(response_ttl=0.01)
+    tag = q.put_request(Job('set_status', 'test', priority=PRIORITY_BACKGROUND))
+    q.put_response(tag, Response(tag, 'test'))
+    time.sleep(0.02)
+    q.evict_expired_responses()
+    assert tag not in q.responses
+    assert tag not in q.waiters
+    assert q.response_stats()["expired"] == {'set_status': 1}
+
+
+def test_response_store_is_bounded() -> None:
+    q = TaggedQueue(max_responses=2)
+    tags = [q.put_request(Job('login', i)) for i in range(3)]
+    for tag in tags:
+        q.put_response(tag, Response(tag, 'test'))
+    assert list(q.responses) == tags[1:]
+    assert q.response_stats()["evicted"] == {'login': 1}
+
+
+def test_late_response_is_orphaned() -> None:
+    q = TaggedQueue()
+    tag = q.put_request(Job('get_chat', 'test'))
+    assert q.wait_for_result(tag, timeout=0.01) is None
+    q.put_response(tag, Response(tag, 'test'))
+    assert tag not in q.responses
+    assert q.response_stats()["orphaned"] == {'get_chat': 1}
+
+
+def test_sub_job_response_is_accounted_to_parent_type() -> None:
+    q = TaggedQueue()
+    tag = q.put_request(Job('create_chat', 'test'))
+    assert q.wait_for_result(str(tag) + "-1", timeout=0.01) is None
+    q.put_response(str(tag) + "-1", Response(tag, 'test'))
+    assert q.response_stats()["orphaned"] == {'create_chat': 1}
+
+
+def test_no_reply_job_has_no_bookkeeping() -> None:
+    q = TaggedQueue()
+    q.put_request(Job('set_status', 'test', priority=PRIORITY_BACKGROUND, no_reply=True))
+    assert q.response_stats()["pending"] == 0
+    assert q.next().no_reply
+
+
+def test_next_batch_takes_only_the_given_type() -> None:
+    q = TaggedQueue()
+    login = Job('login', 'test')
+    statuses = [Job('set_status', i, priority=PRIORITY_BACKGROUND) for i in range(3)]
+    q.put_request(statuses[0])
+    q.put_request(login)
+    q.put_request(statuses[1])
+    q.put_request(statuses[2])
+    assert q.next_batch('set_status', 2) == statuses[:2]
+    assert q.request_queue == [login, statuses[2]]
+
+
+def test_next_batch_waits_for_the_batch_to_fill() -> None:
+    q = TaggedQueue()
+    j = Job('set_status', 'test', priority=PRIORITY_BACKGROUND)
+    threading.Timer(0.02, q.put_request, args=(j,)).start()
+    assert q.next_batch('set_status', 5, max_wait=0.2) == [j]
+    assert q.next_batch('set_status', 5) == []
+
+
+def test_job_done_records_latencies() -> None:
+    q = TaggedQueue()
+    q.put_request(Job('login', 'test'))
+    job = q.next()
+    q.job_done(job)
+    assert job.request_time <= job.start_time <= job.response_time
+    stats = q.latency_stats()['login']
+    assert stats['queue_wait']['count'] == 1
+    assert stats['execution']['count'] == 1
+    assert stats['end_to_end']['count'] == 1
+
+
+def test_jobs_waiting_longer_than_their_timeout_are_dropped() -> None:
+    q = TaggedQueue()
+    q.set_job_type_limits('login', timeout=0.01)
+    q.put_request(Job('login', 'test'))
+    time.sleep(0.02)
+    assert q.next() is None
+    assert q.timed_out_jobs['login'] == 1
+
+
+def test_next_waits_for_a_limited_type_to_free_up() -> None:
+    q = TaggedQueue()
+    q.set_job_type_limits('create_chat', max_concurrency=1)
+    q.put_request(Job('create_chat', 1))
+    q.put_request(Job('create_chat', 2))
+    first = q.next()
+    threading.Timer(0.05, q.job_done, args=(first,)).start()
+    assert q.next(timeout=0.01) is None
+    assert q.next(timeout=5).args == 2
+
+
+def test_cancel_session_removes_its_queued_jobs() -> None:
+    q = TaggedQueue()
+    other = Job('get_chat', 'test', session='b')
+    q.put_request(Job('get_chat', 'test', session='a'))
+    q.put_request(other)
+    q.put_request(Job('update_chats', 'test', session='a'))
+    assert q.cancel_session('a') == 2
+    assert q.request_queue == [other]
+    assert q.cancelled_jobs == {'get_chat': 1, 'update_chats': 1}
+    assert q.response_stats()["pending"] == 1
+
+
+def test_pending_type_is_known_before_a_worker_can_take_the_job() -> None:
+    q = TaggedQueue()
+    registered = []
+
+    class Lane(deque):
+        def append(self, job):
+            registered.append(job.job_tag in q.pending_types)
+            super().append(job)
+
+    q.lanes[PRIORITY_INTERACTIVE] = Lane()
+    q.put_request(Job('get_chat', 'test'))
+    assert registered == [True]
+
+
+def test_pending_type_outlives_the_queue_timeout_of_its_job() -> None:
+    q = TaggedQueue(response_ttl=0.1)
+    q.set_job_type_limits('get_unread_messages', timeout=0.2)
+    tag = q.put_request(Job('get_unread_messages', 'test'))
+    other = q.put_request(Job('get_chat', 'test'))
+    time.sleep(0.15)
+    # The job may still be waiting to be taken: its type is known until its timeout plus the TTL
+    q.evict_expired_responses()
+    assert tag in q.pending_types
+    assert other not in q.pending_types
+    q.put_response(tag, Response(tag, 'test'))
+    assert q.response_deadlines[tag][1] == 'get_unread_messages'